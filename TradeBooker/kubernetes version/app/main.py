@@ -6,6 +6,7 @@ Routes to the appropriate service based on the SERVICE_TYPE environment variable
 
 import os
 import sys
+import signal
 
 def main():
     service_type = os.getenv('SERVICE_TYPE', 'streamlit')
@@ -54,12 +55,12 @@ def main():
     elif service_type == 'market-data':
         # Run market data service
         print("📊 Starting Market Data service...")
-        from market_data import main
-        main()
-        # Keep the service running
-        import time
-        while True:
-            time.sleep(60)  # Sleep for 1 minute between iterations
+        # Each replica refreshes its share of the ticker universe
+        from market_data import run_partitioned_updates
+        # Kubernetes stops pods with SIGTERM; exit through the update loop's cleanup so the replica
+        # leaves the membership right away and its tickers move to the others during rolling restarts
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        run_partitioned_updates()
     
     else:
         print(f"❌ Unknown SERVICE_TYPE: {service_type}")
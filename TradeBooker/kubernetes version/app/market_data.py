@@ -4,6 +4,9 @@ import os
 import logging
 from datetime import datetime, timedelta
 import re
+import time
+import pandas as pd
+from ticker_partition import TickerPartition
 
 # Standard periods that get updated daily by the main updater script
 STANDARD_PERIODS = ['1d', '5d', '1mo', '3mo', '1y', '5y', 'ytd']
@@ -582,6 +585,77 @@ def get_eod_price_range(ticker: str, start_date: str, end_date: str) -> dict:
         "total_days": len(sorted_daily_prices)
     }
 
+REFRESH_INTERVAL = 60  # seconds between live price refreshes of this replica's partition
+BATCH_SIZE = 200
+UNIVERSE_REFRESH_INTERVAL = 24 * 60 * 60  # Re-read the ticker listing once a day
+
+
+def get_ticker_universe(r) -> list:
+    """
+    Nasdaq-listed tickers. If the listing can't be fetched, fall back to the tickers that
+    already have a live price in Redis.
+    """
+    nasdaq_url = "ftp://ftp.nasdaqtrader.com/symboldirectory/nasdaqlisted.txt"
+    try:
+        df = pd.read_csv(nasdaq_url, sep='|')
+        df['Symbol'] = df['Symbol'].astype(str)
+        return sorted(df[~df['Symbol'].str.contains(r'\.|\$', na=False)]['Symbol'][:-1].tolist())
+    except Exception as e:
+        logging.error(f"Error fetching Nasdaq tickers: {e}")
+        return sorted(key[:-len(":Live")] for key in r.scan_iter(match="*:Live", count=1000))
+
+
+def refresh_live_prices(tickers: list, r) -> int:
+    """Download live prices in batches and write each batch in one pipeline. Returns tickers updated."""
+    updated = 0
+    for i in range(0, len(tickers), BATCH_SIZE):
+        batch = tickers[i:i + BATCH_SIZE]
+        try:
+            data = yf.download(' '.join(batch), period="1d", threads=True, ignore_tz=True, progress=False, auto_adjust=True)
+        except Exception as e:
+            logging.error(f"Error downloading batch: {e}")
+            continue
+        if data.empty:
+            continue
+
+        closes = data['Close'].iloc[-1]
+        pipe = r.pipeline(transaction=False)
+        for ticker in batch:
+            price = closes.iloc[0] if len(batch) == 1 else closes.get(ticker)
+            if price is not None and pd.notna(price):
+                pipe.set(f"{ticker}:Live", round(float(price), 2))
+                updated += 1
+        pipe.execute()
+    return updated
+
+
+def run_partitioned_updates():
+    """
+    Market-data service loop. Each replica refreshes only the tickers it owns; ownership is
+    recomputed every cycle, so the universe is re-split when replicas come and go.
+    """
+    r = get_redis_connection()
+    partition = TickerPartition(r)
+    partition.start()
+    print(f"📊 Market-data replica {partition.member} joined")
+
+    universe, universe_loaded_at = [], 0
+    try:
+        while True:
+            start_time = time.time()
+            if not universe or start_time - universe_loaded_at > UNIVERSE_REFRESH_INTERVAL:
+                universe, universe_loaded_at = get_ticker_universe(r), start_time
+
+            my_tickers = partition.my_tickers(universe)
+            updated = refresh_live_prices(my_tickers, r)
+            print(f"[{partition.member}] Updated {updated}/{len(my_tickers)} of {len(universe)} tickers "
+                  f"({len(partition.members) or 1} replicas) in {time.time() - start_time:.2f}s")
+
+            time.sleep(max(0, REFRESH_INTERVAL - (time.time() - start_time)))
+    finally:
+        partition.stop()
+
+
 def main():
     # Test live prices
     try:
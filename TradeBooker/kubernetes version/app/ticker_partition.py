@@ -0,0 +1,113 @@
+import os
+import re
+import time
+import zlib
+import hashlib
+import logging
+import threading
+from typing import List
+
+# Splits the ticker universe across market-data replicas so N replicas each refresh 1/N of it.
+# Replicas announce themselves in the 'market_data:members' sorted set (member = pod name,
+# score = last heartbeat). The live members at any moment own the universe by rendezvous hashing:
+# a ticker belongs to the member with the highest hash(member, ticker). When a replica joins or
+# its heartbeat lapses, only the tickers it gains or loses move; everyone else keeps theirs.
+# If Redis membership can't be read, the StatefulSet ordinal in POD_NAME ('market-data-2')
+# and MARKET_DATA_REPLICAS give a static split instead.
+MEMBERS_ZSET = "market_data:members"
+HEARTBEAT_INTERVAL = 10  # seconds
+MEMBER_TTL = 30  # A replica missing three heartbeats is dropped and its tickers rebalanced
+
+
+def get_member_name() -> str:
+    return os.getenv('POD_NAME') or os.getenv('HOSTNAME', 'market-data-0')
+
+
+def get_ordinal(member: str) -> int:
+    """StatefulSet pods are named '<statefulset>-<ordinal>'"""
+    match = re.search(r'-(\d+)$', member)
+    return int(match.group(1)) if match else 0
+
+
+def heartbeat(r, member: str):
+    r.zadd(MEMBERS_ZSET, {member: time.time()})
+
+
+def get_live_members(r) -> List[str]:
+    """Members with a recent heartbeat, oldest entries pruned on the way."""
+    pipe = r.pipeline(transaction=False)
+    pipe.zremrangebyscore(MEMBERS_ZSET, "-inf", f"({time.time() - MEMBER_TTL}")
+    pipe.zrange(MEMBERS_ZSET, 0, -1)
+    return sorted(pipe.execute()[1])
+
+
+def leave(r, member: str):
+    """Drop out right away on shutdown instead of waiting for the heartbeat to lapse."""
+    r.zrem(MEMBERS_ZSET, member)
+
+
+def _score(member: str, ticker: str) -> int:
+    # crc32 of near-identical strings spreads poorly across members; a digest mixes evenly
+    return int.from_bytes(hashlib.blake2b(f"{member}:{ticker}".encode(), digest_size=8).digest(), "big")
+
+
+def owner_of(ticker: str, members: List[str]) -> str:
+    return max(members, key=lambda member: _score(member, ticker))
+
+
+def partition_tickers(tickers: List[str], members: List[str], member: str) -> List[str]:
+    """The tickers this member owns among the given members."""
+    if member not in members:
+        members = members + [member]
+    if len(members) == 1:
+        return list(tickers)
+    return [ticker for ticker in tickers if owner_of(ticker, members) == member]
+
+
+def static_partition(tickers: List[str], member: str) -> List[str]:
+    """Ordinal-based fallback: a ticker belongs to replica crc32(ticker) % MARKET_DATA_REPLICAS."""
+    replicas = max(1, int(os.getenv('MARKET_DATA_REPLICAS', '1')))
+    ordinal = get_ordinal(member) % replicas
+    return [ticker for ticker in tickers if zlib.crc32(ticker.encode()) % replicas == ordinal]
+
+
+class TickerPartition:
+    """Keeps this replica's heartbeat alive in the background and answers which tickers it owns."""
+
+    def __init__(self, r, member: str = None):
+        self.r = r
+        self.member = member or get_member_name()
+        self.members: List[str] = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        heartbeat(self.r, self.member)
+        self._thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        try:
+            leave(self.r, self.member)
+        except Exception as e:
+            logging.warning(f"Could not leave market-data membership: {e}")
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                heartbeat(self.r, self.member)
+            except Exception as e:
+                logging.warning(f"Market-data heartbeat failed: {e}")
+
+    def my_tickers(self, tickers: List[str]) -> List[str]:
+        try:
+            members = get_live_members(self.r)
+        except Exception as e:
+            logging.warning(f"Could not read market-data membership, using the StatefulSet ordinal: {e}")
+            return static_partition(tickers, self.member)
+
+        if members != self.members:
+            logging.info(f"Market-data members changed: {members}")
+            self.members = members
+        return partition_tickers(tickers, members, self.member)
@@ -1,11 +1,15 @@
 from datetime import datetime
 import redis
-from redis.sentinel import Sentinel
 import uuid
 import time
 import logging
 from typing import List
 from .Trade import Trade
+from .trade_index import EST, TRADE_INDEX_PREFIX, trade_index_key, index_trade, get_trade_keys
+from . import trade_index
+from .redis_connection import get_redis_client
+from .price_events import HELD_TICKERS_SET
+from .trade_events import AGGREGATOR_GROUP, PNL_GROUP, SHARDS, booked_trades_stream, ensure_consumer_group
 import csv
 import os
 
@@ -18,12 +22,9 @@ logger = logging.getLogger(__name__)
 class TradeManager:
     
     def __init__(self, sentinels=None, service_name="mymaster"):
-        if sentinels is None:
-            sentinels = [("sentinel1", 26379), ("sentinel2", 26379), ("sentinel3", 26379)]
-        
         try:
-            sentinel = Sentinel(sentinels, socket_timeout=0.5, decode_responses=True)
-            self.redis_client = sentinel.master_for(service_name, socket_timeout=0.5, decode_responses=True)
+            # Shared pooled connection; defaults to the standard sentinels
+            self.redis_client = get_redis_client(socket_timeout=0.5, sentinels=sentinels, service_name=service_name)
             self.redis_client.ping()
         except redis.ConnectionError as e:
             logger.error(f"Could not connect to Redis Sentinel: {e}")
@@ -119,9 +120,20 @@ class TradeManager:
         except (ValueError, IndexError) as e:
             raise ValueError(f"Invalid full trade string format: {trade_string}") from e
 
+    @staticmethod
+    def _booked_timestamp(trade: Trade) -> float:
+        """Score used for the per-account trade index, taken from the trade's own date and time."""
+        trade_time = trade.trade_time.strip("[]")
+        booked_dt = datetime.strptime(f"{trade.trade_date} {trade_time}", "%Y-%m-%d %H:%M:%S")
+        return booked_dt.replace(tzinfo=EST).timestamp()
+
     def write_trade(self, trade: Trade) -> bool:
         try:
-            self.redis_client.hset(trade.to_redis_key(), mapping=trade.to_redis_hash())
+            pipe = self.redis_client.pipeline()
+            pipe.hset(trade.to_redis_key(), mapping=trade.to_redis_hash())
+            index_trade(pipe, trade.account_id, trade.to_redis_key(), self._booked_timestamp(trade))
+            pipe.sadd("accounts", trade.account_id)
+            pipe.execute()
             return True
         except Exception as e:
             logger.error(f"Error saving trade: {e}")
@@ -132,6 +144,8 @@ class TradeManager:
             pipe = self.redis_client.pipeline()
             for trade in trades:
                 pipe.hset(trade.to_redis_key(), mapping=trade.to_redis_hash())
+                index_trade(pipe, trade.account_id, trade.to_redis_key(), self._booked_timestamp(trade))
+                pipe.sadd("accounts", trade.account_id)
             pipe.execute()
             return True
         except Exception as e:
@@ -150,7 +164,7 @@ class TradeManager:
         logger.info(f" Time taken: {duration:.2f} seconds")
         logger.info(f" Average time per trade: {duration / len(trades):.6f} seconds")
         logger.info(f" Trades per second: {len(trades) / duration:.2f}")
-        logger.info(f" Total trades in Redis: {len(self.redis_client.keys())}")
+        logger.info(f" Total trades in Redis: {self.count_indexed_trades()}")
         print()
         
         return success
@@ -158,14 +172,44 @@ class TradeManager:
     def get_all_trades(self) -> List[Trade]:
         trades = []
         try:
-            for key in self.redis_client.keys():
-                hash_data = self.redis_client.hgetall(key)
-                trade = Trade.from_redis_data(key, hash_data)
-                trades.append(trade)
+            for account in sorted(self.redis_client.smembers("accounts")):
+                trades += self.get_trades_for_account(account)
         except Exception as e:
             logger.error(f"Error retrieving trades: {e}")
         
         return trades
+
+    def get_trades_for_account(self, account_id: str, start_date=None, end_date=None) -> List[Trade]:
+        """
+        Reads an account's trades through the per-account index (oldest first),
+        optionally limited to an inclusive booking date range.
+        """
+        trades = []
+        keys = get_trade_keys(self.redis_client, account_id, start_date, end_date)
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        for key, hash_data in zip(keys, pipe.execute() if keys else []):
+            if not hash_data:
+                continue
+            try:
+                trades.append(Trade.from_redis_data(key, hash_data))
+            except (ValueError, KeyError) as e:
+                logger.warning(f"Skipping unreadable trade {key}: {e}")
+        return trades
+
+    def count_indexed_trades(self) -> int:
+        """Total number of trades across all account indexes."""
+        pipe = self.redis_client.pipeline(transaction=False)
+        for account in self.redis_client.smembers("accounts"):
+            pipe.zcard(trade_index_key(account))
+        return sum(pipe.execute())
+
+    def rebuild_trade_index(self) -> int:
+        """Backfills the per-account index for trades booked before the index existed."""
+        indexed = trade_index.rebuild_trade_index(self.redis_client)
+        logger.info(f"Indexed {indexed} existing trades.")
+        return indexed
     
     def clear_all_trades(self):
         """
@@ -195,18 +239,46 @@ class TradeManager:
             pipe.execute()
             logger.info(f"Deleted {lots_keys_deleted} PnL lot keys.")
 
+            index_keys_deleted = 0
+            pipe = self.redis_client.pipeline()
+            for key in self.redis_client.scan_iter(f"{TRADE_INDEX_PREFIX}*"):
+                pipe.unlink(key)
+                index_keys_deleted += 1
+            pipe.execute()
+            logger.info(f"Deleted {index_keys_deleted} per-account trade index keys.")
+
+            ticker_index_keys_deleted = 0
+            pipe = self.redis_client.pipeline()
+            for key in self.redis_client.scan_iter("positions_by_ticker:*"):
+                pipe.unlink(key)
+                ticker_index_keys_deleted += 1
+            pipe.execute()
+            logger.info(f"Deleted {ticker_index_keys_deleted} ticker-to-position index keys.")
+
             self.redis_client.delete("accounts")
             logger.info("Cleared all accounts from the accounts set.")
             # --- 3. Delete the main data hashes ---
             keys_to_delete = [
                 "positions",
                 "realized_pnl_by_position",
-                "unrealized_pnl_by_position"
+                "unrealized_pnl_by_position",
+                "open_quantity_by_position",
+                "cost_basis_by_position",
+                HELD_TICKERS_SET
             ]
             if keys_to_delete:
                 deleted_count = self.redis_client.unlink(*keys_to_delete)
                 logger.info(f"Deleted {deleted_count} main data hashes: {keys_to_delete}")
 
+            # --- 4. Empty the per-shard booked-trade streams ---
+            # Their consumer groups are recreated right away so the aggregator and PnL workers keep running
+            booked_streams = [booked_trades_stream(shard) for shard in SHARDS]
+            self.redis_client.unlink(*booked_streams)
+            for stream in booked_streams:
+                ensure_consumer_group(self.redis_client, stream, AGGREGATOR_GROUP)
+                ensure_consumer_group(self.redis_client, stream, PNL_GROUP)
+            logger.info(f"Emptied {len(booked_streams)} booked-trade streams.")
+
             # Note: We are INTENTIONALLY NOT deleting 'trades_stream' or 'command_stream'
             # to keep the consumer services running.
 
@@ -3,11 +3,16 @@ import datetime
 import redis
 import json # Use json for safe serialization instead of eval
 import logging
+try:
+    from .redis_connection import get_redis_client
+except ImportError:
+    from redis_connection import get_redis_client
 
 
 class UserManager:
-    def __init__(self, redis_client):
-        self.r = redis_client
+    def __init__(self, redis_client=None):
+        # Defaults to the shared pooled connection
+        self.r = redis_client if redis_client is not None else get_redis_client()
     
     def create_user(self, user):
         """Creates a user hash. Accounts are stored separately."""
@@ -1,17 +1,26 @@
 import datetime
 import time
 import redis
-from redis.sentinel import Sentinel
 import yfinance as yf
 import pandas as pd
 from typing import List
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pytz
+from price_events import publish_live_prices
+from redis_connection import get_redis_client
+from eod_store import add_eod_prices, date_score, eod_key, has_eod_price
+import price_store
+from ticker_demand import get_hot_tickers, rebuild_held_tickers
+from yf_downloads import DownloadPool
 
 # --------------------
 # Configuration
 # --------------------
-REFRESH_INTERVAL = 900  # 15 minutes in seconds
-BATCH_SIZE = 500
+HOT_REFRESH_INTERVAL = 15  # Held and recently viewed tickers, in seconds
+COLD_REFRESH_INTERVAL = 300  # The rest of the universe, in seconds
+BATCH_SIZE = 1000  # yf.download fetches a batch's tickers in parallel itself (threads=True)
+HISTORY_BATCH_SIZE = 500  # Smaller batches for history (API intensive)
+BATCH_WORKERS = 4  # Batches being processed at once, each downloading in its own process
 MARKET_OPEN_HOUR = 9
 MARKET_OPEN_MINUTE = 30
 MARKET_CLOSE_HOUR = 16
@@ -21,14 +30,32 @@ HISTORY_PERIODS = ['1d', '5d', '1mo', '3mo', '1y', '5y', 'ytd']
 
 
 def get_redis_connection():
-    sentinels = [
-        ("sentinel1", 26379),
-        ("sentinel2", 26379),
-        ("sentinel3", 26379)
-    ]
-    service_name = "mymaster"  # match your sentinel config
-    sentinel = Sentinel(sentinels, socket_timeout=1, decode_responses=True)
-    return sentinel.master_for(service_name, socket_timeout=1, decode_responses=True)
+    return get_redis_client(socket_timeout=1)
+
+
+# yf.download isn't thread-safe, so concurrent batch downloads run in separate processes
+download_pool = DownloadPool(BATCH_WORKERS)
+
+
+def run_batches(tickers: List[str], batch_size: int, process_batch) -> int:
+    """
+    Run process_batch(batch, batch_num, total_batches) over the tickers in batches on BATCH_WORKERS
+    threads, so one batch's parsing and Redis writes overlap the other batches' downloads. Downloads
+    go through download_pool: up to BATCH_WORKERS in flight, paced by the shared rate limiter.
+
+    :return: Sum of what process_batch returned (e.g. tickers updated).
+    """
+    batches = [tickers[i:i + batch_size] for i in range(0, len(tickers), batch_size)]
+    total_batches = len(batches)
+    total = 0
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+        futures = [pool.submit(process_batch, batch, batch_num, total_batches) for batch_num, batch in enumerate(batches, start=1)]
+        for future in as_completed(futures):
+            try:
+                total += future.result() or 0
+            except Exception as e:
+                print(f"\nError processing batch: {e}")
+    return total
 
 
 def get_nasdaq_tickers():
@@ -54,15 +81,7 @@ def get_batch_ticker_histories(tickers: List[str]):
     """
     try:
         # Download 2 years of data for all tickers at once
-        ticker_string = ' '.join(tickers)
-        hist_data = yf.download(
-            ticker_string,
-            period="2y",
-            threads=True,
-            ignore_tz=True,
-            progress=False,
-            auto_adjust=True
-        )
+        hist_data = download_pool.download(tickers, period="2y")
         
         if hist_data.empty:
             return {ticker: {period: None for period in HISTORY_PERIODS} for ticker in tickers}
@@ -85,6 +104,9 @@ def get_batch_ticker_histories(tickers: List[str]):
             # Single ticker - hist_data['Close'] is a Series
             ticker = tickers[0]
             close_prices = hist_data['Close']
+            if isinstance(close_prices, pd.DataFrame):
+                close_prices = close_prices.iloc[:, 0]
+            store_closes(ticker, close_prices)
             results[ticker] = extract_historical_prices(close_prices, period_to_days)
         else:
             # Multiple tickers - hist_data['Close'] is a DataFrame
@@ -93,6 +115,7 @@ def get_batch_ticker_histories(tickers: List[str]):
             for ticker in tickers:
                 if ticker in close_data.columns:
                     close_prices = close_data[ticker].dropna()
+                    store_closes(ticker, close_prices)
                     results[ticker] = extract_historical_prices(close_prices, period_to_days)
                 else:
                     results[ticker] = {period: None for period in HISTORY_PERIODS}
@@ -104,6 +127,14 @@ def get_batch_ticker_histories(tickers: List[str]):
         return {ticker: {period: None for period in HISTORY_PERIODS} for ticker in tickers}
 
 
+def store_closes(ticker: str, close_prices):
+    """Keep the full daily history in the local price store, not just the period snapshots."""
+    try:
+        price_store.write_closes(ticker, close_prices)
+    except Exception as e:
+        print(f"Error storing price history for {ticker}: {e}")
+
+
 def extract_historical_prices(close_prices, period_to_days):
     """
     Extract historical prices for all periods from a price series.
@@ -141,52 +172,40 @@ def extract_historical_prices(close_prices, period_to_days):
     return history_data
 
 
+def store_histories_batch(batch: List[str], r: redis.Redis) -> int:
+    """
+    Download one batch of histories and write every period of every ticker in one pipeline.
+    Returns the number of tickers stored.
+    """
+    # Get histories for entire batch in one API call
+    batch_histories = get_batch_ticker_histories(batch)
+
+    pipe = r.pipeline(transaction=False)
+    batch_success = 0
+    for ticker, history_data in batch_histories.items():
+        # Store each period as a separate Redis key
+        stored = False
+        for period, price in history_data.items():
+            if price is not None:
+                pipe.set(f"{ticker}:{period}", str(price))
+                stored = True
+        batch_success += stored
+    pipe.execute()
+    return batch_success
+
+
 def update_all_ticker_histories(tickers: List[str], r: redis.Redis):
     """
-    Update historical data for all tickers using batch processing for speed.
+    Update historical data for all tickers, with several batch downloads in flight.
     """
     print(f"\nUpdating price history for {len(tickers)} tickers...")
-    
-    # Use smaller batch size for history (API intensive)
-    batch_size = 250
-    total_batches = (len(tickers) + batch_size - 1) // batch_size
-    total_success = 0
-    
-    for batch_num in range(total_batches):
-        start_idx = batch_num * batch_size
-        end_idx = min(start_idx + batch_size, len(tickers))
-        batch = tickers[start_idx:end_idx]
-        
-        print(f"\rProcessing batch {batch_num + 1}/{total_batches}: {len(batch)} tickers", end='', flush=True)
-        
-        try:
-            # Get histories for entire batch in one API call
-            batch_histories = get_batch_ticker_histories(batch)
-            
-            # Update Redis for all tickers in batch
-            batch_success = 0
-            for ticker, history_data in batch_histories.items():
-                try:
-                    # Store each period as a separate Redis key
-                    for period, price in history_data.items():
-                        if price is not None:
-                            history_key = f"{ticker}:{period}"
-                            r.set(history_key, str(price))
-                    
-                    batch_success += 1
-                    total_success += 1
-                    
-                except Exception as e:
-                    print(f"\nError updating Redis for {ticker}: {e}")
-            
-            print(f" -> {batch_success}/{len(batch)} updated", end='', flush=True)
-            
-        except Exception as e:
-            print(f"\nError processing batch {batch_num + 1}: {e}")
-        
-        # Small pause between batches
-        time.sleep(2)  # Slightly longer pause since we're getting more data
-    
+
+    def process_batch(batch, batch_num, total_batches):
+        batch_success = store_histories_batch(batch, r)
+        print(f"\rHistory batch {batch_num}/{total_batches}: {batch_success}/{len(batch)} updated", end='', flush=True)
+        return batch_success
+
+    total_success = run_batches(tickers, HISTORY_BATCH_SIZE, process_batch)
     print(f"\n✓ History update completed: {total_success}/{len(tickers)} tickers updated successfully")
 
 
@@ -196,57 +215,22 @@ def check_and_create_missing_histories(tickers: List[str], r: redis.Redis):
     This handles cases where the program starts and histories don't exist.
     """
     print("Checking for missing price histories...")
-    missing_tickers = []
-    
-    # Check which tickers are missing history data (check for 1d as indicator)
+
+    # Check which tickers are missing history data (check for 1d as indicator), in one round trip
+    pipe = r.pipeline(transaction=False)
     for ticker in tickers:
-        history_key = f"{ticker}:1d"  # Use 1d as indicator for history existence
-        if not r.exists(history_key):
-            missing_tickers.append(ticker)
-    
+        pipe.exists(f"{ticker}:1d")  # Use 1d as indicator for history existence
+    missing_tickers = [ticker for ticker, exists in zip(tickers, pipe.execute()) if not exists]
+
     if missing_tickers:
         print(f"Found {len(missing_tickers)} tickers without history data. Creating...")
-        
-        # Use the same batched approach as update_all_ticker_histories
-        batch_size = 250
-        total_batches = (len(missing_tickers) + batch_size - 1) // batch_size
-        total_success = 0
-        
-        for batch_num in range(total_batches):
-            start_idx = batch_num * batch_size
-            end_idx = min(start_idx + batch_size, len(missing_tickers))
-            batch = missing_tickers[start_idx:end_idx]
-            
-            print(f"\rCreating histories batch {batch_num + 1}/{total_batches}: {len(batch)} tickers", end='', flush=True)
-            
-            try:
-                # Get histories for entire batch in one API call
-                batch_histories = get_batch_ticker_histories(batch)
-                
-                # Update Redis for all tickers in batch
-                batch_success = 0
-                for ticker, history_data in batch_histories.items():
-                    try:
-                        # Store each period as a separate Redis key
-                        for period, price in history_data.items():
-                            if price is not None:
-                                history_key = f"{ticker}:{period}"
-                                r.set(history_key, str(price))
-                        
-                        batch_success += 1
-                        total_success += 1
-                        
-                    except Exception as e:
-                        print(f"\nError updating Redis for {ticker}: {e}")
-                
-                print(f" -> {batch_success}/{len(batch)} created", end='', flush=True)
-                
-            except Exception as e:
-                print(f"\nError processing batch {batch_num + 1}: {e}")
-            
-            # Small delay between batches
-            time.sleep(2)
-        
+
+        def process_batch(batch, batch_num, total_batches):
+            batch_success = store_histories_batch(batch, r)
+            print(f"\rCreating histories batch {batch_num}/{total_batches}: {batch_success}/{len(batch)} created", end='', flush=True)
+            return batch_success
+
+        total_success = run_batches(missing_tickers, HISTORY_BATCH_SIZE, process_batch)
         print(f"\n✓ Created {total_success}/{len(missing_tickers)} missing price histories")
     else:
         print("✓ All tickers already have price history data")
@@ -336,70 +320,66 @@ def wait_for_market_open():
     print("\n✓ Market is now open!")
 
 
-def update_prices_batch(tickers: List[str], r: redis.Redis, batch_num: int, total_batches: int):
+def update_prices_batch(tickers: List[str], r: redis.Redis, batch_num: int, total_batches: int) -> int:
     """
-    Update prices for a batch of tickers in Redis.
+    Update prices for a batch of tickers in Redis, written in one pipeline.
+    Returns the number of tickers updated.
     """
-    et_tz = pytz.timezone(MARKET_TIMEZONE)
-    now = datetime.datetime.now(et_tz)
-    today = now.strftime('%Y-%m-%d')
-
     # Download batch data
     try:
-        ticker_string = ' '.join(tickers)
-        data = yf.download(
-            ticker_string,
-            period="1d",
-            threads=True,
-            ignore_tz=True,
-            progress=False,
-            auto_adjust=True
-        )
+        data = download_pool.download(tickers, period="1d")
 
         if data.empty:
             print(f"No data returned for batch")
-            return
+            return 0
 
-        # Count successful updates
-        updated_count = 0
+        # Collect the batch's prices and write them in one round trip
+        prices = {}
 
         # Handle both single ticker and multi-ticker cases
         if len(tickers) == 1:
             # Single ticker - data['Close'] is a Series
-            close_price = data['Close'].iloc[-1]
-            update_redis(tickers[0], close_price, r, today)
-            updated_count = 1
+            prices[tickers[0]] = data['Close'].iloc[-1]
         else:
             # Multiple tickers - data['Close'] is a DataFrame
             close_prices = data['Close'].iloc[-1]
             for ticker in tickers:
                 if ticker in close_prices.index and pd.notna(close_prices[ticker]):
-                    update_redis(ticker, close_prices[ticker], r, today)
-                    updated_count += 1
+                    prices[ticker] = close_prices[ticker]
+
+        changed_count = publish_live_prices(r, prices)
 
         # Progress indicator
-        print(f"\rBatch {batch_num}/{total_batches}: Updated {updated_count}/{len(tickers)} tickers", end='', flush=True)
+        print(f"\rBatch {batch_num}/{total_batches}: Updated {len(prices)}/{len(tickers)} tickers ({changed_count} moved)", end='', flush=True)
+        return len(prices)
 
     except Exception as e:
         print(f"Error downloading batch data: {e}")
-        # Fall back to individual ticker fetching
+        # Fall back to individual ticker fetching, still written in one pipeline
+        prices = {}
         for ticker in tickers:
             try:
                 info = yf.Ticker(ticker).fast_info
                 price = info.get('lastPrice') or info.get('regularMarketPrice')
                 if price:
-                    update_redis(ticker, price, r, today)
+                    prices[ticker] = price
             except Exception as e:
                 print(f"Error fetching {ticker}: {e}")
+        publish_live_prices(r, prices)
+        return len(prices)
+
+
+def refresh_prices(tickers: List[str], r: redis.Redis) -> int:
+    """Refresh the live price of every ticker, with several batch downloads in flight. Returns tickers updated."""
+    return run_batches(tickers, BATCH_SIZE, lambda batch, batch_num, total_batches: update_prices_batch(batch, r, batch_num, total_batches))
 
 
 def update_redis(ticker: str, price: float, r: redis.Redis, today: str):
     """
     Update live price in Redis. EOD updates are handled separately.
     """
-    # Always update live price during market hours
-    live_key = f"{ticker}:Live"
-    r.set(live_key, f"{float(price):.2f}")
+    # Always update live price during market hours; a change is also published for revaluation
+    publish_live_prices(r, {ticker: price})
 
 
 def create_eod_snapshots(tickers: List[str], r: redis.Redis):
@@ -412,15 +392,20 @@ def create_eod_snapshots(tickers: List[str], r: redis.Redis):
     print(f"\nCreating EOD snapshots for {today}...")
     created_count = 0
 
+    # One MGET for the live prices, one pipeline to see which EODs exist and one for the writes
+    live_prices = r.mget([f"{ticker}:Live" for ticker in tickers])
+    pipe = r.pipeline(transaction=False)
     for ticker in tickers:
-        live_key = f"{ticker}:Live"
-        eod_key = f"{ticker}:{today}"
+        pipe.zcount(eod_key(ticker), date_score(today), date_score(today))
+    existing = pipe.execute()
 
+    pipe = r.pipeline(transaction=False)
+    for ticker, price, exists in zip(tickers, live_prices, existing):
         # Only create EOD if it doesn't exist and we have a live price
-        if not r.exists(eod_key) and r.exists(live_key):
-            price = r.get(live_key)
-            r.set(eod_key, f"{float(price):.2f}")
+        if price is not None and not exists:
+            add_eod_prices(pipe, ticker, {today: price})
             created_count += 1
+    pipe.execute()
 
     print(f"✓ Created {created_count} EOD snapshots for {today}")
 
@@ -428,43 +413,49 @@ def create_eod_snapshots(tickers: List[str], r: redis.Redis):
 def run_market_hours_updates(tickers: List[str], r: redis.Redis):
     """
     Run updates during market hours, then create EOD snapshots.
+    The hot tier (held and recently viewed tickers) is refreshed every HOT_REFRESH_INTERVAL,
+    the cold remainder of the universe every COLD_REFRESH_INTERVAL. Tiers are recomputed on
+    every hot pass, so tickers move between them as positions open and close.
     """
     et_tz = pytz.timezone(MARKET_TIMEZONE)
+    next_hot = next_cold = time.time()
+    all_tickers = set(tickers)
 
     while is_market_open():
-        start_time = time.time()
-        total_batches = (len(tickers) + BATCH_SIZE - 1) // BATCH_SIZE
-
+        now = time.time()
         current_time = datetime.datetime.now(et_tz).strftime('%I:%M %p ET')
-        print(f"\n[{current_time}] Updating {len(tickers)} tickers in {total_batches} batches...")
-
-        # Process tickers in batches
-        for i in range(0, len(tickers), BATCH_SIZE):
-            batch = tickers[i:i + BATCH_SIZE]
-            batch_num = i // BATCH_SIZE + 1
-            update_prices_batch(batch, r, batch_num, total_batches)
-            time.sleep(1)  # Be respectful to the API
 
-        print()  # New line after progress updates
-
-        elapsed = time.time() - start_time
-        print(f"Update completed in {elapsed:.2f} seconds")
+        if now >= next_hot:
+            start_time = time.time()
+            hot_tickers = get_hot_tickers(r)
+            all_tickers |= hot_tickers  # Held or viewed tickers outside the listing still get prices and EODs
+            print(f"\n[{current_time}] Updating {len(hot_tickers)} hot tickers...")
+            updated_count = refresh_prices(sorted(hot_tickers), r)
+            print(f"\nUpdated {updated_count}/{len(hot_tickers)} hot tickers in {time.time() - start_time:.2f} seconds")
+            next_hot = start_time + HOT_REFRESH_INTERVAL
+
+        if now >= next_cold:
+            start_time = time.time()
+            cold_tickers = [ticker for ticker in tickers if ticker not in hot_tickers]
+            print(f"\n[{current_time}] Updating {len(cold_tickers)} cold tickers...")
+            updated_count = refresh_prices(cold_tickers, r)
+            print(f"\nUpdated {updated_count}/{len(cold_tickers)} cold tickers in {time.time() - start_time:.2f} seconds")
+            next_cold = start_time + COLD_REFRESH_INTERVAL
 
         # Check if market is still open before sleeping
         if is_market_open():
-            # Calculate time until next update or market close
+            # Sleep until the next tier is due or the market closes
             now = datetime.datetime.now(et_tz)
             market_close = now.replace(hour=MARKET_CLOSE_HOUR, minute=MARKET_CLOSE_MINUTE, second=0, microsecond=0)
             time_until_close = (market_close - now).total_seconds()
 
-            sleep_time = min(max(0, REFRESH_INTERVAL - elapsed), time_until_close)
+            sleep_time = min(max(0, min(next_hot, next_cold) - time.time()), time_until_close)
 
             if sleep_time > 0:
-                print(f"Next update in {sleep_time/60:.1f} minutes...")
                 time.sleep(sleep_time)
 
     # Market just closed - create EOD snapshots
-    create_eod_snapshots(tickers, r)
+    create_eod_snapshots(sorted(all_tickers), r)
 
 
 def initial_price_fetch(tickers: List[str], r: redis.Redis):
@@ -472,14 +463,7 @@ def initial_price_fetch(tickers: List[str], r: redis.Redis):
     Fetch current prices for all tickers - used for initial setup or after-hours startup.
     """
     print("Fetching current prices for all tickers...")
-    total_batches = (len(tickers) + BATCH_SIZE - 1) // BATCH_SIZE
-
-    for i in range(0, len(tickers), BATCH_SIZE):
-        batch = tickers[i:i + BATCH_SIZE]
-        batch_num = i // BATCH_SIZE + 1
-        print(f"\rFetching batch {batch_num}/{total_batches}...", end='', flush=True)
-        update_prices_batch(batch, r, batch_num, total_batches)
-        time.sleep(1)
+    refresh_prices(tickers, r)
 
     print("\n✓ Initial price fetch completed")
 
@@ -496,7 +480,7 @@ def check_and_create_missing_eods(tickers: List[str], r: redis.Redis):
     if now.weekday() <= 4 and now.hour >= MARKET_CLOSE_HOUR:
         # Check if we already have EODs for today
         sample_ticker = "AAPL" #tickers[0] if tickers else None
-        if sample_ticker and not r.exists(f"{sample_ticker}:{today}"):
+        if sample_ticker and not has_eod_price(r, sample_ticker, today):
             print(f"\nMarket closed but EODs missing for {today}.")
 
             # First check if we have any live prices
@@ -523,10 +507,13 @@ def main():
     print(f"Redis Stock Price Updater with History")
     print(f"Tracking {len(tickers)} NASDAQ tickers")
     print(f"Market Hours: 9:30 AM - 4:00 PM ET")
-    print(f"Update Interval: {REFRESH_INTERVAL/60} minutes")
+    print(f"Update Interval: {HOT_REFRESH_INTERVAL} seconds (held/viewed tickers), {COLD_REFRESH_INTERVAL/60} minutes (everything else)")
     print(f"History Periods: {', '.join(HISTORY_PERIODS)}")
     print(f"{'='*60}\n")
 
+    # Positions opened before 'held_tickers' was maintained still count as held
+    print(f"Found {rebuild_held_tickers(r)} held tickers.")
+
     # Check and create missing price histories (for program startup)
     check_and_create_missing_histories(tickers, r)
 
@@ -565,7 +552,7 @@ if __name__ == '__main__':
 This should always be running
 How this works:
 The redis db could start off as empty or with existing tickers/eods from the day before
-When the market opens at 9:30 am, the program updates the live key every 15 min for all tickers. 
+When the market opens at 9:30 am, the program updates the live key every 15 seconds for held and recently viewed tickers and every 5 minutes for the rest (several rate-limited batch downloads in flight, one pipeline per batch). 
 Once the market closes, it adds all the eod prices for each day for each ticker. 
 If program starts running when the market is closed, it first checks if eods are in, if they arent, they get added.
 Once the eods are in and the market is closed, the program sleeps and waits for market to open to repeat the live updating.
@@ -576,7 +563,7 @@ NEW HISTORY FUNCTIONALITY:
 - For example: AAPL:5d = "150.25" (price from 5 trading days ago)
 - YTD contains the price from the first trading day of the current year
 - History updates once per day at the beginning of each trading day (before market open)
-- Uses batch processing (100 tickers per batch) with reduced delays for fast daily updates
+- Uses batch processing (500 tickers per history batch, 1000 per price batch, up to 4 downloads in flight in separate processes) for fast daily updates
 - All tickers are updated daily with optimized performance (~5-8 minutes for 3000 tickers)
 - If program starts and history doesn't exist, it creates missing histories for all tickers
 - Uses a daily marker key to prevent duplicate history updates on the same day
@@ -0,0 +1,68 @@
+from typing import Dict, Iterable, Optional
+
+# End-of-day closes live in one sorted set per ticker ('eod:AAPL'): the score is the date as
+# YYYYMMDD and the member is 'YYYY-MM-DD:price', so any date range is a single ZRANGEBYSCORE.
+EOD_PREFIX = "eod:"
+
+
+def eod_key(ticker: str) -> str:
+    """Generate the EOD series key in the following format 'eod:AAPL'"""
+    return f"{EOD_PREFIX}{ticker.upper()}"
+
+
+def date_score(date: str) -> int:
+    """'2024-01-15' -> 20240115"""
+    return int(date.replace("-", ""))
+
+
+def decode_member(member: str):
+    """'2024-01-15:185.92' -> ('2024-01-15', 185.92)"""
+    date, price = member.split(":", 1)
+    return date, float(price)
+
+
+def add_eod_prices(pipe, ticker: str, prices: Dict[str, float]):
+    """
+    Queue EOD prices for a ticker on a pipeline (or client). Any existing entry for the same
+    date is replaced, since members carry the price and a re-write would otherwise duplicate the date.
+
+    :param prices: {'YYYY-MM-DD': price}
+    """
+    if not prices:
+        return
+    key = eod_key(ticker)
+    members = {}
+    for date, price in prices.items():
+        score = date_score(date)
+        pipe.zremrangebyscore(key, score, score)
+        members[f"{date}:{float(price):.2f}"] = score
+    pipe.zadd(key, members)
+
+
+def get_eod_prices(r, ticker: str, start_date: Optional[str] = None, end_date: Optional[str] = None) -> Dict[str, float]:
+    """
+    Read every stored EOD price of a ticker within an inclusive date range with one ZRANGEBYSCORE.
+    A missing bound is left open.
+
+    :return: {'YYYY-MM-DD': price}, oldest first.
+    """
+    min_score = date_score(start_date) if start_date else "-inf"
+    max_score = date_score(end_date) if end_date else "+inf"
+    return dict(decode_member(member) for member in r.zrangebyscore(eod_key(ticker), min_score, max_score))
+
+
+def get_eod_price_for_date(r, ticker: str, date: str) -> Optional[float]:
+    """The stored EOD price for one date, or None."""
+    score = date_score(date)
+    members = r.zrangebyscore(eod_key(ticker), score, score)
+    return decode_member(members[0])[1] if members else None
+
+
+def has_eod_price(r, ticker: str, date: str) -> bool:
+    score = date_score(date)
+    return r.zcount(eod_key(ticker), score, score) > 0
+
+
+def select_dates(prices: Dict[str, float], dates: Iterable[str]) -> Dict[str, float]:
+    """Pick the requested dates out of a range read."""
+    return {date: prices[date] for date in dates if date in prices}
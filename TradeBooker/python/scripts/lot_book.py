@@ -0,0 +1,434 @@
+import json
+import struct
+import logging
+import datetime
+import threading
+from contextlib import ExitStack, contextmanager
+from itertools import islice
+from collections import deque, namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Compact record for one open lot. Partially consumed lots are replaced in place with _replace().
+Lot = namedtuple("Lot", ["price", "quantity", "date", "time"])
+
+# Each position's lots are a Redis list ('lots:alice/AAPL') of fixed-width packed records, oldest
+# first: price (float64), quantity (int32), trade date as days since 1970-01-01 and trade time as
+# seconds since midnight (int32, -1 when unknown). 20 bytes a lot, and a flush only pops, rewrites
+# or appends the lots that changed instead of re-serializing the whole position.
+LOT_RECORD = struct.Struct("<diii")
+MAX_LOT_QUANTITY = 2 ** 31 - 1
+EPOCH = datetime.date(1970, 1, 1)
+UNKNOWN = -1
+
+
+def pack_lot(lot: Lot) -> bytes:
+    day = (datetime.date.fromisoformat(lot.date) - EPOCH).days if lot.date else UNKNOWN
+    if lot.time:
+        hours, minutes, seconds = (int(part) for part in lot.time.split(":"))
+        time_of_day = hours * 3600 + minutes * 60 + seconds
+    else:
+        time_of_day = UNKNOWN
+    return LOT_RECORD.pack(float(lot.price), int(lot.quantity), day, time_of_day)
+
+
+def unpack_lot(record: bytes) -> Lot:
+    price, quantity, day, time_of_day = LOT_RECORD.unpack(record)
+    date = (EPOCH + datetime.timedelta(days=day)).isoformat() if day != UNKNOWN else None
+    time = f"{time_of_day // 3600:02d}:{time_of_day // 60 % 60:02d}:{time_of_day % 60:02d}" if time_of_day != UNKNOWN else None
+    return Lot(price, quantity, date, time)
+
+
+class LotBook:
+    """
+    In-memory FIFO lot book of the shards a PnL worker currently owns.
+
+    Each position ('alice/AAPL') maps to a deque of Lot records, oldest first. The book is the
+    source of truth while the worker runs: trades mutate it through append_lot / pop_head /
+    replace_head, which also track how the position differs from its 'lots:alice/AAPL' list.
+    A background flush (write-behind) sends just those differences for the dirty positions in
+    one batched MULTI/EXEC, together with any realized PnL accumulated since the last flush and
+    the stream acks of the trades that produced it.
+    """
+
+    def __init__(self, redis_client, lots_key_prefix="lots:", raw_redis_client=None):
+        self.redis = redis_client
+        # Lot records are binary, so they are read through a client that doesn't decode responses
+        self.raw_redis = raw_redis_client or redis_client
+        self.lots_key_prefix = lots_key_prefix
+
+        self.positions = {}         # 'alice/AAPL' -> deque[Lot]
+        self.aggregates = {}        # 'alice/AAPL' -> (open quantity, total cost basis) of the open lots
+        self.dirty = set()          # positions changed since the last flush
+        self.realized_pnl = {}      # 'alice/AAPL' -> realized PnL accumulated since the last flush
+        self.pending_acks = []      # (stream, group, msg_id) of trades applied since the last flush
+        # 'alice/AAPL' -> PositionSync: how the in-memory lots differ from the persisted list
+        self.sync = {}
+
+        # Guards every structure above; held for one trade at a time and while snapshotting a flush
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def position_key(account_id: str, ticker: str) -> str:
+        return f"{account_id}/{ticker}"
+
+    def lots_key(self, position_key: str) -> str:
+        """Generate a redis key in the following format 'lots:alice/AAPL'"""
+        return f"{self.lots_key_prefix}{position_key}"
+
+    @staticmethod
+    def decode_lots(records) -> deque:
+        """Packed records from an LRANGE -> deque of Lots"""
+        return deque(unpack_lot(record) for record in records or ())
+
+    @staticmethod
+    def encode_lots(lots) -> list:
+        return [pack_lot(lot) for lot in lots]
+
+    @staticmethod
+    def decode_json_lots(lots_json) -> deque:
+        """Lots in the old JSON blob encoding (only needed to migrate existing keys)"""
+        if not lots_json:
+            return deque()
+        return deque(Lot(lot["price"], lot["quantity"], lot.get("date"), lot.get("time")) for lot in json.loads(lots_json))
+
+    @staticmethod
+    def sum_lots(lots):
+        """Open quantity and total cost basis of a list of lots (only needed when a position is loaded)."""
+        quantity = 0
+        cost = 0.0
+        for lot in lots:
+            quantity += lot.quantity
+            cost += lot.price * lot.quantity
+        return quantity, cost
+
+    def _set_position(self, position_key: str, lots: deque):
+        self.positions[position_key] = lots
+        self.aggregates[position_key] = self.sum_lots(lots)
+        self.sync[position_key] = PositionSync(persisted=len(lots))
+
+    def get(self, account_id: str, ticker: str) -> deque:
+        """Returns the lots for a position, loading them from Redis the first time the position is touched."""
+        position_key = self.position_key(account_id, ticker)
+        lots = self.positions.get(position_key)
+        if lots is None:
+            lots = self.read_lots(position_key)
+            self._set_position(position_key, lots)
+        return lots
+
+    def read_lots(self, position_key: str) -> deque:
+        """The persisted lots of a position, read without touching the book (or its lock)."""
+        return self.decode_lots(self.raw_redis.lrange(self.lots_key(position_key), 0, -1))
+
+    def has_position(self, position_key: str) -> bool:
+        return position_key in self.positions
+
+    def install_position(self, position_key: str, lots: deque):
+        """Adds lots read with read_lots(), unless the position was loaded meanwhile. Call it holding the lock."""
+        if position_key not in self.positions:
+            self._set_position(position_key, lots)
+
+    def append_lot(self, account_id: str, ticker: str, lot: Lot):
+        """A buy: the new lot goes to the back of the FIFO. A lot that can't be packed raises here, before the book changes."""
+        if not 0 < lot.quantity <= MAX_LOT_QUANTITY:
+            raise ValueError(f"Lot quantity must be between 1 and {MAX_LOT_QUANTITY}, got {lot.quantity}")
+        pack_lot(lot)
+        self.get(account_id, ticker).append(lot)
+        self.mark_dirty(account_id, ticker)
+
+    def pop_head(self, account_id: str, ticker: str) -> Lot:
+        """A sell consumed the oldest lot entirely."""
+        position_key = self.position_key(account_id, ticker)
+        lot = self.get(account_id, ticker).popleft()
+        sync = self.sync[position_key]
+        if sync.persisted:
+            sync.persisted -= 1
+            sync.popped += 1
+            sync.head_changed = False
+        self.mark_dirty(account_id, ticker)
+        return lot
+
+    def replace_head(self, account_id: str, ticker: str, lot: Lot):
+        """A sell consumed part of the oldest lot."""
+        position_key = self.position_key(account_id, ticker)
+        self.get(account_id, ticker)[0] = lot
+        sync = self.sync[position_key]
+        if sync.persisted:
+            sync.head_changed = True
+        self.mark_dirty(account_id, ticker)
+
+    def get_aggregates(self, account_id: str, ticker: str):
+        """Returns (open quantity, total cost basis) for a position."""
+        self.get(account_id, ticker)
+        return self.aggregates[self.position_key(account_id, ticker)]
+
+    def adjust_aggregates(self, account_id: str, ticker: str, quantity_delta: int, cost_delta: float):
+        """Applies a buy (+) or a consumed lot slice (-) to the position's running quantity and cost basis."""
+        position_key = self.position_key(account_id, ticker)
+        quantity, cost = self.aggregates[position_key]
+        quantity += quantity_delta
+        # Reset the cost once the position is flat so float rounding can't accumulate across round trips
+        cost = cost + cost_delta if quantity else 0.0
+        self.aggregates[position_key] = (quantity, cost)
+
+    def load(self, owns_position=None, batch_size=1000) -> int:
+        """
+        Rebuilds the book from the 'lots:*' keys on startup.
+
+        :param owns_position: Optional predicate on 'alice/AAPL' keys, so a shard worker only loads its own positions.
+        :return: Number of positions loaded.
+        """
+        loaded = 0
+        for batch in read_positions(self.redis, self.raw_redis, self.lots_key_prefix, owns_position, batch_size):
+            with self.lock:
+                for position_key, lots in batch:
+                    self._set_position(position_key, lots)
+            loaded += len(batch)
+
+        logger.info(f"Rebuilt lot book with {loaded} positions from Redis")
+        return loaded
+
+    def mark_dirty(self, account_id: str, ticker: str):
+        self.dirty.add(self.position_key(account_id, ticker))
+
+    def add_realized_pnl(self, account_id: str, ticker: str, pnl: float):
+        position_key = self.position_key(account_id, ticker)
+        self.realized_pnl[position_key] = self.realized_pnl.get(position_key, 0.0) + pnl
+
+    def add_pending_ack(self, stream: str, group: str, msg_id: str):
+        self.pending_acks.append((stream, group, msg_id))
+
+    def pending_ack_ids(self) -> set:
+        """(stream, msg_id) of the trades applied but not yet acked by a flush."""
+        with self.lock:
+            return {(stream, msg_id) for stream, _, msg_id in self.pending_acks}
+
+    def take_snapshot(self):
+        """
+        Atomically takes everything that needs persisting and resets the write-behind state.
+        For each dirty position only its changes are taken (and packed) under the lock, so the
+        worker can keep mutating the book while they are written. A position whose changes can't
+        be packed is left out and reported instead of failing the whole snapshot; the caller must
+        drop its shard, since its in-memory lots can never be persisted.
+
+        :return: (LotChanges by dirty position, (open quantity, cost basis) by dirty position, realized PnL deltas by position,
+                  pending acks, exception by position that failed)
+        """
+        with self.lock:
+            changes = {}
+            failed = {}
+            for position_key in self.dirty:
+                lots = self.positions.get(position_key, deque())
+                sync = self.sync.setdefault(position_key, PositionSync(rewrite=True))
+                try:
+                    changes[position_key] = sync.take_changes(lots)
+                except Exception as e:
+                    failed[position_key] = e
+            aggregates = {position_key: self.aggregates.get(position_key, (0, 0.0)) for position_key in changes}
+            realized = self.realized_pnl
+            acks = self.pending_acks
+            self.dirty = set()
+            self.realized_pnl = {}
+            self.pending_acks = []
+        return changes, aggregates, realized, acks, failed
+
+    def queue_changes(self, pipe, position_key: str, changes: "LotChanges"):
+        """Queue a position's lot changes on the flush transaction."""
+        key = self.lots_key(position_key)
+        if changes.rewrite:
+            pipe.delete(key)
+        elif changes.popped:
+            pipe.ltrim(key, changes.popped, -1)
+        if changes.head is not None:
+            pipe.lset(key, 0, changes.head)
+        if changes.appended:
+            pipe.rpush(key, *changes.appended)
+
+    def restore_snapshot(self, changes, aggregates, realized, acks, keep_position=None, keep_stream=None):
+        """
+        Puts a snapshot whose flush failed back into the write-behind state, so the next flush retries it.
+        Its changes were never applied, so the positions are rewritten in full next time.
+        The optional predicates are checked under the lock: positions and acks they reject (e.g. of
+        shards dropped since the snapshot was taken) are discarded instead of restored.
+        """
+        with self.lock:
+            if keep_position:
+                changes = [position_key for position_key in changes if keep_position(position_key)]
+                realized = {position_key: pnl for position_key, pnl in realized.items() if keep_position(position_key)}
+            if keep_stream:
+                acks = [ack for ack in acks if keep_stream(ack[0])]
+            self.dirty.update(changes)
+            for position_key in changes:
+                if position_key in self.sync:
+                    self.sync[position_key].rewrite = True
+            for position_key, pnl in realized.items():
+                self.realized_pnl[position_key] = self.realized_pnl.get(position_key, 0.0) + pnl
+            self.pending_acks = acks + self.pending_acks
+
+    def drop(self, owns_position, streams):
+        """
+        Forgets every position matching the predicate, with its unflushed changes and the pending
+        acks from the given streams. Used when a shard leaves this worker: whatever wasn't flushed
+        stays unacknowledged, so the shard's next owner replays it on top of the persisted lots.
+        """
+        with self.lock:
+            for position_key in [key for key in self.positions if owns_position(key)]:
+                self.positions.pop(position_key, None)
+                self.aggregates.pop(position_key, None)
+                self.sync.pop(position_key, None)
+            self.dirty = {key for key in self.dirty if not owns_position(key)}
+            self.realized_pnl = {key: pnl for key, pnl in self.realized_pnl.items() if not owns_position(key)}
+            self.pending_acks = [ack for ack in self.pending_acks if ack[0] not in streams]
+
+
+def read_positions(redis_client, raw_redis_client, lots_key_prefix="lots:", owns_position=None, batch_size=1000):
+    """Yields batches of ('alice/AAPL', lots) for every 'lots:*' key matching the predicate, one pipelined LRANGE per batch."""
+    def read_batch(batch_keys):
+        pipe = raw_redis_client.pipeline(transaction=False)
+        for position_key in batch_keys:
+            pipe.lrange(f"{lots_key_prefix}{position_key}", 0, -1)
+        return [(position_key, LotBook.decode_lots(records)) for position_key, records in zip(batch_keys, pipe.execute())]
+
+    batch = []
+    for key in redis_client.scan_iter(match=f"{lots_key_prefix}*", count=batch_size):
+        position_key = key[len(lots_key_prefix):]
+        if owns_position and not owns_position(position_key):
+            continue
+        batch.append(position_key)
+        if len(batch) >= batch_size:
+            yield read_batch(batch)
+            batch = []
+    if batch:
+        yield read_batch(batch)
+
+
+class PartitionedLotBook:
+    """
+    A worker's lot book split into one LotBook per ordered partition, each behind its own lock, so
+    the partitions' applier threads never wait on each other. `partition_of` routes a position
+    ('alice/AAPL') to its partition; it must be the same routing the worker uses for its queues,
+    so a position is only ever mutated by its partition's thread. Snapshots gather every
+    partition's write-behind state for one flush.
+    """
+
+    def __init__(self, redis_client, partitions: int, partition_of, lots_key_prefix="lots:", raw_redis_client=None):
+        self.redis = redis_client
+        self.raw_redis = raw_redis_client or redis_client
+        self.lots_key_prefix = lots_key_prefix
+        self.partition_of = partition_of
+        self.books = [LotBook(redis_client, lots_key_prefix, raw_redis_client=raw_redis_client) for _ in range(partitions)]
+
+    def book(self, position_key: str) -> LotBook:
+        return self.books[self.partition_of(position_key)]
+
+    def _book(self, account_id: str, ticker: str) -> LotBook:
+        return self.book(LotBook.position_key(account_id, ticker))
+
+    @contextmanager
+    def locked(self):
+        """Holds every partition's lock (always taken in the same order), e.g. while shards change hands."""
+        with ExitStack() as stack:
+            for book in self.books:
+                stack.enter_context(book.lock)
+            yield
+
+    def get(self, account_id: str, ticker: str) -> deque:
+        return self._book(account_id, ticker).get(account_id, ticker)
+
+    def append_lot(self, account_id: str, ticker: str, lot: Lot):
+        self._book(account_id, ticker).append_lot(account_id, ticker, lot)
+
+    def pop_head(self, account_id: str, ticker: str) -> Lot:
+        return self._book(account_id, ticker).pop_head(account_id, ticker)
+
+    def replace_head(self, account_id: str, ticker: str, lot: Lot):
+        self._book(account_id, ticker).replace_head(account_id, ticker, lot)
+
+    def get_aggregates(self, account_id: str, ticker: str):
+        return self._book(account_id, ticker).get_aggregates(account_id, ticker)
+
+    def adjust_aggregates(self, account_id: str, ticker: str, quantity_delta: int, cost_delta: float):
+        self._book(account_id, ticker).adjust_aggregates(account_id, ticker, quantity_delta, cost_delta)
+
+    def add_realized_pnl(self, account_id: str, ticker: str, pnl: float):
+        self._book(account_id, ticker).add_realized_pnl(account_id, ticker, pnl)
+
+    def queue_changes(self, pipe, position_key: str, changes: "LotChanges"):
+        self.book(position_key).queue_changes(pipe, position_key, changes)
+
+    def load(self, owns_position=None, batch_size=1000) -> int:
+        """Rebuilds the partitions from the 'lots:*' keys with a single scan; see LotBook.load."""
+        loaded = 0
+        for batch in read_positions(self.redis, self.raw_redis, self.lots_key_prefix, owns_position, batch_size):
+            for position_key, lots in batch:
+                book = self.book(position_key)
+                with book.lock:
+                    book._set_position(position_key, lots)
+            loaded += len(batch)
+
+        logger.info(f"Rebuilt lot book with {loaded} positions from Redis")
+        return loaded
+
+    def take_snapshot(self):
+        """Every partition's LotBook.take_snapshot, merged. Each partition is taken atomically under its own lock."""
+        changes, aggregates, realized, acks, failed = {}, {}, {}, [], {}
+        for book in self.books:
+            book_changes, book_aggregates, book_realized, book_acks, book_failed = book.take_snapshot()
+            changes.update(book_changes)
+            aggregates.update(book_aggregates)
+            realized.update(book_realized)
+            acks.extend(book_acks)
+            failed.update(book_failed)
+        return changes, aggregates, realized, acks, failed
+
+    def restore_snapshot(self, changes, aggregates, realized, acks, keep_position=None, keep_stream=None):
+        """Hands each partition back its part of a snapshot whose flush failed; see LotBook.restore_snapshot."""
+        for index, book in enumerate(self.books):
+            book.restore_snapshot({key: value for key, value in changes.items() if self.partition_of(key) == index},
+                                  aggregates,
+                                  {key: pnl for key, pnl in realized.items() if self.partition_of(key) == index},
+                                  acks if index == 0 else [],
+                                  keep_position=keep_position, keep_stream=keep_stream)
+
+    def drop(self, owns_position, streams):
+        for book in self.books:
+            book.drop(owns_position, streams)
+
+    def pending_ack_ids(self) -> set:
+        ids = set()
+        for book in self.books:
+            ids |= book.pending_ack_ids()
+        return ids
+
+
+# What a flush writes for one position: drop `popped` lots from the head, overwrite the head with
+# `head`, append `appended`; or, with `rewrite`, replace the whole list with `appended`.
+LotChanges = namedtuple("LotChanges", ["rewrite", "popped", "head", "appended"])
+
+
+class PositionSync:
+    """
+    Tracks how a position's in-memory lots differ from its persisted list. The deque is always
+    the persisted list with `popped` lots taken off the head (the new head possibly changed)
+    and every lot after the first `persisted` ones appended since the last flush.
+    """
+
+    def __init__(self, persisted=0, rewrite=False):
+        self.persisted = persisted      # leading lots of the deque that are already in the list
+        self.popped = 0                 # persisted lots consumed from the head since the last flush
+        self.head_changed = False       # the first persisted lot was partially consumed
+        self.rewrite = rewrite          # the list's state is unknown, write it in full
+
+    def take_changes(self, lots) -> LotChanges:
+        if self.rewrite:
+            changes = LotChanges(True, 0, None, LotBook.encode_lots(lots))
+        else:
+            head = pack_lot(lots[0]) if self.head_changed and self.persisted else None
+            appended = LotBook.encode_lots(islice(lots, self.persisted, None)) if len(lots) > self.persisted else []
+            changes = LotChanges(False, self.popped, head, appended)
+
+        self.persisted = len(lots)
+        self.popped = 0
+        self.head_changed = False
+        self.rewrite = False
+        return changes
@@ -0,0 +1,193 @@
+import logging
+import redis
+try:
+    from .lot_book import Lot, pack_lot
+    from .price_events import HELD_TICKERS_SET, positions_by_ticker_key
+except ImportError:
+    from lot_book import Lot, pack_lot
+    from price_events import HELD_TICKERS_SET, positions_by_ticker_key
+
+logger = logging.getLogger(__name__)
+
+
+class PositionOwnedError(Exception):
+    """The position's shard is leased by a worker, which is the only process allowed to apply its trades."""
+
+# Redis Function library that applies one trade to a position's FIFO lots server-side: the lots,
+# realized PnL, running aggregates, ticker index and unrealized PnL all change in one atomic call
+# and one round trip. Workers running with PNL_APPLY_MODE=server apply every booked trade this way
+# and have the function ack the stream entry in the same call, so a trade is applied exactly once.
+# Writes are fenced by the position's shard lease: a worker passes its lease token and the call
+# fails unless the lease is still its own; a caller without a token can only apply trades to
+# positions no worker owns, since a book-mode worker's write-behind flush would overwrite them.
+# Lots use the lot book's packed list records, so both paths read and write the same 'lots:alice/AAPL' lists.
+LIBRARY_NAME = "fifo_lots"
+# Versioned, so a server still holding a library with older KEYS/ARGV reports the function missing and reloads it
+APPLY_TRADE_FUNCTION = "fifo_apply_trade_v2"
+
+APPLY_TRADE_BODY = """
+local RECORD = '<diii'   -- price, quantity, trade day, trade time (see lot_book.LOT_RECORD)
+local CHUNK = 100
+
+-- KEYS: lots, realized PnL hash, open quantity hash, cost basis hash, unrealized PnL hash,
+--       ticker's positions index, ticker's live price, held tickers set,
+--       owning shard's lease (optional), stream to ack the trade's entry on (optional)
+-- ARGV: position key, 'buy' | 'sell', price, quantity, packed lot record (buys), ticker,
+--       caller's lease token ('' for none), consumer group, entry ID
+-- Returns {realized PnL of this trade, open quantity, cost basis, unrealized PnL} (numbers as strings)
+local function apply_trade(keys, args)
+    if keys[9] then
+        local holder = redis.call('GET', keys[9])
+        local token = args[7] or ''
+        if (token == '' and holder) or (token ~= '' and holder ~= token) then
+            return redis.error_reply('SHARDOWNED position is owned by another shard worker')
+        end
+    end
+
+    local position_key = args[1]
+    local trade_type = args[2]
+    local price = tonumber(args[3])
+    local quantity = tonumber(args[4])
+    if not price or not quantity or quantity <= 0 or quantity > 2147483647 then
+        return redis.error_reply('invalid price or quantity')
+    end
+
+    -- Running aggregates; positions that predate them are summed from their lots once
+    local open_quantity = tonumber(redis.call('HGET', keys[3], position_key))
+    local cost_basis = tonumber(redis.call('HGET', keys[4], position_key))
+    if not open_quantity or not cost_basis then
+        open_quantity, cost_basis = 0, 0
+        for _, record in ipairs(redis.call('LRANGE', keys[1], 0, -1)) do
+            local lot_price, lot_quantity = struct.unpack(RECORD, record)
+            open_quantity = open_quantity + lot_quantity
+            cost_basis = cost_basis + lot_price * lot_quantity
+        end
+    end
+
+    local realized = 0
+    if trade_type == 'buy' then
+        redis.call('RPUSH', keys[1], args[5])
+        open_quantity = open_quantity + quantity
+        cost_basis = cost_basis + price * quantity
+    elseif trade_type == 'sell' then
+        -- Walk the oldest lots a chunk at a time: whole lots are trimmed off the head,
+        -- a partially consumed one is rewritten in place
+        local remaining = quantity
+        local consumed = 0
+        local head = nil
+        while remaining > 0 do
+            local records = redis.call('LRANGE', keys[1], consumed, consumed + CHUNK - 1)
+            if #records == 0 then break end
+            for _, record in ipairs(records) do
+                local lot_price, lot_quantity, day, time_of_day = struct.unpack(RECORD, record)
+                local take = math.min(lot_quantity, remaining)
+                realized = realized + (price - lot_price) * take
+                open_quantity = open_quantity - take
+                cost_basis = cost_basis - lot_price * take
+                remaining = remaining - take
+                if take == lot_quantity then
+                    consumed = consumed + 1
+                else
+                    head = struct.pack(RECORD, lot_price, lot_quantity - take, day, time_of_day)
+                end
+                if remaining <= 0 then break end
+            end
+        end
+        if consumed > 0 then
+            redis.call('LTRIM', keys[1], consumed, -1)
+        end
+        if head then
+            redis.call('LSET', keys[1], 0, head)
+        end
+    else
+        return redis.error_reply('unknown trade type ' .. tostring(trade_type))
+    end
+    if open_quantity <= 0 then
+        cost_basis = 0
+    end
+
+    if realized ~= 0 then
+        redis.call('HINCRBYFLOAT', keys[2], position_key, realized)
+    end
+    redis.call('HSET', keys[3], position_key, open_quantity)
+    redis.call('HSET', keys[4], position_key, cost_basis)
+    if open_quantity > 0 then
+        redis.call('SADD', keys[6], position_key)
+        redis.call('SADD', keys[8], args[6])
+    elseif redis.call('SREM', keys[6], position_key) == 1 and redis.call('SCARD', keys[6]) == 0 then
+        redis.call('SREM', keys[8], args[6])
+    end
+
+    local unrealized = 0
+    local live_price = tonumber(redis.call('GET', keys[7]))
+    if open_quantity > 0 and live_price then
+        unrealized = open_quantity * live_price - cost_basis
+    end
+    redis.call('HSET', keys[5], position_key, unrealized)
+
+    if keys[10] then
+        redis.call('XACK', keys[10], args[8], args[9])
+    end
+
+    -- Lua numbers would be truncated to integers in the reply, so send them as strings
+    return {tostring(realized), tostring(open_quantity), tostring(cost_basis), tostring(unrealized)}
+end
+"""
+
+LIBRARY_CODE = f"""#!lua name={LIBRARY_NAME}
+{APPLY_TRADE_BODY}
+redis.register_function('{APPLY_TRADE_FUNCTION}', apply_trade)
+"""
+
+
+def load_library(r):
+    """Install (or replace) the library on the server. Functions are persisted and replicated with the data."""
+    r.function_load(LIBRARY_CODE, replace=True)
+    logger.info(f"Loaded Redis function library '{LIBRARY_NAME}'")
+
+
+def apply_trade(r, position_key: str, trade_type: str, price: float, quantity: int, trade_date: str, trade_time: str,
+                lots_key_prefix="lots:", realized_hash="realized_pnl_by_position",
+                open_quantity_hash="open_quantity_by_position", cost_basis_hash="cost_basis_by_position",
+                unrealized_hash="unrealized_pnl_by_position", owner_lease_key=None, lease_token=None, ack=None):
+    """
+    Apply a trade to a position atomically on the server, loading the library first if it isn't there yet.
+    With owner_lease_key, nothing is written and PositionOwnedError is raised unless the lease carries
+    lease_token, or, without a token, unless nobody holds it. With ack=(stream, group, entry ID) the
+    trade's stream entry is acknowledged in the same call.
+
+    :return: (realized PnL of the trade, open quantity, cost basis, unrealized PnL)
+    """
+    ticker = position_key.split("/", 1)[1]
+    keys = [
+        f"{lots_key_prefix}{position_key}",
+        realized_hash,
+        open_quantity_hash,
+        cost_basis_hash,
+        unrealized_hash,
+        positions_by_ticker_key(ticker),
+        f"{ticker.upper()}:Live",
+        HELD_TICKERS_SET,
+    ]
+    args = [position_key, trade_type.lower(), price, quantity, pack_lot(Lot(price, quantity, trade_date, trade_time)),
+            ticker.upper(), lease_token or ""]
+    if owner_lease_key:
+        keys.append(owner_lease_key)
+    if ack:
+        if not owner_lease_key:
+            raise ValueError("Acking a trade's entry requires its shard lease")
+        stream, group, msg_id = ack
+        keys.append(stream)
+        args.extend([group, msg_id])
+    try:
+        result = r.fcall(APPLY_TRADE_FUNCTION, len(keys), *keys, *args)
+    except redis.ResponseError as e:
+        if str(e).startswith("SHARDOWNED"):
+            raise PositionOwnedError(f"{position_key} is owned by another shard worker") from e
+        if "Function not found" not in str(e):
+            raise
+        load_library(r)
+        result = r.fcall(APPLY_TRADE_FUNCTION, len(keys), *keys, *args)
+
+    realized, open_quantity, cost_basis, unrealized = result
+    return float(realized), int(float(open_quantity)), float(cost_basis), float(unrealized)
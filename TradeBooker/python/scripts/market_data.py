@@ -1,21 +1,58 @@
 import redis
-from redis.sentinel import Sentinel
 import yfinance as yf
+import pandas as pd
 from datetime import datetime, timedelta
 import re
+import time
+import threading
+from typing import Dict, Iterable, Optional
+try:
+    from .redis_connection import get_redis_client
+    from .price_events import publish_live_prices
+    from .eod_store import add_eod_prices, get_eod_prices, get_eod_price_for_date, select_dates
+    from . import price_store
+    from .yf_downloads import download
+    from .trading_calendar import can_have_eod_price, closest_on_or_before, is_trading_day, previous_trading_day
+except ImportError:
+    from redis_connection import get_redis_client
+    from price_events import publish_live_prices
+    from eod_store import add_eod_prices, get_eod_prices, get_eod_price_for_date, select_dates
+    import price_store
+    from yf_downloads import download
+    from trading_calendar import can_have_eod_price, closest_on_or_before, is_trading_day, previous_trading_day
 
 # Standard periods that get updated daily by the main updater script
 STANDARD_PERIODS = ['1d', '5d', '1mo', '3mo', '1y', '5y', 'ytd']
 
+# Single-flight for live price misses: ticker -> Event set once the in-progress upstream fetch finishes
+_inflight_fetches = {}
+_inflight_lock = threading.Lock()
+INFLIGHT_WAIT_SECONDS = 30
+
+# Negative cache for EOD dates yfinance had no bar for: (TICKER, 'YYYY-MM-DD') -> expiry timestamp.
+# Every entry gets the same TTL, so insertion order is expiry order: expired entries are pruned
+# from the front on each insert, and the oldest go first once it holds EOD_NEGATIVE_MAX_ENTRIES.
+_eod_negative_cache = {}
+_eod_negative_lock = threading.Lock()
+EOD_NEGATIVE_TTL = 3600
+EOD_NEGATIVE_MAX_ENTRIES = 100000
+
+
+def _remember_missing_eod(ticker: str, date_str: str):
+    now = time.time()
+    with _eod_negative_lock:
+        key = (ticker.upper(), date_str)
+        _eod_negative_cache.pop(key, None)  # Re-inserted at the back so the order stays by expiry
+        _eod_negative_cache[key] = now + EOD_NEGATIVE_TTL
+        while _eod_negative_cache:
+            oldest = next(iter(_eod_negative_cache))
+            if _eod_negative_cache[oldest] > now and len(_eod_negative_cache) <= EOD_NEGATIVE_MAX_ENTRIES:
+                break
+            del _eod_negative_cache[oldest]
+
 def get_redis_connection():
-    sentinels = [
-        ("sentinel1", 26379),
-        ("sentinel2", 26379),
-        ("sentinel3", 26379)
-    ]
-    service_name = "mymaster"  # matches your sentinel config
-    sentinel = Sentinel(sentinels, socket_timeout=1, decode_responses=True)
-    return sentinel.master_for(service_name, socket_timeout=1, decode_responses=True)
+    # Shared pooled client: no Sentinel discovery or new TCP connection per price lookup
+    return get_redis_client(socket_timeout=1)
 
 
 def parse_period_to_days(period: str) -> int:
@@ -50,6 +87,18 @@ def parse_period_to_days(period: str) -> int:
         raise ValueError(f"Unsupported time unit: {unit}")
 
 
+def get_stored_historical_price(ticker: str, period: str):
+    """
+    Answer a lookback from the local price store, or None if the ticker isn't stored
+    or its history is stale (lookbacks count back from the last stored day).
+    """
+    if not price_store.is_fresh(ticker):
+        return None
+    if period == 'ytd':
+        return price_store.get_first_close_of_year(ticker, datetime.now().year)
+    return price_store.get_lookback_close(ticker, parse_period_to_days(period))
+
+
 def get_historical_price(ticker: str, period: str) -> float:
     """
     Get the price of a ticker from a specific time period ago.
@@ -58,7 +107,10 @@ def get_historical_price(ticker: str, period: str) -> float:
     - Checks Redis first, then yfinance if not found, then caches in Redis
     
     For non-standard periods (3d, 4mo, 2y, etc.):
-    - Fetches directly from yfinance without Redis caching
+    - Skips Redis
+    
+    Misses are answered from the local price store when it is current, and only
+    then from yfinance (whose history is written back to the store).
     
     :param ticker: Stock ticker symbol (e.g., 'AAPL', 'GOOGL')
     :param period: Time period (e.g., '1d', '5d', '3mo', '1y', 'ytd', '3d', '4mo')
@@ -80,9 +132,15 @@ def get_historical_price(ticker: str, period: str) -> float:
             print(f"Fetched {ticker} {period} price from Redis")
             return float(cached_price)
         
-        print(f"Redis miss for {ticker}:{period}, fetching from yfinance...")
+        print(f"Redis miss for {ticker}:{period}, checking the local price store...")
     else:
-        print(f"Non-standard period {period}, fetching directly from yfinance...")
+        print(f"Non-standard period {period}, checking the local price store...")
+    
+    price = get_stored_historical_price(ticker, period)
+    if price is not None:
+        if is_standard_period:
+            get_redis_connection().set(f"{ticker}:{period}", str(price))
+        return price
     
     # Fetch from yfinance
     try:
@@ -109,6 +167,9 @@ def get_historical_price(ticker: str, period: str) -> float:
             if hist.empty:
                 raise ValueError(f"No historical data available for ticker '{ticker}'")
             
+            # Keep the history locally so the next lookback doesn't need the network
+            price_store.write_closes(ticker, hist['Close'])
+            
             # Get price from X trading days ago
             if len(hist) > days_back:
                 price = round(float(hist['Close'].iloc[-(days_back + 1)]), 2)
@@ -213,6 +274,141 @@ def get_price(ticker: str, shares: int) -> float:
     return round(price * shares, 2)
 
 
+def _download_live_prices(tickers) -> Dict[str, float]:
+    """
+    Fetch the latest price for several tickers with one yf.download call, made through the
+    process-wide download lock and rate limiter. Tickers yfinance has no data for are left out of the result.
+    """
+    data = download(tickers, period="1d")
+    if data.empty:
+        return {}
+
+    close_prices = data['Close']
+    if isinstance(close_prices, pd.Series):
+        # Single ticker - data['Close'] is a Series
+        close_prices = close_prices.to_frame(name=tickers[0])
+
+    latest = close_prices.ffill().iloc[-1]
+    return {ticker: round(float(latest[ticker]), 2) for ticker in tickers if ticker in latest.index and pd.notna(latest[ticker])}
+
+
+def get_cached_prices(tickers: Iterable[str]) -> Dict[str, Optional[float]]:
+    """
+    The cached 'TICKER:Live' prices of several tickers with one MGET, never going upstream.
+    For callers that can't wait on a download, e.g. while holding a lock.
+
+    :return: {TICKER: price}, with None for tickers that have no cached price.
+    """
+    tickers = list(dict.fromkeys(ticker.upper() for ticker in tickers))
+    if not tickers:
+        return {}
+    r = get_redis_connection()
+    return {ticker: (float(price) if price is not None else None)
+            for ticker, price in zip(tickers, r.mget([f"{ticker}:Live" for ticker in tickers]))}
+
+
+def get_prices(tickers: Iterable[str]) -> Dict[str, Optional[float]]:
+    """
+    Batch version of get_price for one share of each ticker.
+
+    All cached 'TICKER:Live' keys are read with one MGET. The misses are fetched together with a
+    single yf.download and cached. Concurrent callers missing the same ticker are coalesced: only
+    one of them fetches it upstream while the others wait and read the cached result.
+
+    :param tickers: Stock ticker symbols (duplicates are fine).
+    :return: {TICKER: price}, with None for tickers that have no price.
+    """
+    prices = get_cached_prices(tickers)
+    if not prices:
+        return {}
+
+    r = get_redis_connection()
+    misses = [ticker for ticker, price in prices.items() if price is None]
+    if not misses:
+        return prices
+
+    # Claim the misses nobody else is fetching; wait on the rest
+    to_fetch, to_wait = [], []
+    with _inflight_lock:
+        for ticker in misses:
+            event = _inflight_fetches.get(ticker)
+            if event is None:
+                _inflight_fetches[ticker] = threading.Event()
+                to_fetch.append(ticker)
+            else:
+                to_wait.append((ticker, event))
+
+    if to_fetch:
+        try:
+            fetched = _download_live_prices(to_fetch)
+            publish_live_prices(r, fetched)
+            prices.update(fetched)
+            print(f"Fetched {len(fetched)} of {len(to_fetch)} missing prices from yfinance")
+        except Exception as e:
+            print(f"Failed to fetch prices for {to_fetch}: {e}")
+        finally:
+            with _inflight_lock:
+                for ticker in to_fetch:
+                    _inflight_fetches.pop(ticker).set()
+
+    if to_wait:
+        for ticker, event in to_wait:
+            event.wait(INFLIGHT_WAIT_SECONDS)
+        waited = [ticker for ticker, _ in to_wait]
+        for ticker, price in zip(waited, r.mget([f"{ticker}:Live" for ticker in waited])):
+            prices[ticker] = float(price) if price is not None else None
+
+    return prices
+
+
+def _dates_to_fetch(ticker: str, prices: dict, missing_dates: list):
+    """
+    Narrow the EOD dates missing from Redis down to the ones worth a network fetch. Dates after the
+    last close cannot have a price yet and dates yfinance recently had nothing for are skipped;
+    non-trading days take the previous trading day's close when it is already known.
+
+    :param prices: {'YYYY-MM-DD': price} already resolved; filled in place.
+    :return: (dates still to fetch, {date: price} filled from known closes, to be cached)
+    """
+    ticker = ticker.upper()
+    now = time.time()
+    to_fetch = []
+    filled = {}
+    for date_str in sorted(missing_dates):
+        target_date = datetime.strptime(date_str, "%Y-%m-%d").date()
+        if not can_have_eod_price(target_date):
+            continue
+        if _eod_negative_cache.get((ticker, date_str), 0) > now:
+            continue
+        if not is_trading_day(target_date):
+            previous_day = previous_trading_day(target_date)
+            previous_price = prices.get(previous_day.isoformat()) if previous_day else None
+            if previous_price is not None:
+                prices[date_str] = previous_price
+                filled[date_str] = previous_price
+                continue
+        to_fetch.append(date_str)
+    return to_fetch, filled
+
+
+def _resolve_from_history(ticker: str, historical_data, dates: list) -> dict:
+    """
+    Resolve each date to the close of the closest trading day on or before it (bisect over the
+    downloaded index). Dates the download has nothing for go into the negative cache.
+    """
+    available_dates = list(historical_data.index)
+    closes = historical_data['Close']
+    resolved = {}
+    for date_str in dates:
+        target_date = datetime.strptime(date_str, "%Y-%m-%d").date()
+        closest_date = closest_on_or_before(available_dates, target_date)
+        if closest_date is None:
+            _remember_missing_eod(ticker, date_str)
+            continue
+        resolved[date_str] = round(float(closes.loc[closest_date]), 2)
+    return resolved
+
+
 def get_eod_price(ticker: str, date: str, shares: int) -> float:
     """
     Fetch the end-of-day price of the given ticker for a specific date from Redis. 
@@ -228,8 +424,7 @@ def get_eod_price(ticker: str, date: str, shares: int) -> float:
     r = get_redis_connection()
 
     # Check Redis for EOD price
-    eod_key = f"{ticker.upper()}:{date}"
-    price = r.get(eod_key)
+    price = get_eod_price_for_date(r, ticker, date)
 
     if price is None:
         # Fetch EOD price from yfinance as a fallback
@@ -255,25 +450,18 @@ def get_eod_price(ticker: str, date: str, shares: int) -> float:
             historical_data.index = historical_data.index.date  # Convert to date only
             target_date_obj = target_date.date()
             
-            if target_date_obj not in historical_data.index:
-                # Try to find the closest trading day before the target date
-                available_dates = historical_data.index
-                earlier_dates = [d for d in available_dates if d <= target_date_obj]
-                
-                if not earlier_dates:
-                    raise ValueError(f"No trading data available for or before '{date}' for ticker '{ticker}'.")
-                
-                # Use the most recent trading day
-                closest_date = max(earlier_dates)
-                price = historical_data.loc[closest_date, 'Close']
-            else:
-                price = historical_data.loc[target_date_obj, 'Close']
+            # Use the closest trading day on or before the target date
+            closest_date = closest_on_or_before(list(historical_data.index), target_date_obj)
+            if closest_date is None:
+                raise ValueError(f"No trading data available for or before '{date}' for ticker '{ticker}'.")
+            price = historical_data.loc[closest_date, 'Close']
 
             # Validate and round the price
             if price is not None:
                 price = round(float(price), 2)
-                # Cache the price in Redis
-                r.set(eod_key, price)
+                # Cache the price in Redis, unless the date's close hasn't happened yet
+                if can_have_eod_price(target_date_obj):
+                    add_eod_prices(r, ticker, {date: price})
             else:
                 raise ValueError(f"EOD price data is unavailable for ticker '{ticker}' on '{date}'.")
                 
@@ -316,19 +504,23 @@ def get_eod_price_from_list(ticker: str, dates: list) -> dict:
     # Connect to Redis
     r = get_redis_connection()
 
-    daily_price = {}
     dates.sort()
     
-    # Check which dates are already in Redis
-    missing_dates = []
-    for day in dates:
-        eod_key = f"{ticker.upper()}:{day}"
-        cached_price = r.get(eod_key)
-        
-        if cached_price is not None:
-            daily_price[day] = float(cached_price)
-        else:
-            missing_dates.append(day)
+    # Read the whole span of requested dates with one range read, then check which are missing
+    daily_price = select_dates(get_eod_prices(r, ticker, dates[0], dates[-1]), dates)
+    missing_dates = [day for day in dates if day not in daily_price]
+    
+    # Answer what we can from the local price store before going to the network
+    if missing_dates:
+        daily_price.update(price_store.get_closes_for_dates(ticker, missing_dates))
+        missing_dates = [day for day in missing_dates if day not in daily_price]
+    
+    # Only fetch dates that can have a close and aren't covered by a known earlier trading day
+    missing_dates, filled_prices = _dates_to_fetch(ticker, daily_price, missing_dates)
+    if filled_prices and not missing_dates:
+        pipe = r.pipeline(transaction=False)
+        add_eod_prices(pipe, ticker, filled_prices)
+        pipe.execute()
     
     # If we have missing dates, fetch them all in one API call
     if missing_dates:
@@ -357,37 +549,15 @@ def get_eod_price_from_list(ticker: str, dates: list) -> dict:
             historical_data.index = historical_data.index.date
             
             # Process all missing dates from the single API response
-            cached_count = 0
-            for date_str in missing_dates:
-                try:
-                    target_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-                    
-                    if target_date in historical_data.index:
-                        price = round(float(historical_data.loc[target_date, 'Close']), 2)
-                        daily_price[date_str] = price
-                        # Cache in Redis
-                        eod_key = f"{ticker.upper()}:{date_str}"
-                        r.set(eod_key, price)
-                        cached_count += 1
-                    else:
-                        # Find closest earlier trading day
-                        available_dates = historical_data.index
-                        earlier_dates = [d for d in available_dates if d <= target_date]
-                        
-                        if earlier_dates:
-                            closest_date = max(earlier_dates)
-                            price = round(float(historical_data.loc[closest_date, 'Close']), 2)
-                            daily_price[date_str] = price
-                            # Cache in Redis
-                            eod_key = f"{ticker.upper()}:{date_str}"
-                            r.set(eod_key, price)
-                            cached_count += 1
-                
-                except ValueError:
-                    # Skip dates that can't be processed
-                    continue
+            new_prices = _resolve_from_history(ticker, historical_data, missing_dates)
+            daily_price.update(new_prices)
+            new_prices.update(filled_prices)
             
-            print(f"Successfully cached {cached_count} new prices in Redis")
+            # Cache in Redis in one round trip
+            pipe = r.pipeline(transaction=False)
+            add_eod_prices(pipe, ticker, new_prices)
+            pipe.execute()
+            print(f"Successfully cached {len(new_prices)} new prices in Redis")
                         
         except Exception as e:
             error_msg = str(e).lower()
@@ -456,23 +626,29 @@ def get_eod_price_range(ticker: str, start_date: str, end_date: str) -> dict:
     start_dt = datetime.strptime(start_date, "%Y-%m-%d")
     end_dt = datetime.strptime(end_date, "%Y-%m-%d")
     
-    # Check which dates are already in Redis
-    daily_prices = {}
+    # Read the whole range with one command, then check which dates are missing
+    daily_prices = get_eod_prices(r, ticker, start_date, end_date)
     missing_dates = []
     
     current_date = start_dt
     while current_date <= end_dt:
         date_str = current_date.strftime("%Y-%m-%d")
-        eod_key = f"{ticker.upper()}:{date_str}"
-        cached_price = r.get(eod_key)
-        
-        if cached_price is not None:
-            daily_prices[date_str] = float(cached_price)
-        else:
+        if date_str not in daily_prices:
             missing_dates.append(date_str)
-        
         current_date += timedelta(days=1)
     
+    # Answer what we can from the local price store before going to the network
+    if missing_dates:
+        daily_prices.update(price_store.get_closes_for_dates(ticker, missing_dates))
+        missing_dates = [date_str for date_str in missing_dates if date_str not in daily_prices]
+    
+    # Only fetch dates that can have a close and aren't covered by a known earlier trading day
+    missing_dates, filled_prices = _dates_to_fetch(ticker, daily_prices, missing_dates)
+    if filled_prices and not missing_dates:
+        pipe = r.pipeline(transaction=False)
+        add_eod_prices(pipe, ticker, filled_prices)
+        pipe.execute()
+    
     # If we have missing dates, fetch ALL of them in ONE API call
     if missing_dates:
         try:
@@ -495,29 +671,15 @@ def get_eod_price_range(ticker: str, start_date: str, end_date: str) -> dict:
             historical_data.index = historical_data.index.date
             
             # Fill in ALL missing dates from the single API response
-            for date_str in missing_dates:
-                target_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-                
-                if target_date in historical_data.index:
-                    price = round(float(historical_data.loc[target_date, 'Close']), 2)
-                    daily_prices[date_str] = price
-                    # Cache in Redis for future use
-                    eod_key = f"{ticker.upper()}:{date_str}"
-                    r.set(eod_key, price)
-                else:
-                    # Find closest earlier trading day
-                    available_dates = historical_data.index
-                    earlier_dates = [d for d in available_dates if d <= target_date]
-                    
-                    if earlier_dates:
-                        closest_date = max(earlier_dates)
-                        price = round(float(historical_data.loc[closest_date, 'Close']), 2)
-                        daily_prices[date_str] = price
-                        # Cache in Redis
-                        eod_key = f"{ticker.upper()}:{date_str}"
-                        r.set(eod_key, price)
+            new_prices = _resolve_from_history(ticker, historical_data, missing_dates)
+            daily_prices.update(new_prices)
+            new_prices.update(filled_prices)
             
-            print(f"Successfully cached {len(missing_dates)} new prices in Redis")
+            # Cache in Redis for future use, in one round trip
+            pipe = r.pipeline(transaction=False)
+            add_eod_prices(pipe, ticker, new_prices)
+            pipe.execute()
+            print(f"Successfully cached {len(new_prices)} new prices in Redis")
                         
         except Exception as e:
             error_msg = str(e).lower()
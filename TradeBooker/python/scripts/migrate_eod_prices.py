@@ -0,0 +1,59 @@
+# One-off migration of per-day EOD keys ('AAPL:2024-01-15') into per-ticker series ('eod:AAPL').
+# Usage: python3 scripts/migrate_eod_prices.py [--keep]   (--keep leaves the old keys in place)
+import re
+import sys
+from collections import defaultdict
+from redis_connection import get_redis_client
+from eod_store import add_eod_prices
+
+EOD_KEY_PATTERN = "*:[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]"
+EOD_KEY_REGEX = re.compile(r"^([A-Z0-9.\-^]+):(\d{4}-\d{2}-\d{2})$")
+BATCH_SIZE = 1000
+
+
+def migrate_batch(r, keys, keep_old_keys):
+    read_pipe = r.pipeline(transaction=False)
+    for key in keys:
+        read_pipe.get(key)
+
+    by_ticker = defaultdict(dict)
+    migrated_keys = []
+    for key, price in zip(keys, read_pipe.execute()):
+        match = EOD_KEY_REGEX.match(key)
+        if price is None or not match:
+            continue
+        try:
+            by_ticker[match.group(1)][match.group(2)] = float(price)
+        except ValueError:
+            continue
+        migrated_keys.append(key)
+
+    write_pipe = r.pipeline(transaction=False)
+    for ticker, prices in by_ticker.items():
+        add_eod_prices(write_pipe, ticker, prices)
+    if not keep_old_keys and migrated_keys:
+        write_pipe.unlink(*migrated_keys)
+    write_pipe.execute()
+    return len(migrated_keys)
+
+
+def main():
+    keep_old_keys = "--keep" in sys.argv
+    r = get_redis_client()
+
+    migrated = 0
+    batch = []
+    for key in r.scan_iter(match=EOD_KEY_PATTERN, count=BATCH_SIZE):
+        batch.append(key)
+        if len(batch) >= BATCH_SIZE:
+            migrated += migrate_batch(r, batch, keep_old_keys)
+            batch = []
+            print(f"\rMigrated {migrated} EOD prices...", end='', flush=True)
+
+    if batch:
+        migrated += migrate_batch(r, batch, keep_old_keys)
+
+    print(f"\nMigrated {migrated} EOD prices into per-ticker series.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# One-off migration of 'lots:alice/AAPL' JSON blobs into lists of packed lot records (see lot_book.LOT_RECORD).
+# Run it with the PnL workers stopped. Usage: python3 scripts/migrate_lots_encoding.py
+from redis_connection import get_redis_client
+from lot_book import LotBook
+
+LOTS_KEY_PATTERN = "lots:*"
+BATCH_SIZE = 1000
+
+
+def migrate_batch(r, raw, keys):
+    type_pipe = r.pipeline(transaction=False)
+    for key in keys:
+        type_pipe.type(key)
+    string_keys = [key for key, key_type in zip(keys, type_pipe.execute()) if key_type == "string"]
+    if not string_keys:
+        return 0
+
+    read_pipe = r.pipeline(transaction=False)
+    for key in string_keys:
+        read_pipe.get(key)
+
+    # Each key is replaced by its list in the same MULTI/EXEC, so a reader never sees it missing
+    write_pipe = raw.pipeline(transaction=True)
+    for key, lots_json in zip(string_keys, read_pipe.execute()):
+        records = LotBook.encode_lots(LotBook.decode_json_lots(lots_json))
+        write_pipe.delete(key)
+        if records:
+            write_pipe.rpush(key, *records)
+    write_pipe.execute()
+    return len(string_keys)
+
+
+def main():
+    r = get_redis_client()
+    raw = get_redis_client(decode_responses=False)
+
+    migrated = 0
+    batch = []
+    for key in r.scan_iter(match=LOTS_KEY_PATTERN, count=BATCH_SIZE):
+        batch.append(key)
+        if len(batch) >= BATCH_SIZE:
+            migrated += migrate_batch(r, raw, batch)
+            batch = []
+            print(f"\rMigrated {migrated} positions...", end='', flush=True)
+
+    if batch:
+        migrated += migrate_batch(r, raw, batch)
+
+    print(f"\nMigrated {migrated} positions to packed lot lists.")
+
+if __name__ == "__main__":
+    main()
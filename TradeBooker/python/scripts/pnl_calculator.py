@@ -1,9 +1,18 @@
 # import redis
-from redis.sentinel import Sentinel
+import os
+import socket
 import logging
+import itertools
+from collections import Counter
+from redis.exceptions import WatchError
 from Trade import Trade
-import json
 import market_data
+import lot_functions
+from lot_book import Lot, LotBook, PartitionedLotBook
+from price_events import index_position
+from redis_connection import get_redis_client
+from shard_leases import RENEW_INTERVAL, ShardLeases, lease_key
+from trade_events import PNL_DEAD_LETTER_STREAM, PNL_GROUP, SHARDS, booked_trades_stream, ensure_consumer_group, shard_for_position, shard_of_stream
 from datetime import datetime
 import sys
 import time
@@ -13,8 +22,35 @@ from queue import Queue  # Import a thread-safe queue
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-BRPOP_TIMEOUT = 1
+READ_BLOCK_MS = 1000
 MAX_BATCH_SIZE = 1000
+FLUSH_INTERVAL = 1  # Seconds between write-behind flushes of the lot book
+CLAIM_BATCH_SIZE = 1000
+# Reaper: an entry this worker read but still hasn't acked after REAP_IDLE_MS, and that is neither
+# waiting in a partition queue nor applied and waiting for the next flush, was lost in flight
+# (its apply failed or never happened)
+REAP_INTERVAL = 30  # seconds
+REAP_IDLE_MS = 60000
+MAX_APPLY_FAILURES = 3  # Entries that keep failing go to the dead-letter stream instead of wedging their shard
+# Ordered partitions per worker: each position always goes to the same partition, whose single
+# applier thread keeps its trades in stream order, while unrelated positions are applied in parallel
+PARTITIONS = int(os.environ.get("PNL_PARTITIONS", 4))
+# Entries a partition queue may hold; once it is full, reading blocks until the partition catches up
+PARTITION_QUEUE_SIZE = 2 * MAX_BATCH_SIZE
+# How workers apply trades: 'book' keeps the shards' lots in memory and persists them with write-behind
+# flushes; 'server' applies and acks each trade in one fifo_apply_trade call (see lot_functions.py),
+# fenced by the shard lease, with nothing held in memory. Shards can move between workers in either mode.
+APPLY_MODE = os.environ.get("PNL_APPLY_MODE", "book")
+
+
+def shard_of_position(position_key: str) -> int:
+    """'alice/AAPL' -> virtual shard of the position"""
+    return shard_for_position(*position_key.split("/", 1))
+
+
+def partition_of_position(position_key: str) -> int:
+    """Ordered partition of a position within one worker process."""
+    return hash(position_key) % PARTITIONS
 
 
 def valid_date(date_string: str) -> bool:
@@ -27,133 +63,436 @@ def valid_date(date_string: str) -> bool:
 
 
 class PnLCalculator:
-    def __init__(self, shard_range=None, service_name="mymaster", redis_db=0):
-        self.shard_char = shard_range[0] if shard_range else None
-
-        # If a shard is provided, set it up as a worker
-        if self.shard_char:
-            logger.info(f"PnL Worker initialized for shard: {self.shard_char.upper()}")
-            self.queue_key = f"pnl_queue:{self.shard_char}"
-        # If no shard, it's a utility instance, not a worker
+    def __init__(self, worker_name=None, service_name="mymaster", redis_db=0):
+        self.worker_name = worker_name
+
+        # If a worker name is provided, set it up as a worker. Its shards are assigned through Redis leases
+        if self.worker_name:
+            logger.info(f"PnL Worker '{self.worker_name}' initialized, shards are assigned through leases")
+            self.consumer = self.worker_name
+        # If no worker name, it's a utility instance, not a worker
         else:
             logger.info("PnLCalculator initialized in utility mode (no sharding).")
-            self.queue_key = None
 
-        # Connect using Sentinel
-        sentinel = Sentinel(
-            [('sentinel1', 26379), ('sentinel2', 26379), ('sentinel3', 26379)],
-            socket_timeout=None,
-            decode_responses=True
-        )
-        self.redis = sentinel.master_for("mymaster", socket_timeout=None, decode_responses=True)
+        # Shared pooled connection to the Sentinel-managed master
+        self.redis = get_redis_client()
+        # Lot records are packed binary, read through a client that doesn't decode responses
+        self.raw_redis = get_redis_client(decode_responses=False)
 
         # self.redis = redis.Redis(host='localhost', port=6379, decode_responses=True)
 
         self.lots_key_prefix = "lots:"
         self.unrealized_pnl_by_position_hash = "unrealized_pnl_by_position"
         self.realized_pnl_by_position_hash = "realized_pnl_by_position"
-
-        # Threading and Internal Queue Setup
-        self.internal_trade_queue = Queue()
-        # Start a dedicated background thread for processing.
-        # It's a daemon so it exits when the main program exits.
-        processing_thread = threading.Thread(target=self._processing_worker_loop, daemon=True)
-        processing_thread.start()
-        logger.info("Started background processing thread.")
-
-        logger.info(f"Will pull trades from Redis list: '{self.queue_key}'")
+        # Running aggregates of the open lots, so unrealized PnL is qty * price - cost without reading lots
+        self.open_quantity_by_position_hash = "open_quantity_by_position"
+        self.cost_basis_by_position_hash = "cost_basis_by_position"
+
+        # Workers own an in-memory lot book for the shards they currently hold. A shard's positions are
+        # loaded from Redis when its lease is acquired and dropped from the book when the shard moves on.
+        self.lot_book = None
+        self.leases = None
+        self.shard_epochs = {}  # owned shard -> epoch, bumped on every acquisition so stale queued entries are skipped
+        self.read_ids = {}      # owned shard's stream -> next XREADGROUP id ('0' re-reads our pending entries first)
+        self._epochs = itertools.count(1)
+        self.apply_failures = Counter()  # (stream, msg_id) -> times applying the entry raised
+        self.shards_lock = threading.Lock()
+        self.server_apply = bool(self.worker_name) and APPLY_MODE == "server"
+        self.flush_lock = threading.Lock()  # One flush at a time, so position writes can't land out of order
+        # Held only around a flush's fenced MULTI/EXEC and around lease renewals, which would abort it
+        self.fence_lock = threading.Lock()
+        if self.worker_name:
+            # One book per partition, each with its own lock, so the partitions apply trades in parallel
+            self.lot_book = PartitionedLotBook(self.redis, PARTITIONS, partition_of_position, self.lots_key_prefix,
+                                               raw_redis_client=self.raw_redis)
+            self.leases = ShardLeases(self.redis, SHARDS, self.worker_name,
+                                      on_acquire=self._on_shards_acquired,
+                                      on_release=self._on_shard_released,
+                                      on_lost=self._on_shards_lost,
+                                      renew_lock=self.fence_lock)
+
+        # Threading and Internal Queue Setup: one queue per ordered partition
+        self.partition_queues = [Queue(maxsize=PARTITION_QUEUE_SIZE) for _ in range(PARTITIONS)]
+        # (stream, msg_id) of entries read into a partition queue and not yet taken off it
+        self.in_flight = set()
+        self.in_flight_lock = threading.Lock()
+        if self.worker_name:
+            # Start dedicated background threads for each partition's processing, write-behind flushing and
+            # lease upkeep. They're daemons so they exit when the main program exits.
+            for partition_queue in self.partition_queues:
+                processing_thread = threading.Thread(target=self._processing_worker_loop, args=(partition_queue,), daemon=True)
+                processing_thread.start()
+            flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+            flush_thread.start()
+            lease_thread = threading.Thread(target=self._lease_loop, daemon=True)
+            lease_thread.start()
+            logger.info("Started background processing, flush and lease threads.")
         logger.info(f"Will store realized PnL in Redis hash: '{self.realized_pnl_by_position_hash}'")
 
-    def _processing_worker_loop(self):
+    def _processing_worker_loop(self, partition_queue: Queue):
         """
-        This function runs in a separate thread.
-        It continuously pulls trade keys from the internal queue and processes them one by one.
+        This function runs in a separate thread, one per partition.
+        It continuously pulls booked-trade events from its partition's queue and applies them one by one
+        to the partition's lot book, holding only that partition's lock. A position touched for the first
+        time is read from Redis before the lock is taken. Their stream acks are deferred to the next
+        write-behind flush, so a trade is only acknowledged once its effect on the lots has been persisted.
+        In server apply mode each trade is instead applied and acked by one fenced fifo_apply_trade call.
+        Entries read before their shard moved away are skipped; they stay pending for the shard's owner.
         """
         logger.info("Background processor is running...")
         while True:
             # The .get() call is blocking, it will wait until an item is available.
-            key_to_process = self.internal_trade_queue.get()
+            shard, epoch, stream, msg_id, event = partition_queue.get()
             try:
-                self._process_trade_from_key(key_to_process)
+                if self.server_apply:
+                    if self.shard_epochs.get(shard) == epoch:
+                        trade = self._trade_from_event(event, shard)
+                        if trade is None:
+                            self.redis.xack(stream, PNL_GROUP, msg_id)
+                        else:
+                            self.apply_trade_atomic(trade, ack=(stream, PNL_GROUP, msg_id))
+                    continue
+                position_key = f"{event.get('account')}/{event.get('ticker')}"
+                book = self.lot_book.book(position_key)
+                cold_lots = None if book.has_position(position_key) else book.read_lots(position_key)
+                with book.lock:
+                    if self.shard_epochs.get(shard) == epoch:
+                        if cold_lots is not None:
+                            book.install_position(position_key, cold_lots)
+                        self._process_trade_event(event, shard)
+                        book.add_pending_ack(stream, PNL_GROUP, msg_id)
             except Exception as e:
-                logger.error(f"Error in processing worker for key {key_to_process}: {e}")
+                # Applying the shard's later trades would put its positions out of order, so park the shard;
+                # the entry stays pending and the reaper recovers the shard from its persisted state
+                logger.error(f"Error in processing worker for event {msg_id}, pausing shard {shard}: {e}")
+                self.apply_failures[(stream, msg_id)] += 1
+                self._deactivate_shards({shard})
             finally:
+                with self.in_flight_lock:
+                    self.in_flight.discard((stream, msg_id))
                 # Signal that the task from the queue is done.
-                self.internal_trade_queue.task_done()
+                partition_queue.task_done()
 
-    def run_worker(self):
+    def _lease_loop(self):
         """
-        Main worker loop. It efficiently pulls trade keys from Redis and
-        hands them off to the internal processing queue.
-        This version combines low-latency waiting with high-throughput batching.
+        Runs in a separate thread, renewing this worker's shard leases and taking or handing back shards.
+        The reaper runs here too, so shard hand-offs and recoveries never overlap.
         """
-        logger.info(
-            f"Ingestion worker started for shard '{self.shard_char.upper()}'. "
-            f"Waiting for trades from '{self.queue_key}'..."
-        )
+        last_reap = time.time()
         while True:
             try:
-                # 1. Wait for the FIRST trade to arrive.
-                # This blocks with very low resource usage and provides instant responsiveness.
-                message = self.redis.brpop(self.queue_key, timeout=BRPOP_TIMEOUT)
+                self.leases.rebalance()
+                if time.time() - last_reap >= REAP_INTERVAL:
+                    last_reap = time.time()
+                    self.reap_stuck_entries()
+            except Exception as e:
+                logger.error(f"Error rebalancing shard leases: {e}")
+            time.sleep(RENEW_INTERVAL)
 
-                if not message:
-                    # BRPOP timed out, no trades arrived. Continue the loop.
-                    logger.debug("BRPOP timed out. No new trades.")
-                    continue
+    def reap_stuck_entries(self) -> int:
+        """
+        The consumer group's pending list is this worker's processing list: entries stay in it from the
+        read until the flush that persists their effect acks them. An entry idle past REAP_IDLE_MS that
+        is neither still queued in a partition nor applied and awaiting the next flush was dropped in
+        flight (e.g. its apply raised), so its shard is recovered: what the shard applied is flushed,
+        its lots reloaded and its pending entries replayed in order. A shard parked by a failed apply is
+        recovered the same way even when nothing is stuck. Entries that failed to apply
+        MAX_APPLY_FAILURES times are moved to the dead-letter stream first so they can't wedge the shard.
+
+        :return: Number of shards recovered.
+        """
+        # Taken before reading the pending lists, so an entry moving from a queue to the acks meanwhile is in one of them
+        with self.in_flight_lock:
+            held = set(self.in_flight)
+        held |= self.lot_book.pending_ack_ids()
+
+        recovered = 0
+        for shard in sorted(self.leases.owned):
+            stream = booked_trades_stream(shard)
+            stuck = self.redis.xpending_range(stream, PNL_GROUP, min='-', max='+', count=CLAIM_BATCH_SIZE, idle=REAP_IDLE_MS)
+            stuck = [entry for entry in stuck if (stream, entry["message_id"]) not in held]
+            # A shard parked by a failed apply whose entry got acked anyway (a server-side apply whose reply was lost) has nothing stuck
+            if not stuck and shard in self.shard_epochs:
+                continue
+
+            poisoned = [msg_id for (failed_stream, msg_id), failures in list(self.apply_failures.items())
+                        if failed_stream == stream and failures >= MAX_APPLY_FAILURES]
+            if poisoned:
+                self._dead_letter(stream, poisoned)
+                for msg_id in poisoned:
+                    del self.apply_failures[(stream, msg_id)]
+
+            logger.warning(f"Recovering shard {shard}: {len(stuck)} entries stuck in flight" if stuck else f"Recovering paused shard {shard}")
+            self._on_shard_released(shard)
+            self._on_shards_acquired({shard})
+            recovered += 1
+        return recovered
+
+    def _dead_letter(self, stream: str, msg_ids):
+        """Copy the entries to the dead-letter stream and ack them, in one MULTI/EXEC."""
+        entries = []
+        for msg_id in msg_ids:
+            entries.extend(self.redis.xrange(stream, msg_id, msg_id))
+
+        pipe = self.redis.pipeline(transaction=True)
+        for msg_id, event in entries:
+            pipe.xadd(PNL_DEAD_LETTER_STREAM, {"stream": stream, "msg_id": msg_id, **event})
+        pipe.xack(stream, PNL_GROUP, *msg_ids)
+        pipe.execute()
+        logger.error(f"Moved {len(msg_ids)} repeatedly failing entries from '{stream}' to '{PNL_DEAD_LETTER_STREAM}'")
+
+    def _on_shards_acquired(self, shards):
+        """
+        Take over newly leased shards: claim the entries the previous owner read but never acked,
+        load the shards' lots, then start reading their streams from our pending entries.
+        """
+        for shard in shards:
+            stream = booked_trades_stream(shard)
+            ensure_consumer_group(self.redis, stream, PNL_GROUP)
+            self._claim_pending(stream)
+
+        if not self.server_apply:
+            self.lot_book.load(owns_position=lambda position_key: shard_of_position(position_key) in shards)
+
+        with self.lot_book.locked(), self.shards_lock:
+            for shard in shards:
+                self.shard_epochs[shard] = next(self._epochs)
+                self.read_ids[booked_trades_stream(shard)] = '0'
+
+    def _claim_pending(self, stream: str):
+        """Move every pending entry of the stream to this consumer. Safe because only the lease holder reads it."""
+        start_id = "0-0"
+        while True:
+            start_id, _, *_ = self.redis.xautoclaim(stream, PNL_GROUP, self.consumer, min_idle_time=0,
+                                                    start_id=start_id, count=CLAIM_BATCH_SIZE)
+            if start_id == "0-0":
+                return
 
-                # 2. Process the first trade immediately.
-                first_trade_key = message[1]
-                logger.debug(f"Ingested first trade key '{first_trade_key}'. Pushing to internal queue.")
-                self.internal_trade_queue.put(first_trade_key)
+    def _deactivate_shards(self, shards):
+        """Stop reading and applying the shards' entries."""
+        with self.lot_book.locked(), self.shards_lock:
+            for shard in shards:
+                self.shard_epochs.pop(shard, None)
+                self.read_ids.pop(booked_trades_stream(shard), None)
 
-                # 3. Now, try to grab a BATCH of any remaining trades.
-                # This avoids processing one-by-one during a high-volume burst.
-                remaining_keys = self.redis.lpop(self.queue_key, MAX_BATCH_SIZE - 1)
+    def _drop_shards(self, shards):
+        self.lot_book.drop(lambda position_key: shard_of_position(position_key) in shards,
+                           {booked_trades_stream(shard) for shard in shards})
 
-                if remaining_keys:
-                    logger.info(f"Ingested a follow-up batch of {len(remaining_keys)} trades.")
-                    for key in remaining_keys:
-                        self.internal_trade_queue.put(key)
+    def _on_shard_released(self, shard):
+        """Hand a shard back cleanly: stop applying its trades and persist what was applied before letting go."""
+        self._deactivate_shards({shard})
+        try:
+            self.flush_lot_book()
+        except Exception as e:
+            # Nothing is lost: the unflushed trades are still pending and the next owner replays them
+            logger.error(f"Error flushing shard {shard} before releasing it: {e}")
+        self._drop_shards({shard})
 
+    def _on_shards_lost(self, shards):
+        """Another worker may already own these shards, so abandon their unflushed state without writing it."""
+        self._deactivate_shards(shards)
+        self._drop_shards(shards)
+
+    def _flush_loop(self):
+        """Runs in a separate thread, periodically persisting the dirty part of the lot book."""
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush_lot_book()
             except Exception as e:
-                logger.error(f"Error in main ingestion loop: {e}")
-                time.sleep(5)  # Sleep on error to prevent fast failure loops
+                logger.error(f"Error flushing lot book: {e}")
 
-    def _process_trade_from_key(self, key: str):
+    def flush_lot_book(self) -> int:
         """
-        Process a trade from a Redis key. (No changes needed in this function)
+        Write-behind flush: persists every dirty position's lot changes and running aggregates, the realized PnL
+        accumulated since the last flush, the positions' unrealized PnL and the acks of the trades
+        that caused them, all in one MULTI/EXEC. The transaction WATCHes the leases of the shards it
+        writes, so a worker that lost a shard can never overwrite its new owner's state.
+        If the flush fails the snapshot is put back and retried next time.
+
+        :return: Number of positions flushed.
+        """
+        with self.flush_lock:
+            lot_changes, aggregates, realized, acks, failed = self.lot_book.take_snapshot()
+            if failed:
+                lot_changes, aggregates, realized, acks = self._quarantine_positions(failed, lot_changes, aggregates, realized, acks)
+            if not lot_changes and not realized and not acks:
+                return 0
+
+            shards = {shard_of_position(position_key) for position_key in list(lot_changes) + list(realized)}
+            shards |= {shard_of_stream(stream) for stream, _, _ in acks}
+
+            try:
+                # One MGET for every ticker the flush revalues. Cached prices only: a download here would hold up
+                # every flush, and tickers without one are revalued once the refresher publishes their price
+                live_prices = self.get_live_prices((position_key.split("/", 1)[1] for position_key in lot_changes), cached_only=True)
+
+                with self.fence_lock, self.redis.pipeline(transaction=True) as pipe:
+                    if self.leases and shards:
+                        pipe.watch(*[lease_key(shard) for shard in shards])
+                        if not self.leases.holds_all(shards, client=pipe):
+                            raise WatchError("A shard lease is no longer held")
+                        pipe.multi()
+
+                    for position_key, changes in lot_changes.items():
+                        self.lot_book.queue_changes(pipe, position_key, changes)
+
+                        open_quantity, cost_basis = aggregates[position_key]
+                        pipe.hset(self.open_quantity_by_position_hash, position_key, open_quantity)
+                        pipe.hset(self.cost_basis_by_position_hash, position_key, cost_basis)
+                        index_position(pipe, position_key, open_quantity)
+
+                        account_id, ticker = position_key.split("/", 1)
+                        live_price = live_prices.get(ticker.upper())
+                        if open_quantity and live_price is None:
+                            continue
+                        unrealized_pnl = self.calculate_unrealized_pnl_from_aggregates(account_id, ticker, open_quantity, cost_basis, live_price)
+                        pipe.hset(self.unrealized_pnl_by_position_hash, position_key, unrealized_pnl)
+
+                    for position_key, pnl in realized.items():
+                        if pnl != 0:
+                            pipe.hincrbyfloat(self.realized_pnl_by_position_hash, position_key, pnl)
+
+                    for stream, group, msg_id in acks:
+                        pipe.xack(stream, group, msg_id)
+                    pipe.execute()
+            except WatchError as e:
+                # A lease changed hands mid-flush; the lease thread drops the lost shards, the rest retry next flush
+                self._restore_snapshot(lot_changes, aggregates, realized, acks)
+                logger.info(f"Flush deferred, shard leases changed: {e}")
+                return 0
+            except Exception:
+                self._restore_snapshot(lot_changes, aggregates, realized, acks)
+                raise
+
+        logger.info(f"Flushed {len(lot_changes)} positions and acked {len(acks)} trades")
+        return len(lot_changes)
+
+    def _restore_snapshot(self, lot_changes, aggregates, realized, acks):
+        """
+        Put a failed flush back for the next one, keeping only the shards this worker still leases. A shard
+        dropped meanwhile belongs to another worker now: restoring it would make every later flush rewrite
+        that worker's keys, or fail its lease check forever.
         """
+        def still_owned(shard):
+            return self.leases is None or shard in self.leases.owned
+        self.lot_book.restore_snapshot(lot_changes, aggregates, realized, acks,
+                                       keep_position=lambda position_key: still_owned(shard_of_position(position_key)),
+                                       keep_stream=lambda stream: still_owned(shard_of_stream(stream)))
+
+    def _quarantine_positions(self, failed: dict, lot_changes, aggregates, realized, acks):
+        """
+        Positions whose lots can't be persisted are recorded on the dead-letter stream and their shards are
+        parked and dropped, so the rest of the book keeps flushing. Nothing of those shards is written or
+        acked: their trades stay pending and the reaper replays them from the persisted lots.
+
+        :return: The snapshot without the parked shards.
+        """
+        shards = {shard_of_position(position_key) for position_key in failed}
+        self._deactivate_shards(shards)
         try:
-            hash_data = self.redis.hgetall(key)
-            if not hash_data or len(hash_data) < 6:
-                logger.warning(f"Incomplete or no data found for key {key}. Skipping.")
-                return
+            pipe = self.redis.pipeline(transaction=False)
+            for position_key, error in failed.items():
+                logger.error(f"Cannot persist position {position_key}, parking shard {shard_of_position(position_key)}: {error}")
+                pipe.xadd(PNL_DEAD_LETTER_STREAM, {"position": position_key, "error": str(error)})
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"Failed to dead-letter positions {sorted(failed)}: {e}")
+        self._drop_shards(shards)
 
-            # account_id = key.split(':')[0]
-            account_id_comma_ticker = key.split(':')[0]
-            account_id, ticker = account_id_comma_ticker.split(',')
+        def kept(position_key):
+            return shard_of_position(position_key) not in shards
+        return ({key: value for key, value in lot_changes.items() if kept(key)},
+                {key: value for key, value in aggregates.items() if kept(key)},
+                {key: value for key, value in realized.items() if kept(key)},
+                [ack for ack in acks if shard_of_stream(ack[0]) not in shards])
 
-            # Defensive check: ensure key belongs to this worker's shard
-            if not account_id.lower().startswith(self.shard_char):
-                logger.warning(
-                    f"Safety check: Worker for shard '{self.shard_char}' received key for another shard: '{key}'. Skipping.")
-                return
+    def run_worker(self):
+        """
+        Main worker loop. It reads booked-trade events for every shard this worker holds through the PnL
+        consumer group and hands each one to its position's partition queue, preserving stream (booking) order per position.
+        A newly acquired shard's pending entries are re-read first, before asking it for new ones.
+        """
+        logger.info(f"Ingestion worker '{self.consumer}' started. Waiting for shard leases...")
+        while True:
+            try:
+                with self.shards_lock:
+                    read_ids = dict(self.read_ids)
+                    epochs = dict(self.shard_epochs)
+                if not read_ids:
+                    time.sleep(1)
+                    continue
+
+                messages = self.redis.xreadgroup(
+                    groupname=PNL_GROUP,
+                    consumername=self.consumer,
+                    streams=read_ids,
+                    count=MAX_BATCH_SIZE,
+                    block=READ_BLOCK_MS
+                )
+
+                for stream, entries in messages or []:
+                    shard = shard_of_stream(stream)
+                    epoch = epochs.get(shard)
+                    if not entries:
+                        # Pending backlog is drained, switch to new entries
+                        self._advance_read_id(shard, epoch, '>')
+                        continue
+
+                    logger.info(f"Ingested a batch of {len(entries)} trades from '{stream}'.")
+                    for msg_id, event in entries:
+                        position_key = f"{event.get('account')}/{event.get('ticker')}"
+                        with self.in_flight_lock:
+                            self.in_flight.add((stream, msg_id))
+                        # Blocks while the partition's queue is full, so a backlog stays in the stream instead of in memory
+                        self.partition_queues[partition_of_position(position_key)].put((shard, epoch, stream, msg_id, event))
+
+                    if read_ids[stream] != '>':
+                        # Pending entries stay pending until the next flush, so page through them by ID
+                        self._advance_read_id(shard, epoch, entries[-1][0])
+
+            except Exception as e:
+                logger.error(f"Error in main ingestion loop: {e}")
+                time.sleep(5)  # Sleep on error to prevent fast failure loops
 
-            trade = Trade(
-                account_id=account_id,
-                ticker=ticker,
-                price=float(hash_data['price']),
-                trade_type=hash_data['type'].lower(),
-                quantity=int(hash_data['quantity']),
-                trade_time=hash_data['trade_time']
-            )
+    def _advance_read_id(self, shard: int, epoch: int, read_id: str):
+        """Move a stream's read position on, unless the shard changed hands since it was read."""
+        with self.shards_lock:
+            if self.shard_epochs.get(shard) == epoch:
+                self.read_ids[booked_trades_stream(shard)] = read_id
 
-            self.process_trade_fifo(trade)
-            logger.info(f"Processed trade from key: {key}")
+    def _process_trade_event(self, event: dict, shard: int):
+        """
+        Process a booked-trade event. The event carries every field of the trade hash,
+        so no extra read of the trade is needed.
+        """
+        trade = self._trade_from_event(event, shard)
+        if trade is None:
+            return
 
-        except Exception as e:
-            logger.error(f"Failed to process trade from key {key}: {e}")
+        self.process_trade_fifo(trade)
+        logger.info(f"Processed trade: {event.get('key')}")
+
+    def _trade_from_event(self, event: dict, shard: int):
+        """The Trade a booked-trade event carries, or None if it doesn't belong on this shard's stream."""
+        account_id = event['account']
+
+        # Defensive check: ensure event belongs to this worker's shard
+        if shard_for_position(account_id, event['ticker']) != shard:
+            logger.warning(
+                f"Safety check: Stream of shard {shard} carried a trade for another shard: '{event.get('key')}'. Skipping.")
+            return None
+
+        return Trade(
+            account_id=account_id,
+            ticker=event['ticker'],
+            price=float(event['price']),
+            trade_type=event['type'].lower(),
+            quantity=int(event['quantity']),
+            trade_time=event['trade_time'],
+            trade_date=event['trade_date']
+        )
 
     def _get_lots_key(self, account_id: str, ticker: str) -> str:
         """Generate a redis key in the following format 'lots:alice/AAPL'"""
@@ -161,50 +500,58 @@ class PnLCalculator:
 
     def _get_lots(self, account_id: str, ticker: str) -> list:
         """Returns a list of all lots(trades) for the user and ticker"""
-        lots_key = self._get_lots_key(account_id, ticker)
-        lots_json = self.redis.get(lots_key)
+        if self.lot_book is not None:
+            return list(self.lot_book.get(account_id, ticker))
 
-        if lots_json:
-            return json.loads(lots_json)
-        else:
-            return []  # No lots exist yet
-
-    def _save_lots(self, account_id: str, ticker: str, lots: list):
-        """Saves lots and stores in into json for the lot key"""
-        lots_key = self._get_lots_key(account_id, ticker)
-        lots_json = json.dumps(lots)
-
-        self.redis.set(lots_key, lots_json)
-        logger.info(f"Saved {len(lots)} lots for {account_id}/{ticker}")
+        return list(LotBook.decode_lots(self.raw_redis.lrange(self._get_lots_key(account_id, ticker), 0, -1)))
 
     def process_trade_fifo(self, trade: Trade):
-        """Function that processes according to whether the trade is a buy or sell"""
-        if trade.trade_type == "buy":
+        """
+        Function that processes according to whether the trade is a buy or sell.
+        Book-mode workers apply it to their lot book; server-mode workers and utility instances apply it
+        atomically on the server instead (utility instances only to positions no worker owns).
+        """
+        if self.lot_book is None or self.server_apply:
+            self.apply_trade_atomic(trade)
+        elif trade.trade_type == "buy":
             self._process_buy_fifo(trade)
         elif trade.trade_type == "sell":
             self._process_sell_fifo(trade)
         else:
             logger.error(f"Unknown trade type {trade.trade_type}")
 
+    def apply_trade_atomic(self, trade: Trade, ack=None):
+        """
+        Apply a trade with the server-side FIFO function in one round trip, fenced by the position's shard
+        lease: a worker's call only goes through while the lease is still its own, and a utility instance's
+        only while no worker owns the shard (a book-mode owner would overwrite the result on its next flush).
+        Refused calls raise lot_functions.PositionOwnedError. With ack=(stream, group, entry ID) the
+        trade's stream entry is acknowledged in the same call.
+        """
+        position_key = f"{trade.account_id}/{trade.ticker}"
+        realized_pnl, open_quantity, cost_basis, unrealized_pnl = lot_functions.apply_trade(
+            self.redis, position_key, trade.trade_type, trade.price, trade.quantity, trade.trade_date, trade.trade_time,
+            lots_key_prefix=self.lots_key_prefix,
+            realized_hash=self.realized_pnl_by_position_hash,
+            open_quantity_hash=self.open_quantity_by_position_hash,
+            cost_basis_hash=self.cost_basis_by_position_hash,
+            unrealized_hash=self.unrealized_pnl_by_position_hash,
+            owner_lease_key=lease_key(shard_for_position(trade.account_id, trade.ticker)),
+            lease_token=self.leases.token if self.leases else None,
+            ack=ack)
+        logger.info(f"{trade.trade_type.upper()} - {position_key} now holds {open_quantity} shares, "
+                    f"realized ${realized_pnl:.2f}, unrealized ${unrealized_pnl:.2f}")
+        return realized_pnl, open_quantity, cost_basis, unrealized_pnl
+
     def _process_buy_fifo(self, trade: Trade):
         """Process buy trades by adding to lots"""
-        existing_lots = self._get_lots(trade.account_id, trade.ticker)
-
-        new_lot = {
-            "price": trade.price,
-            "quantity": trade.quantity,
-            "date": trade.trade_date,
-            "time": trade.trade_time
-        }
-        existing_lots.append(new_lot)
-
-        self._save_lots(trade.account_id, trade.ticker, existing_lots)
+        self.lot_book.append_lot(trade.account_id, trade.ticker, Lot(trade.price, trade.quantity, trade.trade_date, trade.trade_time))
+        self.lot_book.adjust_aggregates(trade.account_id, trade.ticker, trade.quantity, trade.price * trade.quantity)
+        existing_lots = self.lot_book.get(trade.account_id, trade.ticker)
 
         logger.info(f"BUY - Added lot of {trade.quantity} shares @ ${trade.price}")
         logger.info(f"{trade.account_id}/{trade.ticker} now has {len(existing_lots)} lots")
 
-        self.store_and_calculate_unrealized_pnl_position(trade.account_id, trade.ticker)
-
     def _process_sell_fifo(self, trade: Trade):
         """
         Process sell trades using FIFO methodology.
@@ -212,7 +559,7 @@ class PnLCalculator:
         If sell quantity is higher than the first lot, this method will consume multiple lots and calculate the realized PnL accordingly.
         Partial consumption of lots is also permitted.
         """
-        existing_lots = self._get_lots(trade.account_id, trade.ticker)
+        existing_lots = self.lot_book.get(trade.account_id, trade.ticker)
 
         if not existing_lots:
             logger.warning(f"SELL - No lots to sell for {trade.account_id}/{trade.ticker} - cannot calculate PnL")
@@ -224,43 +571,34 @@ class PnLCalculator:
         logger.info(
             f"SELL - Need to sell {remaining_to_sell} shares of {trade.ticker} from a total of {len(existing_lots)}")
 
-        lots_to_remove = []
+        while existing_lots and remaining_to_sell > 0:
+            lot = existing_lots[0]
 
-        for i, lot in enumerate(existing_lots):
-            if remaining_to_sell <= 0:
-                break
-
-            if lot["quantity"] <= remaining_to_sell:
+            if lot.quantity <= remaining_to_sell:
                 # Consume entire lot
-                realized_pnl_from_lot = (trade.price - lot["price"]) * lot["quantity"]
+                realized_pnl_from_lot = (trade.price - lot.price) * lot.quantity
                 total_realized_pnl += realized_pnl_from_lot
-                remaining_to_sell -= lot["quantity"]
-                lots_to_remove.append(i)
+                remaining_to_sell -= lot.quantity
+                self.lot_book.pop_head(trade.account_id, trade.ticker)
+                self.lot_book.adjust_aggregates(trade.account_id, trade.ticker, -lot.quantity, -lot.price * lot.quantity)
 
                 logger.info(
-                    f"Consumed entire lot: {lot['quantity']} @ ${lot['price']} → PnL: ${realized_pnl_from_lot:.2f}")
+                    f"Consumed entire lot: {lot.quantity} @ ${lot.price} → PnL: ${realized_pnl_from_lot:.2f}")
             else:
                 # Partial consumption of the current lot
-                realized_pnl_from_lot = (trade.price - lot["price"]) * remaining_to_sell
+                realized_pnl_from_lot = (trade.price - lot.price) * remaining_to_sell
                 total_realized_pnl += realized_pnl_from_lot
-                lot["quantity"] -= remaining_to_sell
+                self.lot_book.replace_head(trade.account_id, trade.ticker, lot._replace(quantity=lot.quantity - remaining_to_sell))
+                self.lot_book.adjust_aggregates(trade.account_id, trade.ticker, -remaining_to_sell, -lot.price * remaining_to_sell)
                 logger.info(
-                    f"Partially consumed lot: {remaining_to_sell} from {lot['quantity'] + remaining_to_sell} @ ${lot['price']} → PnL: ${realized_pnl_from_lot:.2f}")
-                logger.info(f"Remaining in lot: {lot['quantity']} shares")
+                    f"Partially consumed lot: {remaining_to_sell} from {lot.quantity} @ ${lot.price} → PnL: ${realized_pnl_from_lot:.2f}")
+                logger.info(f"Remaining in lot: {existing_lots[0].quantity} shares")
                 remaining_to_sell = 0
 
-        # Remove fully consumed lots
-        existing_lots = [lot for i, lot in enumerate(existing_lots) if i not in lots_to_remove]
-
-        # Save updated lots
-        self._save_lots(trade.account_id, trade.ticker, existing_lots)
-
-        # Update realized PnL for this account
+        # Accumulate realized PnL for this position, it is persisted with the next flush
         if total_realized_pnl != 0:
-            position_key = f"{trade.account_id}/{trade.ticker}"
-            self.redis.hincrbyfloat(self.realized_pnl_by_position_hash, position_key, total_realized_pnl)
-            logger.info(f"Realized PnL for {position_key}: ${total_realized_pnl:.2f}")
-            self.store_and_calculate_unrealized_pnl_position(trade.account_id, trade.ticker)
+            self.lot_book.add_realized_pnl(trade.account_id, trade.ticker, total_realized_pnl)
+            logger.info(f"Realized PnL for {trade.account_id}/{trade.ticker}: ${total_realized_pnl:.2f}")
 
         if remaining_to_sell > 0:
             logger.warning(f"Could not sell {remaining_to_sell} shares - insufficient lots!")
@@ -280,6 +618,19 @@ class PnLCalculator:
             logger.error(f"  Unexpected error getting price for {ticker}: {e}")
             return None
 
+    def get_live_prices(self, tickers, cached_only=False) -> dict:
+        """
+        Get current market prices for several tickers in one round trip ({TICKER: price or None}).
+        With cached_only, tickers without a cached price are left as None instead of being downloaded.
+        """
+        try:
+            if cached_only:
+                return market_data.get_cached_prices(tickers)
+            return market_data.get_prices(tickers)
+        except Exception as e:
+            logger.error(f"  Unexpected error getting prices: {e}")
+            return {}
+
     def store_and_calculate_unrealized_pnl_position(self, account_id: str, ticker: str) -> bool:
         """
         Calculate and store unrealized PnL for a specific position.
@@ -306,44 +657,59 @@ class PnLCalculator:
             logger.debug(f"   Unrealized PnL for {position_key} is unchanged. Skipping update.")
             return False
 
+    def get_position_aggregates(self, account_id: str, ticker: str):
+        """
+        Returns (open quantity, total cost basis) for a position. Workers read their lot book;
+        utility instances read the persisted aggregates, deriving them from the lots only for
+        positions that predate the aggregates (and storing them so that happens once).
+        """
+        if self.lot_book is not None:
+            return self.lot_book.get_aggregates(account_id, ticker)
+
+        position_key = f"{account_id}/{ticker}"
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hget(self.open_quantity_by_position_hash, position_key)
+        pipe.hget(self.cost_basis_by_position_hash, position_key)
+        open_quantity, cost_basis = pipe.execute()
+
+        if open_quantity is not None and cost_basis is not None:
+            return int(open_quantity), float(cost_basis)
+
+        open_quantity, cost_basis = LotBook.sum_lots(self._get_lots(account_id, ticker))
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hsetnx(self.open_quantity_by_position_hash, position_key, open_quantity)
+        pipe.hsetnx(self.cost_basis_by_position_hash, position_key, cost_basis)
+        index_position(pipe, position_key, open_quantity)
+        pipe.execute()
+        return open_quantity, cost_basis
+
     def calculate_unrealized_pnl_single(self, account_id: str, ticker: str) -> float:
         """Calculate unrealized PnL for a single position"""
-        # Get current lots for this position
-        lots = self._get_lots(account_id, ticker)
+        open_quantity, cost_basis = self.get_position_aggregates(account_id, ticker)
+        return self.calculate_unrealized_pnl_from_aggregates(account_id, ticker, open_quantity, cost_basis)
 
-        if not lots:
-            logger.debug(f"No lots found for {account_id}/{ticker}")
+    def calculate_unrealized_pnl_from_aggregates(self, account_id: str, ticker: str, open_quantity: int, cost_basis: float, live_price: float = None) -> float:
+        """
+        Calculate unrealized PnL for a single position from its running aggregates in O(1):
+        sum((price - lot_price) * lot_qty) == open_quantity * price - cost_basis
+        The live price is looked up unless the caller already fetched it.
+        """
+        if not open_quantity:
+            logger.debug(f"No open lots for {account_id}/{ticker}")
             return 0.0
 
         # Get live market price
-        live_price = self.get_live_price(ticker)
+        if live_price is None:
+            live_price = self.get_live_price(ticker)
         if live_price is None:
             logger.warning(f" Cannot calculate unrealized PnL for {account_id}/{ticker} - no live price")
             return 0.0
 
-        # Calculate unrealized PnL for each lot
-        total_unrealized_pnl = 0.0
-        total_shares = 0
-        total_cost = 0.0
-
-        for lot in lots:
-            lot_quantity = lot["quantity"]
-            lot_cost_basis = lot["price"]
-
-            # PnL for this lot: (market_price - cost_basis) × quantity
-            lot_unrealized_pnl = (live_price - lot_cost_basis) * lot_quantity
-            total_unrealized_pnl += lot_unrealized_pnl
-
-            # Track totals for logging
-            total_shares += lot_quantity
-            total_cost += lot_cost_basis * lot_quantity
-
-        # Calculate weighted average cost basis for logging
-        avg_cost_basis = total_cost / total_shares if total_shares > 0 else 0
+        total_unrealized_pnl = open_quantity * live_price - cost_basis
 
         logger.info(f"   Unrealized PnL for {account_id}/{ticker}:")
-        logger.info(f"   Current position: {total_shares} shares")
-        logger.info(f"   Average cost basis: ${avg_cost_basis:.2f}")
+        logger.info(f"   Current position: {open_quantity} shares")
+        logger.info(f"   Average cost basis: ${cost_basis / open_quantity:.2f}")
         logger.info(f"   Current market price: ${live_price:.2f}")
         logger.info(f"   Unrealized PnL: ${total_unrealized_pnl:.2f}")
 
@@ -351,14 +717,14 @@ class PnLCalculator:
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python pnl_calculator.py <shard_char>")
-        print("Example: python pnl_calculator.py a")
-        sys.exit(1)
+    # Usage: python pnl_calculator.py [WORKER_NAME]
+    # Normally launched by start_pnl_calculators.py, which runs several workers that share the shards
+    worker_name = sys.argv[1] if len(sys.argv) > 1 else f"pnl-{socket.gethostname()}-{os.getpid()}"
+    calculator = PnLCalculator(worker_name=worker_name)
 
-    letter = sys.argv[1].lower()
-    # The PnLCalculator now takes a single character for its shard
-    calculator = PnLCalculator(shard_range=(letter, letter))
-
-    # The main entry point is now the run_worker loop
-    calculator.run_worker()
\ No newline at end of file
+    # The main entry point is the run_worker loop
+    try:
+        calculator.run_worker()
+    finally:
+        # Hand the shards straight to the other workers instead of making them wait for the leases to expire
+        calculator.leases.release_all()
@@ -1,6 +1,9 @@
 # import redis
 import logging
-from redis.sentinel import Sentinel
+try:
+    from .redis_connection import get_redis_client
+except ImportError:
+    from redis_connection import get_redis_client
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -14,13 +17,8 @@ class PnLRetriever:
         :param realized_pnl_hash: Redis hash for realized PnL.
         :param unrealized_pnl_hash: Redis hash for unrealized PnL.
         """
-        # Connect using Sentinel
-        sentinel = Sentinel(
-            [('sentinel1', 26379), ('sentinel2', 26379), ('sentinel3', 26379)],
-            socket_timeout=None,
-            decode_responses=True
-        )
-        self.redis = sentinel.master_for("mymaster", socket_timeout=None, decode_responses=True)
+        # Shared pooled connection to the Sentinel-managed master
+        self.redis = get_redis_client()
         # self.redis = redis.Redis(host='localhost', port=6379, decode_responses=True)
         self.realized_pnl_hash = realized_pnl_hash
         self.unrealized_pnl_hash = unrealized_pnl_hash
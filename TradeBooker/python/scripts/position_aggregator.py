@@ -1,64 +1,97 @@
-import redis
-from redis.sentinel import Sentinel
 import logging
 from datetime import datetime
 import sys
 import time
-import threading
+from trade_index import trade_index_key
+from trade_events import AGGREGATOR_GROUP, NUM_SHARDS, ensure_consumer_group, shard_for_position, shards_for_instance, streams_for_shards
+from redis_connection import get_redis_client
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class PortfolioAggregator:
-    def __init__(self, sentinels=None, service_name="mymaster", redis_db=0):
+    def __init__(self, sentinels=None, service_name="mymaster", instance=None, consume=True):
        
-        # Redis setup
-        if sentinels is None:
-            sentinels = [("sentinel1", 26379), ("sentinel2", 26379), ("sentinel3", 26379)]
-
-        sentinel = Sentinel(sentinels, socket_timeout=None, decode_responses=True)
-        self.redis = sentinel.master_for(service_name, socket_timeout=None, decode_responses=True)
+        # Redis setup (shared pooled connection; defaults to the standard sentinels)
+        self.redis = get_redis_client(sentinels=sentinels, service_name=service_name)
 
         self.positions_hash_key = "positions"  # Where aggregated positions are stored
         
         #Wait for redis to load the dataset
         self.wait_for_redis_ready()
 
-        # Prep method that proceses dirty positions (accountid/ticker combos who've had new trades w/o position being aggregated yet)
+        # Positions (accountid,ticker combos) queued for a full re-aggregation by reconcile()
         self.dirty_positions = set()
-        threading.Thread(target=self._run_dirty_loop_every_second, daemon=True).start()  # runs in background
-        
-        # Subscribe to Redis keyspace notifications via Pub/Sub
-        self.pubsub = self.redis.pubsub()
-
-        self.letter_range = "ABCDEFGHIJKLMNOPQRSTUVWXYZ" # Default is to subscribe to entire alphabet
-        if len(sys.argv) == 2:
-            self.letter_range = sys.argv[1].upper()
-        self.patterns = [f"__keyspace@{redis_db}__:{letter}*,*:*:*" for letter in self.letter_range]
 
-        for pattern in self.patterns:
-            self.pubsub.psubscribe(pattern)
-            logger.info(f"Subscribed to Redis keyspace notifications on pattern: {pattern}")
-        
-        #Upon instantiation (starting up after potentially having been down and missing trades,
-        # send ALL id,tickercombos of past trades into dirty positions, reagregating evrything.
-        self.mark_all_positions_dirty() 
-        
+        # instance = (index, count): this process takes every count-th booked-trade shard. Default is all of them
+        index, count = instance or (0, 1)
+        self.shards = set(shards_for_instance(index, count))
+
+        # Consume the booked-trade streams for this instance's shards through the aggregator consumer group
+        self.streams = streams_for_shards(sorted(self.shards))
+        self.consumer = f"aggregator-{index}-of-{count}"
+        if consume:
+            for stream in self.streams:
+                ensure_consumer_group(self.redis, stream, AGGREGATOR_GROUP)
+            logger.info(f"Consuming {len(self.streams)} booked-trade streams as '{self.consumer}' in group '{AGGREGATOR_GROUP}'")
+
+    @staticmethod
+    def position_delta(event: dict):
+        """
+        Incremental mode: turn a booked-trade event into (position_key, signed quantity delta).
+        Returns None for events that don't change a position.
+        """
+        trade_type = event.get("type", "").lower()
+        quantity = int(event["quantity"])
+        if trade_type == 'buy':
+            delta = quantity
+        elif trade_type == 'sell':
+            delta = -quantity
+        else:
+            logger.warning(f"Unknown trade type '{trade_type}' in event for {event.get('key')}")
+            return None
+        return f"{event['account']}:{event['ticker']}", delta
+
+    def apply_events(self, stream: str, entries):
+        """
+        Applies a batch of booked-trade events as HINCRBY deltas and acknowledges them
+        in the same MULTI/EXEC, so a crash can never apply an event without acking it (or vice versa).
+        """
+        pipe = self.redis.pipeline(transaction=True)
+        for msg_id, event in entries:
+            try:
+                change = self.position_delta(event)
+                if change:
+                    position_key, delta = change
+                    pipe.hincrby(self.positions_hash_key, position_key, delta)
+            except Exception as e:
+                logger.error(f"❌ Failed to apply booked trade {msg_id} from {stream}: {e}")
+            pipe.xack(stream, AGGREGATOR_GROUP, msg_id)
+        pipe.execute()
 
     def reaggregate_position(self, account_id: str, ticker: str):
+        """
+        Reconciliation path: recompute a position from scratch out of the account's trade index.
+        Only the account's own trades are read, never the whole keyspace.
+        """
         try:
             total_quantity = 0
-            
-            for key in self.redis.scan_iter(match=f"{account_id},{ticker}:*", count=1000):
-                trade = self.redis.hgetall(key)
-                if not trade:
+
+            prefix = f"{account_id},{ticker}:"
+            keys = [key for key in self.redis.zrange(trade_index_key(account_id), 0, -1) if key.startswith(prefix)]
+
+            pipe = self.redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.hmget(key, "type", "quantity")
+
+            for key, (trade_type, quantity) in zip(keys, pipe.execute() if keys else []):
+                if trade_type is None or quantity is None:
                     logger.info(f"Skipping key {key}. trade is empty")
                     continue
                 try:
-                    quantity = int(trade['quantity'])
-                    #logger.info(f"Quantity of this particular trade: {quantity}")
-                    trade_type = trade['type'].lower()
+                    quantity = int(quantity)
+                    trade_type = trade_type.lower()
                     if trade_type == 'buy':
                         total_quantity += quantity
                     elif trade_type == 'sell':
@@ -76,48 +109,60 @@ class PortfolioAggregator:
             logger.error(f"❌ Failed to reaggregate position for {account_id},{ticker}: {e}")
 
     def listen(self):
-        logger.info("Listening for trade updates...")
-
-        for message in self.pubsub.listen():
-
-            if message['type'] != 'pmessage':
-                continue
-
-            keyname = message['channel'].split("__keyspace@0__:")[-1]
-            event_type = message['data']
+        logger.info("Listening for booked trades (incremental mode)...")
 
-            if event_type != 'hset':
-                continue
+        # Start with our own pending entries ('0') left over from a previous run, then switch to new ones ('>')
+        read_ids = {stream: '0' for stream in self.streams}
 
+        while True:
             try:
-                account_ticker_combo = keyname.split(":")[0]  # "Ari,GOOG"
-                self.dirty_positions.add(account_ticker_combo)
+                messages = self.redis.xreadgroup(
+                    groupname=AGGREGATOR_GROUP,
+                    consumername=self.consumer,
+                    streams=read_ids,
+                    count=1000,
+                    block=5000
+                )
+
+                for stream, entries in messages:
+                    if not entries:
+                        # No pending entries left for this stream
+                        read_ids[stream] = '>'
+                        continue
+                    self.apply_events(stream, entries)
 
             except Exception as e:
-                logger.error(f"⚠️ Failed to process key {keyname}: {e}")
-    def _run_dirty_loop_every_second(self):
-        while True:
-            logger.info("Running dirty loop")
+                logger.error(f"Booked-trade stream read error: {e}")
+                time.sleep(1)
 
-            current_dirties = list(self.dirty_positions)
-            self.dirty_positions.clear()
-            #self.dirty_positions.difference_update(current_dirties)  # Slower but perhaps a moticum safer, only removes processed items (in case new items added in between setting of current dirties and the clearing)
+    def reconcile(self):
+        """
+        Explicit reconciliation: fully re-aggregates every position in this instance's shards.
+        Run it while the incremental aggregators are idle (e.g. after downtime), since it
+        overwrites positions with values computed from the trade index.
+        """
+        self.mark_all_positions_dirty()
 
-            for dirty_position in current_dirties:
-                account_id, ticker = dirty_position.split(",")
-                self.reaggregate_position(account_id, ticker)
-            time.sleep(1)
+        current_dirties = list(self.dirty_positions)
+        self.dirty_positions.clear()
+
+        for dirty_position in current_dirties:
+            account_id, ticker = dirty_position.split(",")
+            self.reaggregate_position(account_id, ticker)
+        logger.info(f"Reconciled {len(current_dirties)} positions.")
 
     def mark_all_positions_dirty(self):
-        logger.info("Marking all positions dirty upon starting up")
-        for key in self.redis.scan_iter(match="*,*:*", count=1000):
-            try:
-                account_ticker = key.split(":")[0]  # e.g: "Ari,GOOG"
-                first_letter = account_ticker[0].upper()
-                if first_letter in self.letter_range:
-                    self.dirty_positions.add(account_ticker)
-            except Exception as e:
-                logger.warning(f"⚠️ Could not process key {key}: {e}")
+        logger.info("Marking all positions dirty for reconciliation")
+        for account_id in self.redis.smembers("accounts"):
+            if not account_id:
+                continue
+            for key in self.redis.zrange(trade_index_key(account_id), 0, -1):
+                try:
+                    account_ticker = key.split(":")[0]  # e.g: "Ari,GOOG"
+                    if shard_for_position(*account_ticker.split(",")) in self.shards:
+                        self.dirty_positions.add(account_ticker)
+                except Exception as e:
+                    logger.warning(f"⚠️ Could not process key {key}: {e}")
         logger.info(f"Total positions marked dirty by this running instance/process: {len(self.dirty_positions)}")
 
     def wait_for_redis_ready(self, timeout=60):
@@ -134,4 +179,14 @@ class PortfolioAggregator:
         raise TimeoutError("Redis did not become ready within timeout")
 
 if __name__ == "__main__":
-    PortfolioAggregator().listen()
+    # Usage: python position_aggregator.py [INDEX/COUNT] [--reconcile]   e.g. '2/5' is the third of five instances
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    instance = tuple(int(part) for part in args[0].split("/")) if args else None
+    if instance and not (0 <= instance[0] < instance[1] <= NUM_SHARDS):
+        print(f"Instance must be INDEX/COUNT with 0 <= INDEX < COUNT <= {NUM_SHARDS}")
+        sys.exit(1)
+
+    if "--reconcile" in sys.argv:
+        PortfolioAggregator(instance=instance, consume=False).reconcile()
+    else:
+        PortfolioAggregator(instance=instance).listen()
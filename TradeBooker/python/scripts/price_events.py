@@ -0,0 +1,82 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The market-data feed appends one entry per ticker whose live price actually changed,
+# so revaluation only has to touch the positions holding those tickers.
+PRICE_CHANGES_STREAM = "price_changes"
+PRICE_CHANGES_MAXLEN = 100000  # Approximate cap; consumers only ever need the recent tail
+REVALUATION_GROUP = "revaluation-group"
+
+# Reverse index: ticker -> open positions ('alice/AAPL') holding it
+POSITIONS_BY_TICKER_PREFIX = "positions_by_ticker:"
+# Tickers with at least one open position, kept in step with the reverse index above
+HELD_TICKERS_SET = "held_tickers"
+
+# KEYS: ticker's positions set, held tickers set; ARGV: position key, ticker, 1 if open else 0
+INDEX_POSITION_SCRIPT = """
+if ARGV[3] == '1' then
+    redis.call('SADD', KEYS[1], ARGV[1])
+    redis.call('SADD', KEYS[2], ARGV[2])
+elseif redis.call('SREM', KEYS[1], ARGV[1]) == 1 and redis.call('SCARD', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[2], ARGV[2])
+end
+"""
+_index_position_script = None
+
+
+def positions_by_ticker_key(ticker: str) -> str:
+    """Generate the reverse index key in the following format 'positions_by_ticker:AAPL'"""
+    return f"{POSITIONS_BY_TICKER_PREFIX}{ticker.upper()}"
+
+
+def index_position(pipe, position_key: str, open_quantity):
+    """
+    Queue the reverse index update for a position on an existing pipeline:
+    open positions are added to their ticker's set, flat ones removed. The ticker joins
+    'held_tickers' with its first open position and leaves it when its last one closes.
+    """
+    global _index_position_script
+    if _index_position_script is None:
+        _index_position_script = pipe.register_script(INDEX_POSITION_SCRIPT)
+    ticker = position_key.split("/", 1)[1].upper()
+    _index_position_script(keys=[positions_by_ticker_key(ticker), HELD_TICKERS_SET],
+                           args=[position_key, ticker, 1 if open_quantity else 0], client=pipe)
+
+
+def publish_live_prices(r, prices: dict) -> int:
+    """
+    Write live prices ('AAPL:Live') and publish the ones that moved to the price-change stream.
+    SET ... GET returns the previous value in the same round trip, so detecting a change costs
+    nothing extra; unchanged prices produce no event.
+
+    :param r: Redis client.
+    :param prices: {ticker: price}
+    :return: Number of tickers whose price changed.
+    """
+    if not prices:
+        return 0
+
+    tickers = list(prices.keys())
+    new_values = [f"{float(prices[ticker]):.2f}" for ticker in tickers]
+
+    pipe = r.pipeline(transaction=False)
+    for ticker, value in zip(tickers, new_values):
+        pipe.set(f"{ticker}:Live", value, get=True)
+    old_values = pipe.execute()
+
+    pipe = r.pipeline(transaction=False)
+    changed = 0
+    for ticker, old_value, new_value in zip(tickers, old_values, new_values):
+        if old_value == new_value:
+            continue
+        pipe.xadd(
+            PRICE_CHANGES_STREAM,
+            {"ticker": ticker, "old": old_value or "", "new": new_value},
+            maxlen=PRICE_CHANGES_MAXLEN,
+            approximate=True
+        )
+        changed += 1
+    if changed:
+        pipe.execute()
+    return changed
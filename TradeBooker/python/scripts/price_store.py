@@ -0,0 +1,141 @@
+import os
+import datetime
+import threading
+import numpy as np
+from typing import Dict, Iterable, Optional
+
+# Local columnar store of daily closes: one .npy file per ticker holding a structured array
+# of (day, close) sorted by day, where day counts days since 1970-01-01. Files are written
+# by the market-data updater and memory-mapped read-only by readers, so lookups are a binary
+# search over a mapped array with no network or Redis round trip.
+PRICE_STORE_DIR = os.environ.get("PRICE_STORE_DIR", "data/price_store")
+CLOSE_DTYPE = np.dtype([("day", "<i4"), ("close", "<f8")])
+EPOCH = datetime.date(1970, 1, 1)
+
+# ticker -> (file mtime, memory-mapped array); reopened when the writer replaces the file
+_mapped = {}
+_mapped_lock = threading.Lock()
+
+
+def to_day(date) -> int:
+    """datetime.date / datetime / 'YYYY-MM-DD' -> days since 1970-01-01"""
+    if isinstance(date, str):
+        date = datetime.date.fromisoformat(date[:10])
+    elif isinstance(date, datetime.datetime):
+        date = date.date()
+    return (date - EPOCH).days
+
+
+def from_day(day: int) -> str:
+    return (EPOCH + datetime.timedelta(days=int(day))).isoformat()
+
+
+def ticker_path(ticker: str, store_dir: str = None) -> str:
+    return os.path.join(store_dir or PRICE_STORE_DIR, f"{ticker.upper()}.npy")
+
+
+def load_closes(ticker: str, store_dir: str = None) -> Optional[np.ndarray]:
+    """
+    Returns the ticker's (day, close) array memory-mapped read-only, or None if it isn't stored.
+    The mapping is cached and only reopened when the file has been replaced.
+    """
+    path = ticker_path(ticker, store_dir)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    cached = _mapped.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with _mapped_lock:
+        closes = np.load(path, mmap_mode="r")
+        _mapped[path] = (mtime, closes)
+    return closes
+
+
+def write_closes(ticker: str, close_prices, store_dir: str = None) -> int:
+    """
+    Merge a pandas Series of closes (indexed by date) into the ticker's file. New values win on
+    overlapping days. The file is replaced atomically so readers never see a partial write.
+
+    :return: Number of days stored for the ticker.
+    """
+    close_prices = close_prices.dropna()
+    if close_prices.empty:
+        return 0
+
+    new = np.empty(len(close_prices), dtype=CLOSE_DTYPE)
+    new["day"] = [to_day(index) for index in close_prices.index]
+    new["close"] = np.round(close_prices.to_numpy(dtype=np.float64), 2)
+
+    existing = load_closes(ticker, store_dir)
+    if existing is not None and len(existing):
+        # Keep existing days the new data doesn't cover
+        keep = ~np.isin(existing["day"], new["day"])
+        new = np.concatenate([np.asarray(existing[keep]), new])
+
+    merged = new[np.argsort(new["day"], kind="stable")]
+
+    store_dir = store_dir or PRICE_STORE_DIR
+    os.makedirs(store_dir, exist_ok=True)
+    path = ticker_path(ticker, store_dir)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, merged)
+    os.replace(tmp_path, path)
+    return len(merged)
+
+
+def get_close_on_or_before(ticker: str, date, store_dir: str = None) -> Optional[float]:
+    """Close of the last trading day on or before the date, or None if the store doesn't reach back that far."""
+    closes = load_closes(ticker, store_dir)
+    if closes is None or not len(closes):
+        return None
+    idx = np.searchsorted(closes["day"], to_day(date), side="right") - 1
+    return float(closes["close"][idx]) if idx >= 0 else None
+
+
+def get_closes_for_dates(ticker: str, dates: Iterable[str], store_dir: str = None) -> Dict[str, float]:
+    """
+    Closes for calendar dates, carrying the previous trading day's close over non-trading days.
+    Only dates within the stored span are answered; anything outside it is left out.
+    """
+    closes = load_closes(ticker, store_dir)
+    if closes is None or not len(closes):
+        return {}
+
+    dates = list(dates)
+    days = np.array([to_day(date) for date in dates], dtype=np.int32)
+    idx = np.searchsorted(closes["day"], days, side="right") - 1
+    covered = (idx >= 0) & (days <= closes["day"][-1])
+    return {date: float(closes["close"][i]) for date, i, ok in zip(dates, idx, covered) if ok}
+
+
+def get_lookback_close(ticker: str, trading_days_back: int, store_dir: str = None) -> Optional[float]:
+    """Close from N trading days before the latest stored day (the earliest stored close if the history is shorter)."""
+    closes = load_closes(ticker, store_dir)
+    if closes is None or not len(closes):
+        return None
+    if len(closes) > trading_days_back:
+        return float(closes["close"][-(trading_days_back + 1)])
+    return float(closes["close"][0])
+
+
+def get_first_close_of_year(ticker: str, year: int, store_dir: str = None) -> Optional[float]:
+    closes = load_closes(ticker, store_dir)
+    if closes is None or not len(closes):
+        return None
+    idx = np.searchsorted(closes["day"], to_day(datetime.date(year, 1, 1)), side="left")
+    if idx >= len(closes) or closes["day"][idx] >= to_day(datetime.date(year + 1, 1, 1)):
+        return None
+    return float(closes["close"][idx])
+
+
+def is_fresh(ticker: str, max_age_days: int = 5, store_dir: str = None) -> bool:
+    """True if the ticker's history runs up to within max_age_days of today, so lookbacks from its end are current."""
+    closes = load_closes(ticker, store_dir)
+    if closes is None or not len(closes):
+        return False
+    return to_day(datetime.date.today()) - int(closes["day"][-1]) <= max_age_days
@@ -0,0 +1,11 @@
+# One-off backfill of the per-account trade index (trades_by_account:<account>) and the 'accounts' set for trades booked before they existed.
+from redis_connection import get_redis_client
+from trade_index import rebuild_trade_index
+
+def main():
+    r = get_redis_client()
+    indexed = rebuild_trade_index(r)
+    print(f"Indexed {indexed} existing trades.")
+
+if __name__ == "__main__":
+    main()
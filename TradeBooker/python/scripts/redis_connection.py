@@ -0,0 +1,79 @@
+import os
+import logging
+import threading
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError, TimeoutError
+from redis.retry import Retry
+from redis.sentinel import Sentinel
+
+logger = logging.getLogger(__name__)
+
+# Sentinel configuration shared by every service
+SENTINELS = [("sentinel1", 26379), ("sentinel2", 26379), ("sentinel3", 26379)]
+SERVICE_NAME = "mymaster"  # matches the sentinel config
+
+# Upper bound on open connections per client (i.e. per process and configuration)
+MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 50))
+SOCKET_CONNECT_TIMEOUT = 2  # Fail fast on a dead master so the retry can rediscover the new one
+SENTINEL_SOCKET_TIMEOUT = 0.5
+HEALTH_CHECK_INTERVAL = 30
+
+# Retry with exponential backoff (50ms doubling up to 2s) across a failover, roughly 5s in total
+RETRIES = 6
+BACKOFF_BASE = 0.05
+BACKOFF_CAP = 2
+
+_sentinels = {}
+_clients = {}
+_lock = threading.Lock()
+
+
+def _get_sentinel(sentinels: tuple) -> Sentinel:
+    sentinel = _sentinels.get(sentinels)
+    if sentinel is None:
+        sentinel = Sentinel(
+            list(sentinels),
+            sentinel_kwargs={"socket_timeout": SENTINEL_SOCKET_TIMEOUT, "socket_connect_timeout": SENTINEL_SOCKET_TIMEOUT}
+        )
+        _sentinels[sentinels] = sentinel
+    return sentinel
+
+
+def get_redis_client(decode_responses=True, socket_timeout=None, sentinels=None, service_name=SERVICE_NAME):
+    """
+    Returns the process-wide client for the Sentinel-managed master.
+
+    Clients are cached per configuration, so every caller with the same settings shares one
+    bounded connection pool. Master discovery only happens when the pool opens a connection,
+    not per command, and a failover surfaces as a connection error that is retried with
+    backoff on a fresh connection to the newly promoted master.
+
+    :param decode_responses: Return str instead of bytes.
+    :param socket_timeout: Read timeout in seconds; None for clients that block on stream reads.
+    :param sentinels: Sentinel (host, port) pairs, defaults to SENTINELS.
+    :param service_name: Name of the monitored master.
+    """
+    sentinels = tuple(sentinels or SENTINELS)
+    key = (sentinels, service_name, decode_responses, socket_timeout)
+
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _get_sentinel(sentinels).master_for(
+                service_name,
+                decode_responses=decode_responses,
+                socket_timeout=socket_timeout,
+                socket_connect_timeout=SOCKET_CONNECT_TIMEOUT,
+                socket_keepalive=True,
+                health_check_interval=HEALTH_CHECK_INTERVAL,
+                max_connections=MAX_CONNECTIONS,
+                retry=Retry(ExponentialBackoff(cap=BACKOFF_CAP, base=BACKOFF_BASE), RETRIES),
+                retry_on_error=[ConnectionError, TimeoutError]
+            )
+            _clients[key] = client
+            logger.info(f"Created pooled Redis client for '{service_name}' (max {MAX_CONNECTIONS} connections)")
+    return client
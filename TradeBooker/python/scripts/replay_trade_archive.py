@@ -0,0 +1,47 @@
+# Replays archived 'trades_stream' entries (see stream_retention.py) through the booker.
+# Booking is keyed on the original entry IDs, so trades that are still booked are skipped and
+# only missing ones are written back. Without --book it only counts what is in the range.
+# Usage: python3 scripts/replay_trade_archive.py [FROM_ID] [TO_ID] [--book]
+import sys
+from stream_retention import read_archive
+from trade_stream import decode_trade_entry
+
+BATCH_SIZE = 1000
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    start_id = args[0] if len(args) > 0 else None
+    end_id = args[1] if len(args) > 1 else None
+
+    if "--book" not in sys.argv:
+        count = sum(len(decode_trade_entry(fields)) for _, fields in read_archive(start_id=start_id, end_id=end_id))
+        print(f"{count} archived trades in range. Pass --book to book the missing ones.")
+        return
+
+    from trade_booker import TradeBooker, parse_trade_entry
+    booker = TradeBooker(consumer_name="booker-replay")
+
+    replayed = 0
+    booked = 0
+    batch = []
+    for entry_id, fields in read_archive(start_id=start_id, end_id=end_id):
+        try:
+            batch.extend(parse_trade_entry(entry_id, fields))
+        except Exception as e:
+            print(f"Skipping malformed entry {entry_id}: {e}")
+            continue
+        if len(batch) >= BATCH_SIZE:
+            booked += booker.book_trades(batch)
+            replayed += len(batch)
+            batch = []
+            print(f"\rReplayed {replayed} trades...", end='', flush=True)
+
+    if batch:
+        booked += booker.book_trades(batch)
+        replayed += len(batch)
+
+    print(f"\nReplayed {replayed} trades, {booked} of them were missing and have been booked.")
+
+if __name__ == "__main__":
+    main()
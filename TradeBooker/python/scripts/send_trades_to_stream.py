@@ -5,7 +5,14 @@ import time
 from multiprocessing import Process
 import logging
 import sys
-from redis.sentinel import Sentinel  # For Sentinel-based Redis connection
+try:
+    from .redis_connection import get_redis_client
+    from .trade_codec import make_trade, parse_trade_string
+    from .trade_stream import TRADES_STREAM, TradeStreamProducer, encode_trade_batch
+except ImportError:
+    from redis_connection import get_redis_client
+    from trade_codec import make_trade, parse_trade_string
+    from trade_stream import TRADES_STREAM, TradeStreamProducer, encode_trade_batch
 import yfinance as yf
 # import redis  # For direct Redis connection
 
@@ -13,13 +20,8 @@ import yfinance as yf
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-sentinel = Sentinel(
-    [('sentinel1', 26379), ('sentinel2', 26379), ('sentinel3', 26379)],
-    socket_timeout=None,
-    decode_responses=True
-)
-
-r = sentinel.master_for("mymaster", socket_timeout=None, decode_responses=True)
+# Shared pooled connection to the Sentinel-managed master
+r = get_redis_client()
 
 # --- Direct localhost Redis connection ---
 # r = redis.Redis(host='localhost', port=6379, decode_responses=True)
@@ -32,7 +34,7 @@ action_type = "trade"
 #name_counter = 0  # global counter
 
 
-def book_random_trade_to_stream(r):
+def random_trade():
     #account = random.choice(accounts)
     global name_counter
     base_name = random.choice(accounts)
@@ -45,18 +47,17 @@ def book_random_trade_to_stream(r):
     realistic_pricing: bool = False
 
 
-    trade_string = f"{base_name},{ticker}:{price}:{trade_type}:{quantity}:{action_type}"
+    return make_trade(base_name, ticker, price, trade_type, quantity, action_type)
 
-    r.xadd("trades_stream", {
-        "trade_string": trade_string
-    })
+
+def book_random_trade_to_stream(r):
+    r.xadd(TRADES_STREAM, encode_trade_batch([random_trade()]))
 
     #print(f"📤 Booked trade: {trade_string}")
 
 def book_custom_trade_to_stream(trade_string, r):
-    r.xadd("trades_stream", {
-        "trade_string": trade_string
-    })
+    # A single manual trade goes out right away as a one-trade batch; an invalid trade raises here
+    r.xadd(TRADES_STREAM, encode_trade_batch([parse_trade_string(trade_string)]))
 
     return True
 
@@ -75,7 +76,7 @@ def book_trades_in_batches(
         start_time=None
 ):
     """
-    Generates and books a precise number of realistic trades in batches.
+    Generates and books a precise number of realistic trades, sent as multi-trade stream entries.
     """
     if num_trades <= 0 or not all([accounts, tickers, trade_types]):
         logger.error("Invalid parameters for trade generation.")
@@ -112,7 +113,7 @@ def book_trades_in_batches(
     # --- END: MODIFIED PRICE FETCHING LOGIC ---
 
     num_generated = 0
-    pipe = r.pipeline(transaction=False)
+    producer = TradeStreamProducer(r)
     min_qty, max_qty = quantity_range
     action = "trade"
 
@@ -150,18 +151,13 @@ def book_trades_in_batches(
             # Fallback to the user-defined price range from the sliders
             price = round(random.uniform(price_range[0], price_range[1]), 2)
 
-        trade_string = f"{account},{ticker}:{price}:{trade_type}:{quantity}:{action}"
-        pipe.xadd("trades_stream", {"trade_string": trade_string})
+        producer.send(make_trade(account, ticker, price, trade_type, quantity, action))
         num_generated += 1
 
-        if num_generated % batch_size == 0:
-            pipe.execute()
-            pipe = r.pipeline(transaction=False)
-            if status_container:
-                status_container.update(label=f"Generated {num_generated:,} of {num_trades:,} trades...")
+        if num_generated % batch_size == 0 and status_container:
+            status_container.update(label=f"Generated {num_generated:,} of {num_trades:,} trades...")
 
-    if num_generated % batch_size != 0:
-        pipe.execute()
+    producer.close()
 
     return num_generated
 
@@ -186,10 +182,11 @@ def print_all_past_trades():
             break
 
 def run_instance():
-        for _ in range(5):  # 50k trades
-            for _ in range(10000):  # 10k trades
-                book_random_trade_to_stream(r)
-            print("booked 10k trades stream.", flush=True)
+        with TradeStreamProducer(r) as producer:
+            for _ in range(5):  # 50k trades
+                for _ in range(10000):  # 10k trades
+                    producer.send(random_trade())
+                print("booked 10k trades stream.", flush=True)
 
 if __name__ == "__main__":
     try:
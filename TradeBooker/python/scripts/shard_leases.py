@@ -0,0 +1,137 @@
+import math
+import time
+import uuid
+import random
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Dynamic assignment of virtual shards to worker processes through Redis leases.
+# A worker owns a shard while it holds 'pnl_shard_lease:<shard>' (SET NX PX, value = its token)
+# and keeps it by renewing before the TTL runs out. Workers heartbeat into 'pnl_workers', and each
+# aims for a fair share of ceil(shards / live workers): it takes free shards while under it and
+# hands extras back while over it, so shards spread out as workers start and move to the
+# survivors when one dies (its leases simply expire).
+LEASE_PREFIX = "pnl_shard_lease:"
+WORKERS_ZSET = "pnl_workers"
+LEASE_TTL_MS = 15000
+RENEW_INTERVAL = 5  # seconds; a few renewals fit inside one TTL
+WORKER_TTL = 15  # A worker missing its heartbeats this long stops counting towards the fair share
+
+# Only touch the lease while it is still ours
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def lease_key(shard) -> str:
+    """Generate the lease key in the following format 'pnl_shard_lease:17'"""
+    return f"{LEASE_PREFIX}{shard}"
+
+
+class ShardLeases:
+    """
+    Holds this worker's shard leases. rebalance() is called periodically; the callbacks let the
+    owner start consuming a shard (on_acquire), finish with it before the lease is given back
+    (on_release) and abandon it at once when the lease was lost (on_lost).
+    """
+
+    def __init__(self, redis_client, shards, worker_name: str, on_acquire=None, on_release=None, on_lost=None, renew_lock=None):
+        self.redis = redis_client
+        self.shards = list(shards)
+        self.worker_name = worker_name
+        # Unique per incarnation, so a restarted worker never mistakes its predecessor's leases for its own
+        self.token = f"{worker_name}:{uuid.uuid4().hex[:8]}"
+        self.owned = set()
+
+        self.on_acquire = on_acquire or (lambda shards: None)
+        self.on_release = on_release or (lambda shard: None)
+        self.on_lost = on_lost or (lambda shards: None)
+
+        # Renewing touches the lease keys, which aborts any write that WATCHes them. The owner can pass
+        # the lock its fenced writes hold so its own renewals never collide with them
+        self.renew_lock = renew_lock or threading.Lock()
+
+        self._renew = self.redis.register_script(RENEW_SCRIPT)
+        self._release = self.redis.register_script(RELEASE_SCRIPT)
+
+    def fair_share(self) -> int:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(WORKERS_ZSET, {self.worker_name: time.time()})
+        pipe.zremrangebyscore(WORKERS_ZSET, "-inf", f"({time.time() - WORKER_TTL}")
+        pipe.zcard(WORKERS_ZSET)
+        live_workers = max(1, pipe.execute()[2])
+        return math.ceil(len(self.shards) / live_workers)
+
+    def renew(self):
+        """Extends every owned lease; the ones that expired or were taken over are reported as lost."""
+        owned = sorted(self.owned)
+        pipe = self.redis.pipeline(transaction=False)
+        for shard in owned:
+            self._renew(keys=[lease_key(shard)], args=[self.token, LEASE_TTL_MS], client=pipe)
+        with self.renew_lock:
+            renewed = pipe.execute()
+        lost = {shard for shard, ok in zip(owned, renewed) if not ok}
+        if lost:
+            logger.warning(f"Lost the leases on shards {sorted(lost)}")
+            self.owned -= lost
+            self.on_lost(lost)
+
+    def acquire(self, wanted: int):
+        """Tries the free shards in random order until `wanted` more are held."""
+        candidates = [shard for shard in self.shards if shard not in self.owned]
+        random.shuffle(candidates)
+        acquired = set()
+        for shard in candidates:
+            if len(acquired) >= wanted:
+                break
+            if self.redis.set(lease_key(shard), self.token, nx=True, px=LEASE_TTL_MS):
+                acquired.add(shard)
+        if acquired:
+            logger.info(f"Acquired shards {sorted(acquired)}")
+            self.owned |= acquired
+            self.on_acquire(acquired)
+
+    def release(self, shard):
+        """Lets the owner finish with the shard, then gives the lease back for another worker to take."""
+        self.owned.discard(shard)
+        try:
+            self.on_release(shard)
+        finally:
+            self._release(keys=[lease_key(shard)], args=[self.token])
+        logger.info(f"Released shard {shard}")
+
+    def rebalance(self):
+        self.renew()
+        target = self.fair_share()
+        if len(self.owned) > target:
+            for shard in random.sample(sorted(self.owned), len(self.owned) - target):
+                self.release(shard)
+        elif len(self.owned) < target:
+            self.acquire(target - len(self.owned))
+
+    def release_all(self):
+        for shard in sorted(self.owned):
+            self.release(shard)
+        self.redis.zrem(WORKERS_ZSET, self.worker_name)
+
+    def holds_all(self, shards, client=None) -> bool:
+        """
+        Fencing check before a write: True only if every shard's lease still carries our token.
+        Pass a pipeline that WATCHes the lease keys so the write fails if a lease changes after the check.
+        """
+        shards = sorted(shards)
+        if not shards:
+            return True
+        tokens = (client or self.redis).mget([lease_key(shard) for shard in shards])
+        return all(token == self.token for token in tokens)
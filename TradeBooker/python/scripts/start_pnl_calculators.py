@@ -1,7 +1,9 @@
 import subprocess
 import os
+import sys
 import time
-import string
+import signal
+import socket
 from pathlib import Path
 
 
@@ -20,11 +22,28 @@ def print_colored(message, color):
     print(f"{color}{message}{Colors.NC}")
 
 
+def stop_on_signal(signum, frame):
+    """`docker stop` sends SIGTERM; treat it like Ctrl+C so the workers are stopped gracefully."""
+    raise KeyboardInterrupt
+
+
+def start_worker(worker_script, worker_name, log_dir):
+    log_file_path = os.path.join(log_dir, f"{worker_name}.log")
+    with open(log_file_path, 'a') as log_file:
+        return subprocess.Popen(
+            ["python", worker_script, worker_name],
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            cwd=os.getcwd()
+        )
+
+
 def main():
+    # Usage: python scripts/start_pnl_calculators.py [PROCESSES]   (default: PNL_WORKER_PROCESSES or one per core)
     WORKER_SCRIPT = "scripts/pnl_calculator.py"
-    LISTENER_SCRIPT = "scripts/notification_listener.py"
     LOG_DIR = "logs"
     PID_FILE = os.path.join(LOG_DIR, "pnl_pids.txt")
+    num_workers = int(sys.argv[1] if len(sys.argv) > 1 else os.environ.get("PNL_WORKER_PROCESSES", os.cpu_count() or 1))
 
     # Create a logs directory if it doesn't exist
     Path(LOG_DIR).mkdir(exist_ok=True)
@@ -32,81 +51,56 @@ def main():
     # Clear the previous PID file
     open(PID_FILE, 'w').close()
 
-    # Check if scripts exist
-    for script in [WORKER_SCRIPT, LISTENER_SCRIPT]:
-        if not os.path.isfile(script):
-            print_colored(f"❌ Error: {script} not found in current directory", Colors.RED)
-            return 1
-
-    # --- 1. Start the Notification Listener ---
-    print_colored("🚀 Starting the central Notification Listener...", Colors.PURPLE)
-    listener_log_path = os.path.join(LOG_DIR, "notification_listener.log")
-    try:
-        with open(listener_log_path, 'w') as log_file:
-            listener_process = subprocess.Popen(
-                ["python", LISTENER_SCRIPT],
-                stdout=log_file,
-                stderr=subprocess.STDOUT,
-                cwd=os.getcwd()
-            )
-        with open(PID_FILE, 'a') as pid_file:
-            pid_file.write(f"listener:{listener_process.pid}\n")
-        print_colored(f"✅ Started Notification Listener (PID: {listener_process.pid})", Colors.GREEN)
-        print_colored(f"📋 Logs available in: {listener_log_path}", Colors.BLUE)
-    except Exception as e:
-        print_colored(f"❌ Failed to start the Notification Listener: {e}", Colors.RED)
+    # Check if the worker script exists
+    if not os.path.isfile(WORKER_SCRIPT):
+        print_colored(f"❌ Error: {WORKER_SCRIPT} not found in current directory", Colors.RED)
         return 1
 
-    print()
-    time.sleep(1)  # Give the listener a moment to initialize
-
-    # --- 2. Start the 26 PnL Worker instances ---
-    print_colored("🚀 Starting 26 PnL Worker instances...", Colors.BLUE)
+    # Workers take the booked_trades:<shard> streams through Redis leases, so any number of them
+    # (on this host or others) split the virtual shards evenly and pick up a dead worker's shards.
+    # Names are stable per slot, so a restarted worker reuses its consumer in the PnL group.
+    print_colored(f"🚀 Starting {num_workers} PnL Worker processes...", Colors.BLUE)
+    host = socket.gethostname()
     processes = {}
 
-    for letter in string.ascii_lowercase:
-        print_colored(f"📊 Starting PnL Worker for shard '{letter.upper()}'", Colors.YELLOW)
-
-        log_file_path = os.path.join(LOG_DIR, f"pnl_worker_{letter}.log")
-
+    for slot in range(num_workers):
+        worker_name = f"pnl-{host}-{slot}"
         try:
-            with open(log_file_path, 'w') as log_file:
-                process = subprocess.Popen(
-                    ["python", WORKER_SCRIPT, letter],  # Pass only the single letter
-                    stdout=log_file,
-                    stderr=subprocess.STDOUT,
-                    cwd=os.getcwd()
-                )
-
-            processes[letter] = process
-
+            processes[worker_name] = start_worker(WORKER_SCRIPT, worker_name, LOG_DIR)
             with open(PID_FILE, 'a') as pid_file:
-                pid_file.write(f"worker_{letter}:{process.pid}\n")
-
-            print_colored(f"✅ Started worker for shard '{letter}' (PID: {process.pid})", Colors.GREEN)
-            time.sleep(0.1)
-
+                pid_file.write(f"{worker_name}:{processes[worker_name].pid}\n")
+            print_colored(f"✅ Started {worker_name} (PID: {processes[worker_name].pid})", Colors.GREEN)
         except Exception as e:
-            print_colored(f"❌ Failed to start worker for shard '{letter}': {e}", Colors.RED)
+            print_colored(f"❌ Failed to start {worker_name}: {e}", Colors.RED)
 
     print()
-    print_colored("🎉 Successfully launched 1 Listener and 26 Worker processes!", Colors.GREEN)
+    print_colored(f"🎉 Launched {len(processes)} Worker processes!", Colors.GREEN)
     print_colored(f"📝 Process IDs saved to: {PID_FILE}", Colors.BLUE)
-    print_colored("To stop all instances, you will need to create a corresponding stop script.", Colors.YELLOW)
 
-    # This infinite loop prevents the script from exiting, keeping the container alive.
+    # Keep the container alive and restart any worker that dies; its shards move to the others meanwhile
     try:
         while True:
-            # Sleep for a long interval to consume minimal CPU.
-            # The script's only job now is to exist.
-            time.sleep(60)
-            # You could add logic here to check if the child processes are still running
+            time.sleep(10)
+            for worker_name, process in processes.items():
+                if process.poll() is not None:
+                    print_colored(f"⚠️ {worker_name} exited with code {process.returncode}, restarting", Colors.YELLOW)
+                    processes[worker_name] = start_worker(WORKER_SCRIPT, worker_name, LOG_DIR)
     except KeyboardInterrupt:
-        print_colored("\nMonitoring stopped.", Colors.BLUE)
-    # --- END OF ADDED LOOP ---
+        print_colored("\nStopping workers...", Colors.BLUE)
+    finally:
+        # SIGINT lets each worker flush and hand its shard leases back before exiting
+        for process in processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in processes.values():
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
 
     return 0
 
 
 if __name__ == "__main__":
-    exit(main())
\ No newline at end of file
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    exit(main())
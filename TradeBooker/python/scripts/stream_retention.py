@@ -0,0 +1,212 @@
+import os
+import sys
+import gzip
+import json
+import base64
+import time
+import logging
+from typing import Iterator, List, Optional, Tuple
+from redis_connection import get_redis_client
+from trade_events import AGGREGATOR_GROUP, PNL_GROUP, SHARDS, booked_trades_stream
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Retention for 'trades_stream': once every consumer group has acknowledged an entry it is only
+# dead weight in Redis memory (the booked trade lives on as its own hash), so entries below the
+# oldest one any group still needs are appended to gzipped segment files on disk and then
+# trimmed with XTRIM MINID. Segments are JSON lines of {"id", "fields", "encoding"} named
+# '<first id>_<last id>.jsonl.gz', so the archive is ordered and resumable from the file names
+# alone, and read_archive() streams them back for replay. Field values are base64, since trade
+# payloads are binary (see trade_codec.py); segments written before that hold plain strings.
+# The per-shard 'booked_trades:<shard>' streams are only derived events (every trade lives on as
+# its hash), so their acknowledged entries are trimmed without being archived.
+TRADES_STREAM = "trades_stream"
+TRADE_ARCHIVE_DIR = os.environ.get("TRADE_ARCHIVE_DIR", "data/trade_archive")
+RETENTION_INTERVAL = 60  # seconds
+READ_BATCH_SIZE = 1000
+SEGMENT_MAX_ENTRIES = 100000
+
+StreamId = Tuple[int, int]
+
+
+def parse_id(entry_id: str) -> StreamId:
+    """'1718000000000-5' -> (1718000000000, 5)"""
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+def format_id(stream_id: StreamId) -> str:
+    return f"{stream_id[0]}-{stream_id[1]}"
+
+
+def next_id(entry_id: str) -> StreamId:
+    ms, seq = parse_id(entry_id)
+    return ms, seq + 1
+
+
+def safe_trim_id(r, stream_key: str = TRADES_STREAM) -> Optional[str]:
+    """
+    The smallest entry ID some consumer group may still need: its oldest pending entry, or the one
+    after the last it was delivered. Everything below it has been acknowledged by every group.
+    Returns None if the stream has no groups, since nothing has consumed it.
+    """
+    groups = r.xinfo_groups(stream_key)
+    if not groups:
+        return None
+    bounds = []
+    for group in groups:
+        pending = r.xpending(stream_key, group["name"])
+        if pending["pending"]:
+            bounds.append(parse_id(pending["min"]))
+        else:
+            bounds.append(next_id(group["last-delivered-id"]))
+    return format_id(min(bounds))
+
+
+def segment_dir(stream_key: str = TRADES_STREAM, archive_dir: str = None) -> str:
+    return os.path.join(archive_dir or TRADE_ARCHIVE_DIR, stream_key)
+
+
+def list_segments(stream_key: str = TRADES_STREAM, archive_dir: str = None) -> List[Tuple[StreamId, StreamId, str]]:
+    """(first id, last id, path) of every segment, oldest first."""
+    directory = segment_dir(stream_key, archive_dir)
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for name in os.listdir(directory):
+        if not name.endswith(".jsonl.gz"):
+            continue
+        first_id, _, last_id = name[:-len(".jsonl.gz")].partition("_")
+        segments.append((parse_id(first_id), parse_id(last_id), os.path.join(directory, name)))
+    return sorted(segments)
+
+
+def last_archived_id(stream_key: str = TRADES_STREAM, archive_dir: str = None) -> Optional[str]:
+    segments = list_segments(stream_key, archive_dir)
+    return format_id(segments[-1][1]) if segments else None
+
+
+def write_segment(directory: str, entries) -> str:
+    """Write entries to a new segment atomically: a crash leaves either the whole file or none of it."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{entries[0][0]}_{entries[-1][0]}.jsonl.gz")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as raw_file:
+        with gzip.GzipFile(fileobj=raw_file, mode="wb") as segment:
+            for entry_id, fields in entries:
+                encoded = {name.decode(): base64.b64encode(value).decode() for name, value in fields.items()}
+                segment.write(json.dumps({"id": entry_id, "fields": encoded, "encoding": "base64"}).encode() + b"\n")
+        raw_file.flush()
+        os.fsync(raw_file.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+def archive_entries(raw, up_to: str, stream_key: str = TRADES_STREAM, archive_dir: str = None) -> int:
+    """Append every entry after the last archived one and below `up_to` to new segments. `raw` must not decode responses."""
+    directory = segment_dir(stream_key, archive_dir)
+    last_id = last_archived_id(stream_key, archive_dir)
+    start = f"({last_id}" if last_id else "-"
+
+    archived = 0
+    buffer = []
+    while True:
+        entries = [(entry_id.decode(), fields)
+                   for entry_id, fields in raw.xrange(stream_key, min=start, max=f"({up_to}", count=READ_BATCH_SIZE)]
+        buffer.extend(entries)
+        if len(buffer) >= SEGMENT_MAX_ENTRIES or (buffer and not entries):
+            write_segment(directory, buffer)
+            archived += len(buffer)
+            buffer = []
+        if not entries:
+            return archived
+        start = f"({entries[-1][0]}"
+
+
+def trim_archived(r, raw, stream_key: str = TRADES_STREAM, archive_dir: str = None) -> int:
+    """
+    Archive the entries every group has acknowledged, then trim them from the stream.
+
+    :return: The number of entries trimmed.
+    """
+    trim_id = safe_trim_id(r, stream_key)
+    if trim_id is None:
+        return 0
+    archived = archive_entries(raw, trim_id, stream_key, archive_dir)
+    if archived:
+        logger.info(f"Archived {archived} entries of '{stream_key}' below {trim_id}")
+
+    # Never trim past what is on disk
+    last_id = last_archived_id(stream_key, archive_dir)
+    if last_id is None:
+        return 0
+    min_id = format_id(min(parse_id(trim_id), next_id(last_id)))
+    return r.xtrim(stream_key, minid=min_id, approximate=False)
+
+
+def trim_booked_trades(r, groups=(AGGREGATOR_GROUP, PNL_GROUP)) -> int:
+    """
+    Trim every shard's booked-trade stream below the oldest entry its consumer groups still need.
+    A stream is left alone until all `groups` exist on it, so a consumer that hasn't started yet
+    still finds every entry when it creates its group.
+
+    :return: The number of entries trimmed.
+    """
+    trimmed = 0
+    for shard in SHARDS:
+        stream_key = booked_trades_stream(shard)
+        if not r.exists(stream_key):
+            continue
+        if not set(groups) <= {group["name"] for group in r.xinfo_groups(stream_key)}:
+            continue
+        trimmed += r.xtrim(stream_key, minid=safe_trim_id(r, stream_key), approximate=False)
+    return trimmed
+
+
+def read_archive(stream_key: str = TRADES_STREAM, start_id: str = None, end_id: str = None,
+                 archive_dir: str = None) -> Iterator[Tuple[str, dict]]:
+    """Yield archived (entry id, fields) in stream order, optionally limited to an inclusive ID range. Fields hold bytes."""
+    start = parse_id(start_id) if start_id else None
+    end = parse_id(end_id) if end_id else None
+    for first, last, path in list_segments(stream_key, archive_dir):
+        if (start and last < start) or (end and first > end):
+            continue
+        with gzip.open(path, "rt") as segment:
+            for line in segment:
+                entry = json.loads(line)
+                entry_id = parse_id(entry["id"])
+                if (start and entry_id < start) or (end and entry_id > end):
+                    continue
+                if entry.get("encoding") == "base64":
+                    fields = {name: base64.b64decode(value) for name, value in entry["fields"].items()}
+                else:
+                    fields = {name: value.encode() for name, value in entry["fields"].items()}
+                yield entry["id"], fields
+
+
+def run(stream_key: str = TRADES_STREAM, interval: int = RETENTION_INTERVAL):
+    r = get_redis_client()
+    raw = get_redis_client(decode_responses=False)
+    logger.info(f"Archiving and trimming '{stream_key}' into {segment_dir(stream_key)} and trimming the booked-trade streams every {interval}s")
+    while True:
+        try:
+            trimmed = trim_archived(r, raw, stream_key)
+            if trimmed:
+                logger.info(f"Trimmed {trimmed} entries from '{stream_key}'")
+            trimmed = trim_booked_trades(r)
+            if trimmed:
+                logger.info(f"Trimmed {trimmed} acknowledged entries from the booked-trade streams")
+        except Exception as e:
+            logger.error(f"Stream retention pass failed: {e}")
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    # Usage: python3 scripts/stream_retention.py [--once]
+    if "--once" in sys.argv:
+        r = get_redis_client()
+        print(f"Trimmed {trim_archived(r, get_redis_client(decode_responses=False))} entries.")
+        print(f"Trimmed {trim_booked_trades(r)} booked-trade entries.")
+    else:
+        run()
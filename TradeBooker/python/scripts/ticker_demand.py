@@ -0,0 +1,48 @@
+import time
+try:
+    from .price_events import HELD_TICKERS_SET, POSITIONS_BY_TICKER_PREFIX
+except ImportError:
+    from price_events import HELD_TICKERS_SET, POSITIONS_BY_TICKER_PREFIX
+
+# Demand signals the market-data refresher uses to split the universe into a hot tier
+# (refreshed on a fast cadence) and a cold tier (slow background cadence):
+#  - held tickers: the 'held_tickers' set. Whatever maintains a ticker's 'positions_by_ticker:<TICKER>'
+#    set (price_events.index_position, the fifo_apply_trade function) adds the ticker with its
+#    first open position and removes it with its last, so reading it is one SMEMBERS.
+#  - viewed tickers: 'ticker_views' sorted set of ticker -> last time someone looked at it.
+TICKER_VIEWS_ZSET = "ticker_views"
+VIEW_TTL_SECONDS = 3600  # A view keeps a ticker hot for an hour
+
+
+def record_ticker_view(r, ticker: str):
+    """Called by the UI when a ticker is shown, so it joins the hot tier."""
+    r.zadd(TICKER_VIEWS_ZSET, {ticker.upper(): time.time()})
+
+
+def get_held_tickers(r) -> set:
+    return r.smembers(HELD_TICKERS_SET)
+
+
+def rebuild_held_tickers(r) -> int:
+    """
+    One-off backfill of 'held_tickers' from the reverse index sets, for positions opened before
+    it was maintained. Walks the keyspace once, so it runs at startup rather than on every pass.
+    """
+    held = [key[len(POSITIONS_BY_TICKER_PREFIX):] for key in r.scan_iter(match=f"{POSITIONS_BY_TICKER_PREFIX}*", count=1000)]
+    if held:
+        r.sadd(HELD_TICKERS_SET, *held)
+    return len(held)
+
+
+def get_viewed_tickers(r, ttl: int = VIEW_TTL_SECONDS) -> set:
+    """Tickers viewed within the TTL; older views are pruned on the way."""
+    cutoff = time.time() - ttl
+    pipe = r.pipeline(transaction=False)
+    pipe.zremrangebyscore(TICKER_VIEWS_ZSET, "-inf", f"({cutoff}")
+    pipe.zrange(TICKER_VIEWS_ZSET, 0, -1)
+    return set(pipe.execute()[1])
+
+
+def get_hot_tickers(r) -> set:
+    """Held and recently viewed tickers."""
+    return get_held_tickers(r) | get_viewed_tickers(r)
@@ -1,9 +1,12 @@
 import redis
-from redis.sentinel import Sentinel
 import socket
-import uuid
 import logging
 from Trade import Trade
+from trade_index import index_trade
+from trade_events import emit_booked_trade
+from trade_codec import StreamTrade, parse_trade_string
+from trade_stream import decode_trade_entry, is_single_trade_entry
+from redis_connection import get_redis_client
 import time
 from datetime import datetime
 import sys
@@ -16,25 +19,110 @@ import threading
 # Timezone Configuration
 EST = ZoneInfo("America/New_York")
 
+# Pending-entry reclaim: a message a booker read but hasn't acked after CLAIM_IDLE_MS is taken
+# over by another booker (its owner died or hung). Booking is idempotent, so claiming an entry a
+# slow booker is still working on is harmless.
+RECLAIM_INTERVAL = 5  # seconds
+CLAIM_IDLE_MS = 10000
+CLAIM_BATCH_SIZE = 1000
+# Consumers with nothing pending that haven't read for this long are removed from the group
+DEAD_CONSUMER_IDLE_MS = 10 * 60 * 1000
+# Trades written per MULTI/EXEC; batch entries are never split across transactions
+BOOK_BATCH_SIZE = 1000
+
+# DELCONSUMER discards the consumer's pending entries, so only delete it while it still has none
+DELETE_IDLE_CONSUMER_SCRIPT = """
+if #redis.call('XPENDING', KEYS[1], ARGV[1], '-', '+', 1, ARGV[2]) == 0 then
+    return redis.call('XGROUP', 'DELCONSUMER', KEYS[1], ARGV[1], ARGV[2])
+end
+return -1
+"""
+
 # Set up logging configuration:
 os.makedirs("logs/booker_logs", exist_ok=True) #ensure a logs file exists
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)  # Use module name as logger name
 
+def default_consumer_name() -> str:
+    """Stable across restarts of the same container, so a restarted booker picks up its own pending entries."""
+    return f"booker-{socket.gethostname()}"
+
+
+def trade_id_for_message(msg_id: str, index: int = None) -> str:
+    """
+    The trade ID is the stream entry ID ('1718000000000-0'), plus the trade's position for trades
+    in a batch entry ('1718000000000-0-3'), so every delivery of a message names the same trades.
+    """
+    return msg_id if index is None else f"{msg_id}-{index}"
+
+
+def parse_trade_entry(msg_id: str, fields: dict) -> list:
+    """
+    Parse every trade carried by a 'trades_stream' entry (see trade_stream.py). Invalid trades
+    in a legacy string batch are logged and skipped; a malformed entry raises.
+    """
+    trades = decode_trade_entry(fields)
+    if is_single_trade_entry(fields):
+        # Single-trade entries keep the plain entry ID as their trade ID
+        return [parse_trade_message(msg_id, parse_trade_string(trades[0]))]
+
+    parsed = []
+    for index, trade in enumerate(trades):
+        try:
+            if isinstance(trade, str):
+                trade = parse_trade_string(trade)
+            parsed.append(parse_trade_message(msg_id, trade, index))
+        except Exception as e:
+            logger.error(f"Failed to process trade {index} of message {msg_id}: {e}")
+    return parsed
+
+
+def parse_trade_message(msg_id: str, trade: StreamTrade, index: int = None):
+    """
+    Turn a trade from a 'trades_stream' message into (msg_id, trade key, trade hash, booked_at timestamp).
+
+    The booking time is the entry ID's millisecond timestamp rather than the clock at processing
+    time, so redelivery and replay produce exactly the same key and fields.
+    """
+    # Use timezone-aware time
+    booked_at = int(msg_id.split("-", 1)[0]) / 1000
+    booked_time = datetime.fromtimestamp(booked_at, EST)
+    trade_time = booked_time.strftime("%H:%M:%S") # Will be in EST
+    trade_date = booked_time.strftime('%Y-%m-%d') # Will be in EST
+    trade_id = trade_id_for_message(msg_id, index)
+
+    key = f"{trade.account},{trade.ticker}:{trade_date}:{trade_id}"
+
+    hash_data = {
+        "account": trade.account,
+        "trade_date": trade_date,
+        "trade_time": trade_time,
+        "ticker": trade.ticker,
+        "price": str(trade.price),
+        "type": trade.side,
+        "quantity": str(trade.quantity),
+        "action_type": trade.action_type
+    }
+    return msg_id, key, hash_data, booked_at
+
+
+def decode_entries(entries) -> list:
+    """Entries read with the raw client carry bytes IDs; the booker works with str IDs."""
+    return [(msg_id.decode() if isinstance(msg_id, bytes) else msg_id, fields) for msg_id, fields in entries]
+
+
 class TradeBooker:
-    def __init__(self, stream_key="trades_stream", position_hash="positions", consumer_group="booker-group"):
-        # Connect using Sentinel
-        sentinel = Sentinel(
-            [('sentinel1', 26379), ('sentinel2', 26379), ('sentinel3', 26379)],
-            socket_timeout=None,
-            decode_responses=True
-        )
-        self.redis = sentinel.master_for("mymaster", socket_timeout=None, decode_responses=True)
+    def __init__(self, stream_key="trades_stream", position_hash="positions", consumer_group="booker-group", consumer_name=None):
+        # Shared pooled connection to the Sentinel-managed master
+        self.redis = get_redis_client()
+        # Stream payloads are binary (see trade_codec.py), so the stream itself is read without decoding
+        self.raw_redis = get_redis_client(decode_responses=False)
 
         self.stream_key = stream_key
         self.group = consumer_group
 
-        self.consumer = f"booker-consumer-{uuid.uuid4()}"
+        self.consumer = consumer_name or default_consumer_name()
+        self._delete_idle_consumer = self.redis.register_script(DELETE_IDLE_CONSUMER_SCRIPT)
 
         logger.info(f"My consumer name is: {self.consumer}")
         logger.info("Connected to Redis via Sentinel: my-master")
@@ -52,9 +140,136 @@ class TradeBooker:
                 logger.error(f"Failed to create consumer group: {e}")
                 raise
 
+    def book_trades(self, trades, msg_ids=None) -> int:
+        """
+        Book a batch of parsed trades exactly once and ack their messages (or `msg_ids`, when given).
+
+        Trade keys come from the stream entry IDs, so a redelivered or replayed message maps to the
+        key it was booked under the first time. The keys are WATCHed and checked, then every new
+        trade is written in one MULTI/EXEC together with the acks: either all of a batch lands or
+        none of it does, and if another booker books one of the same messages in between, the
+        transaction aborts and is retried against what is now there.
+
+        :return: The number of trades newly booked.
+        """
+        if msg_ids is None:
+            msg_ids = list(dict.fromkeys(msg_id for msg_id, _, _, _ in trades))
+        if not trades:
+            if msg_ids:
+                self.redis.xack(self.stream_key, self.group, *msg_ids)
+            return 0
+        keys = [key for _, key, _, _ in trades]
+        while True:
+            with self.redis.pipeline(transaction=True) as pipe:
+                try:
+                    pipe.watch(*keys)
+                    # WATCH guards the keys whichever connection reads them, so check them in one round trip
+                    exists_pipe = self.redis.pipeline(transaction=False)
+                    for key in keys:
+                        exists_pipe.exists(key)
+                    booked = {key for key, exists in zip(keys, exists_pipe.execute()) if exists}
+                    pipe.multi()
+                    new_trades = 0
+                    for msg_id, key, hash_data, booked_at in trades:
+                        if key not in booked:
+                            pipe.hset(key, mapping=hash_data)
+                            index_trade(pipe, hash_data["account"], key, booked_at)
+                            emit_booked_trade(pipe, key, hash_data)
+                            pipe.sadd("accounts", hash_data["account"])
+                            pipe.incr("total_trades_booked")
+                            new_trades += 1
+                    if msg_ids:
+                        pipe.xack(self.stream_key, self.group, *msg_ids)
+                    pipe.execute()
+                except redis.WatchError:
+                    logger.info("A trade in the batch was booked concurrently, retrying")
+                    continue
+            duplicates = len(trades) - new_trades
+            if duplicates:
+                logger.info(f"Skipped {duplicates} already booked trades")
+            return new_trades
+
+    def book_entries(self, entries) -> int:
+        """
+        Parse and book stream entries, about BOOK_BATCH_SIZE trades per transaction.
+        Malformed messages are logged and acked with the rest so they don't come back.
+        """
+        booked = 0
+        trades = []
+        msg_ids = []
+        for msg_id, fields in decode_entries(entries):
+            msg_ids.append(msg_id)
+            if not fields:
+                # Trimmed from the stream while pending; nothing left to book
+                continue
+            try:
+                trades.extend(parse_trade_entry(msg_id, fields))
+            except Exception as e:
+                logger.error(f"Failed to process message {msg_id}: {e}")
+            if len(trades) >= BOOK_BATCH_SIZE:
+                booked += self.book_trades(trades, msg_ids)
+                trades = []
+                msg_ids = []
+        if msg_ids:
+            booked += self.book_trades(trades, msg_ids)
+        return booked
+
+    def book_own_pending(self) -> int:
+        """Book whatever was delivered to this consumer name before a restart and never acked."""
+        booked = 0
+        while True:
+            messages = self.raw_redis.xreadgroup(groupname=self.group, consumername=self.consumer,
+                                             streams={self.stream_key: '0'}, count=CLAIM_BATCH_SIZE)
+            entries = messages[0][1] if messages else []
+            if not entries:
+                return booked
+            booked += self.book_entries(entries)
+
+    def reclaim_idle_entries(self) -> int:
+        """XAUTOCLAIM every entry idle for CLAIM_IDLE_MS from whichever consumer holds it, and book it."""
+        booked = 0
+        start_id = "0-0"
+        while True:
+            start_id, entries, *_ = self.raw_redis.xautoclaim(self.stream_key, self.group, self.consumer,
+                                                              min_idle_time=CLAIM_IDLE_MS, start_id=start_id,
+                                                              count=CLAIM_BATCH_SIZE)
+            if entries:
+                logger.info(f"Reclaimed {len(entries)} idle pending messages")
+                booked += self.book_entries(entries)
+            if start_id in ("0-0", b"0-0"):
+                return booked
+
+    def prune_dead_consumers(self) -> int:
+        """Delete consumers that have nothing pending and haven't read in DEAD_CONSUMER_IDLE_MS."""
+        pruned = 0
+        for consumer in self.redis.xinfo_consumers(self.stream_key, self.group):
+            name = consumer["name"]
+            if name == self.consumer or consumer["pending"] > 0 or consumer["idle"] < DEAD_CONSUMER_IDLE_MS:
+                continue
+            if self._delete_idle_consumer(keys=[self.stream_key], args=[self.group, name]) != -1:
+                pruned += 1
+        if pruned:
+            logger.info(f"Removed {pruned} dead consumers from '{self.group}'")
+        return pruned
+
+    def _reclaim_loop(self):
+        """Runs in a separate thread, taking over entries stranded by dead bookers and pruning their consumers."""
+        while True:
+            time.sleep(RECLAIM_INTERVAL)
+            try:
+                self.reclaim_idle_entries()
+                self.prune_dead_consumers()
+            except Exception as e:
+                logger.error(f"Error reclaiming pending messages: {e}")
+
     def listen_and_book(self):
         logger.info("Starting to listen and book trades to Redis...")
 
+        recovered = self.book_own_pending()
+        if recovered:
+            logger.info(f"Booked {recovered} messages left pending by this consumer's last run")
+        threading.Thread(target=self._reclaim_loop, daemon=True).start()
+
         #For speed tracking
         self.booked = 0
         self.last_logged_count = 0
@@ -62,7 +277,7 @@ class TradeBooker:
 
         while True:
             try:
-                messages = self.redis.xreadgroup(
+                messages = self.raw_redis.xreadgroup(
                 groupname=self.group,
                 consumername=self.consumer,
                 streams={self.stream_key: '>'},
@@ -71,51 +286,8 @@ class TradeBooker:
                 )
 
                 for stream, entries in messages:
-                    pipe = self.redis.pipeline(transaction=False)
-                    for msg_id, fields in entries:
-                        try:
-                            trade_string = fields["trade_string"]
-                            
-                            #account_id, rest = trade_string.strip().split(',')
-                            #ticker, price, trade_type, quantity, action_type = rest.split(':')
-
-                            # Split on the first colon only — gives you accountID,ticker and the rest
-                            account_comma_ticker_combo, rest = trade_string.split(":", 1)
-
-                            # Split rest of string into remaining fields
-                            price, trade_type, quantity, action_type = rest.split(":")
-
-                            # Use timezone-aware time
-                            now = datetime.now(EST)
-                            trade_time = now.strftime("%H:%M:%S") # Will be in EST
-                            trade_date = now.strftime('%Y-%m-%d') # Will be in EST
-                            trade_id = str(uuid.uuid4())
-                            
-                            key = f"{account_comma_ticker_combo.strip()}:{trade_date}:{trade_id}"
-                            #key = f"{account_id_comma_ticker.strip()}:{trade_date}:{trade_id}"
-                            account, ticker = account_comma_ticker_combo.split(",")
-
-                            hash_data = {
-                                "account": account.strip(),
-                                "trade_date": trade_date,
-                                "trade_time": trade_time,
-                                "ticker": ticker.strip(),
-                                "price": price.strip(),
-                                "type": trade_type.strip().lower(),
-                                "quantity": quantity.strip(),
-                                "action_type": action_type.strip().lower()
-                            }
+                    self.booked += self.book_entries(entries)
 
-                            pipe.hset(key, mapping=hash_data)
-                            pipe.sadd(f"accounts", account.strip())
-                            pipe.incr("total_trades_booked")
-                            pipe.xack(self.stream_key, self.group, msg_id)
-                            self.booked += 1
-                        except Exception as e:
-                            logger.error(f"Failed to process message {msg_id}: {e}")
-                            self.redis.xack(self.stream_key, self.group, msg_id)
-                    pipe.execute()
-            
                     # Log every ~1000 trades
                     if self.booked - self.last_logged_count >= 1000:
                         elapsed = time.time() - self.start_time
@@ -130,19 +302,23 @@ if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1].isdigit():
         num_instances = int(sys.argv[1])
 
-        # Launch N-1 additional bookers as subprocesses
+        # Launch N-1 additional bookers as subprocesses, each with a consumer name of its own
         for i in range(1, num_instances):
             log_file = open(f"logs/booker_logs/booker_log_{i+1}.txt", "w")
             subprocess.Popen(
-                ["python", __file__],
+                ["python", __file__, f"{default_consumer_name()}-{i + 1}"],
                 stdout=log_file,
                 stderr=subprocess.STDOUT
             )
 
         print(f"Launched {num_instances - 1} subprocesses. This process will be instance #{num_instances}.")
+        consumer_name = f"{default_consumer_name()}-1"
+    else:
+        # Launched by another booker or by launch_bookers.py with a consumer name
+        consumer_name = sys.argv[1] if len(sys.argv) > 1 else None
 
     # This process itself becomes the final booker (ensuring this process stays alive, keeping the docker container alive, avoiding killing off all the above subprocceses)
     while True:
-        booker = TradeBooker()
+        booker = TradeBooker(consumer_name=consumer_name)
         booker.listen_and_book()
 
@@ -0,0 +1,111 @@
+import math
+import struct
+from collections import namedtuple
+from typing import Iterable, List
+
+# Binary wire format of the trades producers put on 'trades_stream' (see trade_stream.py).
+# A payload carries a batch of trades:
+#
+#   header   <BHHI   version, account count, ticker count, trade count
+#   strings  for every account, then every ticker: <B length + UTF-8 bytes
+#   records  <HHdIBB per trade: account index, ticker index, price, quantity, side, action type
+#
+# Accounts and tickers are interned per payload, so a batch names each one once and every
+# record is a fixed 18 bytes that unpacks in one call with no splitting, stripping or
+# escaping. The version byte selects the record layout, so a field can be added by
+# defining a new version while bookers keep decoding the old one.
+CODEC_VERSION = 1
+HEADER = struct.Struct("<BHHI")
+STRING_LENGTH = struct.Struct("<B")
+RECORD_FORMATS = {
+    1: struct.Struct("<HHdIBB"),
+}
+
+MAX_STRING_BYTES = 255  # <B length prefix
+MAX_QUANTITY = 2 ** 31 - 1  # The record field is <I, but the PnL lot records hold int32 (lot_book.LOT_RECORD)
+
+SIDES = ("buy", "sell")
+ACTION_TYPES = ("trade", "placeholder")
+
+StreamTrade = namedtuple("StreamTrade", ["account", "ticker", "price", "side", "quantity", "action_type"])
+
+
+def make_trade(account: str, ticker: str, price, side: str, quantity, action_type: str = "trade") -> StreamTrade:
+    """Normalize and validate a trade before it is encoded, so anything it returns is encodable."""
+    trade = StreamTrade(account.strip(), ticker.strip(), float(price), side.strip().lower(),
+                        int(quantity), action_type.strip().lower())
+    if not trade.account or not trade.ticker:
+        raise ValueError("Account and ticker are required")
+    if trade.side not in SIDES:
+        raise ValueError(f"Unknown side '{side}'")
+    if trade.action_type not in ACTION_TYPES:
+        raise ValueError(f"Unknown action type '{action_type}'")
+    for value in (trade.account, trade.ticker):
+        if len(value.encode()) > MAX_STRING_BYTES:
+            raise ValueError(f"'{value[:20]}...' is longer than {MAX_STRING_BYTES} bytes")
+    if not math.isfinite(trade.price):
+        raise ValueError(f"Price must be finite, got {price}")
+    if trade.quantity <= 0:
+        raise ValueError(f"Quantity must be positive, got {quantity}")
+    if trade.quantity > MAX_QUANTITY:
+        raise ValueError(f"Quantity must be at most {MAX_QUANTITY}, got {quantity}")
+    return trade
+
+
+def parse_trade_string(trade_string: str) -> StreamTrade:
+    """Legacy 'account,ticker:price:type:quantity:action' string -> StreamTrade"""
+    # Split on the first colon only — gives you accountID,ticker and the rest
+    account_comma_ticker_combo, rest = trade_string.split(":", 1)
+    account, ticker = account_comma_ticker_combo.split(",")
+    price, trade_type, quantity, action_type = rest.split(":")
+    return make_trade(account, ticker, price, trade_type, quantity, action_type)
+
+
+def _intern(values: Iterable[str]) -> dict:
+    table = {}
+    for value in values:
+        if value not in table:
+            table[value] = len(table)
+    return table
+
+
+def _pack_string(value: str) -> bytes:
+    encoded = value.encode()
+    if len(encoded) > MAX_STRING_BYTES:
+        raise ValueError(f"'{value[:20]}...' is longer than {MAX_STRING_BYTES} bytes")
+    return STRING_LENGTH.pack(len(encoded)) + encoded
+
+
+def encode_trades(trades: List[StreamTrade]) -> bytes:
+    record = RECORD_FORMATS[CODEC_VERSION]
+    accounts = _intern(trade.account for trade in trades)
+    tickers = _intern(trade.ticker for trade in trades)
+
+    parts = [HEADER.pack(CODEC_VERSION, len(accounts), len(tickers), len(trades))]
+    parts.extend(_pack_string(account) for account in accounts)
+    parts.extend(_pack_string(ticker) for ticker in tickers)
+    for trade in trades:
+        parts.append(record.pack(accounts[trade.account], tickers[trade.ticker], trade.price, trade.quantity,
+                                 SIDES.index(trade.side), ACTION_TYPES.index(trade.action_type)))
+    return b"".join(parts)
+
+
+def decode_trades(payload: bytes) -> List[StreamTrade]:
+    version, account_count, ticker_count, trade_count = HEADER.unpack_from(payload, 0)
+    record = RECORD_FORMATS.get(version)
+    if record is None:
+        raise ValueError(f"Unsupported trade payload version {version}")
+
+    offset = HEADER.size
+    strings = []
+    for _ in range(account_count + ticker_count):
+        (length,) = STRING_LENGTH.unpack_from(payload, offset)
+        offset += STRING_LENGTH.size
+        strings.append(payload[offset:offset + length].decode())
+        offset += length
+    accounts, tickers = strings[:account_count], strings[account_count:]
+
+    if len(payload) - offset != trade_count * record.size:
+        raise ValueError(f"Payload says {trade_count} trades but carries {len(payload) - offset} bytes of records")
+    return [StreamTrade(accounts[account], tickers[ticker], price, SIDES[side], quantity, ACTION_TYPES[action])
+            for account, ticker, price, quantity, side, action in record.iter_unpack(payload[offset:])]
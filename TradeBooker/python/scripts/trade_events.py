@@ -0,0 +1,65 @@
+import os
+import zlib
+import redis
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Booked-trade events are written by the TradeBooker, one stream per virtual shard, so that
+# every trade for a position (account/ticker) lands (in booking order) on the same stream.
+# Positions are hashed onto many more shards than there are worker processes, so skewed account
+# names and hot accounts holding many tickers still spread evenly, and shards can be moved between
+# workers one at a time. Every service must agree on NUM_SHARDS; changing it re-routes positions,
+# so drain the streams first.
+BOOKED_TRADES_STREAM_PREFIX = "booked_trades:"
+NUM_SHARDS = int(os.environ.get("BOOKED_TRADE_SHARDS", 64))
+SHARDS = range(NUM_SHARDS)
+
+AGGREGATOR_GROUP = "aggregator-group"
+PNL_GROUP = "pnl-group"
+# Booked trades the PnL workers failed to apply MAX_DELIVERIES times, parked for inspection
+PNL_DEAD_LETTER_STREAM = "pnl_dead_letters"
+
+
+def shard_for_position(account: str, ticker: str) -> int:
+    """Virtual shard of a position: crc32 of 'account/ticker' modulo NUM_SHARDS."""
+    return zlib.crc32(f"{account.strip()}/{ticker.strip()}".encode()) % NUM_SHARDS
+
+
+def booked_trades_stream(shard: int) -> str:
+    """Generate the stream key for a shard in the following format 'booked_trades:17'"""
+    return f"{BOOKED_TRADES_STREAM_PREFIX}{shard}"
+
+
+def shard_of_stream(stream: str) -> int:
+    """'booked_trades:17' -> 17"""
+    return int(stream[len(BOOKED_TRADES_STREAM_PREFIX):])
+
+
+def shards_for_instance(index: int, count: int) -> list:
+    """Static split of the shards over a fixed number of instances: instance i takes every count-th shard."""
+    return [shard for shard in SHARDS if shard % count == index]
+
+
+def streams_for_shards(shards) -> list:
+    return [booked_trades_stream(shard) for shard in shards]
+
+
+def emit_booked_trade(pipe, trade_key: str, hash_data: dict):
+    """
+    Queue a booked-trade event on the pipeline that writes the trade hash,
+    carrying every field so consumers never have to read the hash back.
+    """
+    event = {"key": trade_key, **hash_data}
+    pipe.xadd(booked_trades_stream(shard_for_position(hash_data["account"], hash_data["ticker"])), event)
+
+
+def ensure_consumer_group(r, stream_key: str, group: str):
+    """Create the consumer group (and the stream) if it doesn't exist yet."""
+    try:
+        r.xgroup_create(stream_key, group, id='0', mkstream=True)
+        logger.info(f"Created consumer group '{group}' on stream '{stream_key}'.")
+    except redis.ResponseError as e:
+        # This error is expected if the consumer group already exists.
+        if "BUSYGROUP" not in str(e):
+            raise
@@ -0,0 +1,141 @@
+import datetime
+from typing import Iterable, List, Optional
+from zoneinfo import ZoneInfo
+
+# Timezone Configuration (trades are booked in EST)
+EST = ZoneInfo("America/New_York")
+
+TRADE_INDEX_PREFIX = "trades_by_account:"
+FETCH_BATCH_SIZE = 1000
+
+
+def trade_index_key(account: str) -> str:
+    """Generate the per-account index key in the following format 'trades_by_account:alice'"""
+    return f"{TRADE_INDEX_PREFIX}{account}"
+
+
+def index_trade(pipe, account: str, trade_key: str, booked_at: float):
+    """
+    Queue the index write for a newly booked trade on an existing pipeline,
+    so it lands together with the trade hash itself.
+
+    :param pipe: Redis pipeline the booker is already writing to.
+    :param account: Account the trade was booked for.
+    :param trade_key: Redis key of the trade hash.
+    :param booked_at: Booking time as a unix timestamp (used as the score).
+    """
+    pipe.zadd(trade_index_key(account), {trade_key: booked_at})
+
+
+def date_range_to_scores(start_date: Optional[datetime.date], end_date: Optional[datetime.date]):
+    """
+    Convert an inclusive EST date range into a (min, max) score range for ZRANGEBYSCORE.
+    A missing bound is left open.
+    """
+    min_score = "-inf"
+    max_score = "+inf"
+    if start_date is not None:
+        start_dt = datetime.datetime.combine(start_date, datetime.time.min, tzinfo=EST)
+        min_score = start_dt.timestamp()
+    if end_date is not None:
+        end_dt = datetime.datetime.combine(end_date + datetime.timedelta(days=1), datetime.time.min, tzinfo=EST)
+        max_score = f"({end_dt.timestamp()}"  # exclusive upper bound: midnight after end_date
+    return min_score, max_score
+
+
+def get_trade_keys(r, account: str, start_date: Optional[datetime.date] = None, end_date: Optional[datetime.date] = None) -> List[str]:
+    """
+    Returns the keys of an account's trades booked within the date range, oldest first.
+
+    :param r: Redis client.
+    :param account: Account to look up.
+    :param start_date: First booking date to include (EST), or None for no lower bound.
+    :param end_date: Last booking date to include (EST), or None for no upper bound.
+    """
+    min_score, max_score = date_range_to_scores(start_date, end_date)
+    return r.zrangebyscore(trade_index_key(account), min_score, max_score)
+
+
+def fetch_trade_hashes(r, keys: Iterable[str], batch_size: int = FETCH_BATCH_SIZE, progress_callback=None) -> List[dict]:
+    """
+    Fetch the trade hashes for the given keys using pipelined HGETALLs.
+    Keys whose hash no longer exists are skipped.
+    """
+    trades = []
+    pipe = r.pipeline(transaction=False)
+    in_pipe = 0
+
+    for key in keys:
+        pipe.hgetall(key)
+        in_pipe += 1
+        if in_pipe >= batch_size:
+            trades += [trade for trade in pipe.execute() if trade]
+            in_pipe = 0
+            if progress_callback:
+                progress_callback(len(trades))
+
+    if in_pipe > 0:
+        trades += [trade for trade in pipe.execute() if trade]
+
+    return trades
+
+
+def fetch_trades_for_accounts(r, accounts: Iterable[str], start_date: Optional[datetime.date] = None, end_date: Optional[datetime.date] = None, progress_callback=None) -> List[dict]:
+    """
+    Fetch all trades for the given accounts within the date range by reading
+    each account's index with one ZRANGEBYSCORE and then pipelining the hash reads.
+    """
+    keys = []
+    for account in accounts:
+        keys += get_trade_keys(r, account, start_date, end_date)
+    return fetch_trade_hashes(r, keys, progress_callback=progress_callback)
+
+
+def rebuild_trade_index(r, match: str = "*:*:*", batch_size: int = FETCH_BATCH_SIZE) -> int:
+    """
+    One-off backfill of the index (and the 'accounts' set) for trades booked before it existed.
+    Walks the keyspace once and covers both booker keys ('alice,AAPL:2025-06-24:<id>', whose hash
+    carries the account and date) and TradeManager keys ('alice:2025-06-24:<uuid>', where they are
+    only in the key). Keys that aren't trade hashes, and trades without a readable booking time,
+    are skipped.
+
+    :return: Number of trades indexed.
+    """
+    indexed = 0
+    batch = []
+
+    def flush(batch_keys):
+        read_pipe = r.pipeline(transaction=False)
+        for key in batch_keys:
+            read_pipe.hmget(key, "account", "trade_date", "trade_time", "ticker")
+        write_pipe = r.pipeline(transaction=False)
+        count = 0
+        for key, fields in zip(batch_keys, read_pipe.execute(raise_on_error=False)):
+            key_parts = key.split(":")
+            if isinstance(fields, Exception) or len(key_parts) != 3:
+                continue  # Not a hash, or not a trade key
+            account, trade_date, trade_time, ticker = fields
+            if not (trade_time and ticker):
+                continue
+            account = account or key_parts[0].split(",", 1)[0]
+            trade_date = trade_date or key_parts[1]
+            try:
+                booked_dt = datetime.datetime.strptime(f"{trade_date} {trade_time.strip('[]')}", "%Y-%m-%d %H:%M:%S").replace(tzinfo=EST)
+            except ValueError:
+                continue
+            index_trade(write_pipe, account, key, booked_dt.timestamp())
+            write_pipe.sadd("accounts", account)
+            count += 1
+        write_pipe.execute()
+        return count
+
+    for key in r.scan_iter(match=match, count=batch_size):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            indexed += flush(batch)
+            batch = []
+
+    if batch:
+        indexed += flush(batch)
+
+    return indexed
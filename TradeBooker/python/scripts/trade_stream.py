@@ -0,0 +1,146 @@
+import time
+import logging
+import threading
+from typing import List, Union
+try:
+    from .trade_codec import StreamTrade, decode_trades, encode_trades, parse_trade_string
+except ImportError:
+    from trade_codec import StreamTrade, decode_trades, encode_trades, parse_trade_string
+
+logger = logging.getLogger(__name__)
+
+# Wire format of 'trades_stream' entries. Producers send a batch of trades packed into one entry
+# by TradeStreamProducer, as a binary trade_codec payload:
+#   {"payload": <encode_trades(...)>}
+# Per-entry costs (the XADD round trip, stream node overhead, XREADGROUP/XACK bookkeeping) are then
+# paid once per batch instead of once per trade. Entries written before the binary format are
+# still decoded: a single trade string,
+#   {"trade_string": "alice,AAPL:150.0:buy:10:trade"}
+# or a newline-joined batch of them,
+#   {"count": "3", "trades": "<trade string>\n<trade string>\n<trade string>"}
+# Consumers must read the stream with a client that doesn't decode responses.
+TRADES_STREAM = "trades_stream"
+PAYLOAD_FIELD = "payload"
+TRADE_STRING_FIELD = "trade_string"
+BATCH_COUNT_FIELD = "count"
+BATCH_TRADES_FIELD = "trades"
+
+MAX_BATCH_TRADES = 500
+MAX_BATCH_DELAY = 0.05  # seconds a trade may wait in the producer before its batch is sent
+
+
+def encode_trade_batch(trades: List[StreamTrade]) -> dict:
+    return {PAYLOAD_FIELD: encode_trades(trades)}
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def decode_trade_entry(fields: dict) -> List[Union[StreamTrade, str]]:
+    """
+    The trades carried by a stream entry, in the order they were sent. Binary payloads decode to
+    StreamTrades; legacy entries yield their raw trade strings for parse_trade_string().
+    """
+    fields = {_text(name): value for name, value in fields.items()}
+    if PAYLOAD_FIELD in fields:
+        return decode_trades(fields[PAYLOAD_FIELD])
+    if TRADE_STRING_FIELD in fields:
+        return [_text(fields[TRADE_STRING_FIELD])]
+    trade_strings = _text(fields[BATCH_TRADES_FIELD]).split("\n")
+    if len(trade_strings) != int(fields[BATCH_COUNT_FIELD]):
+        raise ValueError(f"Batch says {_text(fields[BATCH_COUNT_FIELD])} trades but carries {len(trade_strings)}")
+    return trade_strings
+
+
+def is_single_trade_entry(fields: dict) -> bool:
+    """Legacy single-trade entries book under the plain entry ID instead of '<entry id>-<index>'."""
+    return any(_text(name) == TRADE_STRING_FIELD for name in fields)
+
+
+class TradeStreamProducer:
+    """
+    Buffers trades and sends them to the stream as binary batch entries, flushing once
+    max_batch trades are waiting or the oldest has waited max_delay seconds.
+    Use it as a context manager, or call close() when done so the last batch is sent.
+    """
+
+    def __init__(self, redis_client, stream_key: str = TRADES_STREAM, max_batch: int = MAX_BATCH_TRADES,
+                 max_delay: float = MAX_BATCH_DELAY):
+        self.redis = redis_client
+        self.stream_key = stream_key
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self.buffer = []
+        self.oldest = None  # When the first trade in the buffer was sent
+        self.lock = threading.Lock()
+        self.sent = 0
+
+        self._closed = threading.Event()
+        self._flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flush_thread.start()
+
+    def send(self, trade: Union[StreamTrade, str]):
+        """Queue a trade (a StreamTrade from trade_codec.make_trade, or a trade string). Invalid trades raise here."""
+        if isinstance(trade, str):
+            trade = parse_trade_string(trade)
+        with self.lock:
+            if not self.buffer:
+                self.oldest = time.monotonic()
+            self.buffer.append(trade)
+            if len(self.buffer) >= self.max_batch:
+                self._flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self.buffer:
+            return
+        try:
+            batch = encode_trade_batch(self.buffer)
+        except Exception as e:
+            # Only StreamTrades built by hand can get here. Drop the ones that can't be encoded
+            # rather than keep them queued, where they would fail every flush after this one.
+            logger.error(f"Failed to encode a trade batch: {e}")
+            self.buffer = [trade for trade in self.buffer if self._encodable(trade)]
+            if not self.buffer:
+                self.oldest = None
+                return
+            batch = encode_trade_batch(self.buffer)
+        self.redis.xadd(self.stream_key, batch)
+        self.sent += len(self.buffer)
+        self.buffer = []
+        self.oldest = None
+
+    @staticmethod
+    def _encodable(trade) -> bool:
+        try:
+            encode_trades([trade])
+            return True
+        except Exception as e:
+            logger.error(f"Dropping trade {trade}: {e}")
+            return False
+
+    def _flush_loop(self):
+        """Runs in a separate thread, sending batches that have waited max_delay without filling up."""
+        while not self._closed.wait(self.max_delay / 2):
+            try:
+                with self.lock:
+                    if self.oldest is not None and time.monotonic() - self.oldest >= self.max_delay:
+                        self._flush_locked()
+            except Exception as e:
+                logger.error(f"Failed to send a trade batch: {e}")
+
+    def close(self):
+        self._closed.set()
+        self._flush_thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
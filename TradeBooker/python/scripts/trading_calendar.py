@@ -0,0 +1,119 @@
+import datetime
+import bisect
+import threading
+from functools import lru_cache
+from typing import List, Optional
+from zoneinfo import ZoneInfo
+
+# NYSE trading calendar: weekdays minus exchange holidays, computed from the holiday rules
+# (one-off closures such as national days of mourning are not included).
+MARKET_TIMEZONE = ZoneInfo("America/New_York")
+MARKET_CLOSE = datetime.time(16, 0)
+FIRST_YEAR = 1970
+
+
+def _nth_weekday(year: int, month: int, weekday: int, n: int) -> datetime.date:
+    """n-th given weekday (0 = Monday) of a month; n = -1 for the last one."""
+    if n > 0:
+        first = datetime.date(year, month, 1)
+        return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    next_month = datetime.date(year + month // 12, month % 12 + 1, 1)
+    last = next_month - datetime.timedelta(days=1)
+    return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def _easter(year: int) -> datetime.date:
+    """Gregorian Easter Sunday (anonymous Gregorian algorithm)."""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(year, month, day + 1)
+
+
+def _observed(date: datetime.date) -> datetime.date:
+    """Saturday holidays are observed on Friday, Sunday holidays on Monday."""
+    if date.weekday() == 5:
+        return date - datetime.timedelta(days=1)
+    if date.weekday() == 6:
+        return date + datetime.timedelta(days=1)
+    return date
+
+
+@lru_cache(maxsize=None)
+def holidays(year: int) -> frozenset:
+    days = {
+        _nth_weekday(year, 2, 0, 3),                     # Washington's Birthday
+        _easter(year) - datetime.timedelta(days=2),      # Good Friday
+        _nth_weekday(year, 5, 0, -1),                    # Memorial Day
+        _observed(datetime.date(year, 7, 4)),            # Independence Day
+        _nth_weekday(year, 9, 0, 1),                     # Labor Day
+        _nth_weekday(year, 11, 3, 4),                    # Thanksgiving
+        _observed(datetime.date(year, 12, 25)),          # Christmas
+    }
+    # New Year's Day falling on a Saturday is not observed on the prior Friday
+    new_year = datetime.date(year, 1, 1)
+    if new_year.weekday() != 5:
+        days.add(_observed(new_year))
+    if year >= 1998:
+        days.add(_nth_weekday(year, 1, 0, 3))            # Martin Luther King Jr. Day
+    if year >= 2022:
+        days.add(_observed(datetime.date(year, 6, 19)))  # Juneteenth
+    return frozenset(days)
+
+
+def is_trading_day(date: datetime.date) -> bool:
+    return date.weekday() < 5 and date not in holidays(date.year)
+
+
+# Sorted trading days from FIRST_YEAR through next year, extended on demand
+_trading_days: List[datetime.date] = []
+_last_year = FIRST_YEAR - 1
+_lock = threading.Lock()
+
+
+def _ensure_years(through_year: int):
+    global _last_year
+    if through_year <= _last_year:
+        return
+    with _lock:
+        day = datetime.date(_last_year + 1, 1, 1)
+        end = datetime.date(through_year, 12, 31)
+        while day <= end:
+            if is_trading_day(day):
+                _trading_days.append(day)
+            day += datetime.timedelta(days=1)
+        _last_year = through_year
+
+
+def previous_trading_day(date: datetime.date, inclusive: bool = True) -> Optional[datetime.date]:
+    """The last trading day on (or, with inclusive=False, strictly before) the date."""
+    _ensure_years(max(date.year, datetime.date.today().year + 1))
+    idx = bisect.bisect_right(_trading_days, date) if inclusive else bisect.bisect_left(_trading_days, date)
+    return _trading_days[idx - 1] if idx > 0 else None
+
+
+def last_closed_trading_day(now: datetime.datetime = None) -> datetime.date:
+    """The most recent trading day whose close has happened, i.e. the last date that can have an EOD price."""
+    now = now.astimezone(MARKET_TIMEZONE) if now else datetime.datetime.now(MARKET_TIMEZONE)
+    today = now.date()
+    if is_trading_day(today) and now.time() >= MARKET_CLOSE:
+        return today
+    return previous_trading_day(today, inclusive=False)
+
+
+def can_have_eod_price(date: datetime.date, now: datetime.datetime = None) -> bool:
+    """Negative check: dates after the last close cannot have an EOD price yet, so never fetch them."""
+    return date <= last_closed_trading_day(now)
+
+
+def closest_on_or_before(sorted_dates: List[datetime.date], target: datetime.date) -> Optional[datetime.date]:
+    """Bisect for the latest date in a sorted list that is on or before the target."""
+    idx = bisect.bisect_right(sorted_dates, target)
+    return sorted_dates[idx - 1] if idx > 0 else None
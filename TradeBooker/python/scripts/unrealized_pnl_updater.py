@@ -1,32 +1,37 @@
 import time
 # import redis
 import logging
+import sys
+import numpy as np
 from pnl_calculator import PnLCalculator
-from redis.sentinel import Sentinel
+from price_events import PRICE_CHANGES_STREAM, REVALUATION_GROUP, index_position, positions_by_ticker_key
+from trade_events import ensure_consumer_group
+from redis_connection import get_redis_client
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+WRITE_BATCH_SIZE = 5000  # Changed values per pipelined HSET
+READ_BLOCK_MS = 5000
+MAX_PRICE_CHANGES = 5000  # Price-change events read (and revalued together) per XREADGROUP
+PENDING_RETRY_INTERVAL = 30  # seconds between re-reads of our own unacknowledged price changes
+
 
 class PnLUpdater:
-    def __init__(self, position_hash="positions", update_interval=120):
+    def __init__(self, position_hash="positions", update_interval=5):
         """
         Initializes the PnL updater.
 
         :param position_hash: Redis hash that stores positions (account_id/ticker → shares held)
         :param update_interval: Interval (in seconds) at which to update unrealized PnL
         """
-        # Connect using Sentinel
-        sentinel = Sentinel(
-            [('sentinel1', 26379), ('sentinel2', 26379), ('sentinel3', 26379)],
-            socket_timeout=None,
-            decode_responses=True
-        )
-        self.redis = sentinel.master_for("mymaster", socket_timeout=None, decode_responses=True)
+        # Shared pooled connection to the Sentinel-managed master
+        self.redis = get_redis_client()
         # self.redis = redis.Redis(host='localhost', port=6379, decode_responses=True)
         self.position_hash = position_hash
         self.update_interval = update_interval
         self.pnl_calculator = PnLCalculator()
+        self.consumer = "revaluation-updater"
 
     def get_all_positions(self):
         """
@@ -40,12 +45,204 @@ class PnLUpdater:
             logger.error(f"Failed to fetch positions: {e}")
             return {}
 
+    def backfill_aggregates(self):
+        """
+        One pass over the positions hash that stores the quantity/cost aggregates of any position
+        booked before the PnL workers started maintaining them, so the batch sweep sees every position.
+        """
+        positions = self.get_all_positions()
+        position_keys = [key.replace(":", "/", 1) for key in positions]
+        if not position_keys:
+            return 0
+
+        stored = self.redis.hmget(self.pnl_calculator.open_quantity_by_position_hash, position_keys)
+        backfilled = 0
+        for position_key, open_quantity in zip(position_keys, stored):
+            if open_quantity is None:
+                account_id, ticker = position_key.split("/", 1)
+                self.pnl_calculator.get_position_aggregates(account_id, ticker)
+                backfilled += 1
+        logger.info(f"Backfilled quantity/cost aggregates for {backfilled} positions.")
+        return backfilled
+
+    def rebuild_ticker_index(self):
+        """Adds every open position to its ticker's reverse index (idempotent; the PnL workers keep it current)."""
+        open_quantities = self.redis.hgetall(self.pnl_calculator.open_quantity_by_position_hash)
+        pipe = self.redis.pipeline(transaction=False)
+        indexed = 0
+        for position_key, open_quantity in open_quantities.items():
+            if float(open_quantity):
+                index_position(pipe, position_key, open_quantity)
+                indexed += 1
+        pipe.execute()
+        logger.info(f"Indexed {indexed} open positions by ticker.")
+        return indexed
+
+    def load_book(self):
+        """
+        Loads the whole book into arrays: one entry per position.
+
+        :return: (position keys, tickers, open quantities, cost bases, stored unrealized PnL)
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(self.pnl_calculator.open_quantity_by_position_hash)
+        pipe.hgetall(self.pnl_calculator.cost_basis_by_position_hash)
+        pipe.hgetall(self.pnl_calculator.unrealized_pnl_by_position_hash)
+        open_quantities, cost_bases, stored_pnl = pipe.execute()
+
+        position_keys = list(open_quantities.keys())
+        tickers = np.array([key.split("/", 1)[1] for key in position_keys], dtype=object)
+        quantity = np.fromiter((float(open_quantities[key]) for key in position_keys), dtype=np.float64, count=len(position_keys))
+        cost = np.fromiter((float(cost_bases.get(key) or 0.0) for key in position_keys), dtype=np.float64, count=len(position_keys))
+        old_pnl = np.fromiter((float(stored_pnl.get(key) or 0.0) for key in position_keys), dtype=np.float64, count=len(position_keys))
+        return position_keys, tickers, quantity, cost, old_pnl
+
+    def fetch_live_prices(self, tickers):
+        """
+        One MGET for the live price of every ticker.
+
+        :return: Array of prices aligned with tickers, NaN where there is no live price.
+        """
+        values = self.redis.mget([f"{ticker.upper()}:Live" for ticker in tickers])
+        return np.array([float(value) if value is not None else np.nan for value in values], dtype=np.float64)
+
+    @staticmethod
+    def revalue(quantity, cost, prices):
+        """
+        Vectorized unrealized PnL for the whole book: open_quantity * price - cost_basis.
+        Flat positions are worth 0; positions without a live price come back as NaN.
+        """
+        unrealized = quantity * prices - cost
+        return np.where(quantity == 0, 0.0, unrealized)
+
+    def store_changed(self, position_keys, new_pnl, old_pnl) -> int:
+        """Writes back only the values that changed to the cent, in pipelined HSETs. Returns how many changed."""
+        # NaN compares unequal to everything, so positions without a price need excluding explicitly
+        changed = ~np.isnan(new_pnl) & (np.round(new_pnl, 2) != np.round(old_pnl, 2))
+        changed_idx = np.flatnonzero(changed)
+
+        pipe = self.redis.pipeline(transaction=False)
+        for start in range(0, len(changed_idx), WRITE_BATCH_SIZE):
+            batch = changed_idx[start:start + WRITE_BATCH_SIZE]
+            mapping = {position_keys[i]: float(new_pnl[i]) for i in batch}
+            pipe.hset(self.pnl_calculator.unrealized_pnl_by_position_hash, mapping=mapping)
+        pipe.execute()
+        return len(changed_idx)
+
     def update_unrealized_pnl(self):
         """
-        Updates the unrealized PnL for all positions and logs the number of changes.
+        Batch revaluation of the whole book: load positions and their aggregates, fetch all prices
+        with one MGET, compute every unrealized PnL in one vectorized pass and write back only the
+        values that changed (to the cent) in pipelined HSETs.
         """
         logger.info("Starting unrealized PnL update for all positions.")
 
+        position_keys, tickers, quantity, cost, old_pnl = self.load_book()
+        total_positions = len(position_keys)
+        if not total_positions:
+            logger.warning("No positions found. Unrealized PnL cannot be updated.")
+            return 0
+
+        unique_tickers, ticker_index = np.unique(tickers, return_inverse=True)
+        prices = self.fetch_live_prices(unique_tickers)
+        missing = np.isnan(prices)
+        if missing.any():
+            logger.warning(f"No live price for {int(missing.sum())} tickers; their positions keep their last value.")
+
+        new_pnl = self.revalue(quantity, cost, prices[ticker_index])
+        changed_count = self.store_changed(position_keys, new_pnl, old_pnl)
+        logger.info(f"Unrealized PnL update completed. {changed_count} of {total_positions} positions were updated.")
+        return changed_count
+
+    def revalue_tickers(self, prices_by_ticker: dict) -> int:
+        """
+        Revalues only the open positions holding the given tickers, at the given prices:
+        reverse index lookup, one HMGET per hash for their aggregates, then the same vectorized pass.
+        """
+        tickers = list(prices_by_ticker.keys())
+        pipe = self.redis.pipeline(transaction=False)
+        for ticker in tickers:
+            pipe.smembers(positions_by_ticker_key(ticker))
+        holders = pipe.execute()
+
+        position_keys = []
+        prices = []
+        for ticker, members in zip(tickers, holders):
+            position_keys += members
+            prices += [prices_by_ticker[ticker]] * len(members)
+        if not position_keys:
+            return 0
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hmget(self.pnl_calculator.open_quantity_by_position_hash, position_keys)
+        pipe.hmget(self.pnl_calculator.cost_basis_by_position_hash, position_keys)
+        pipe.hmget(self.pnl_calculator.unrealized_pnl_by_position_hash, position_keys)
+        open_quantities, cost_bases, stored_pnl = pipe.execute()
+
+        quantity = np.array([float(value or 0.0) for value in open_quantities], dtype=np.float64)
+        cost = np.array([float(value or 0.0) for value in cost_bases], dtype=np.float64)
+        old_pnl = np.array([float(value or 0.0) for value in stored_pnl], dtype=np.float64)
+
+        new_pnl = self.revalue(quantity, cost, np.array(prices, dtype=np.float64))
+        return self.store_changed(position_keys, new_pnl, old_pnl)
+
+    def listen_price_changes(self):
+        """
+        Event-driven revaluation: consumes the market-data feed's price-change stream and
+        recomputes only the positions holding tickers that moved. Each read is handled as one
+        batch (latest price per ticker wins) and acknowledged once its values are written.
+        A batch that fails stays pending and is read again ('0') right after the error, and
+        every PENDING_RETRY_INTERVAL anyway, so no price move is left unrevalued.
+        """
+        ensure_consumer_group(self.redis, PRICE_CHANGES_STREAM, REVALUATION_GROUP)
+        logger.info(f"Listening for price changes on '{PRICE_CHANGES_STREAM}' as '{self.consumer}'...")
+
+        # Start with our own pending entries ('0') left over from a previous run, then switch to new ones ('>')
+        read_id = '0'
+        last_pending_read = time.time()
+
+        while True:
+            if read_id == '>' and time.time() - last_pending_read >= PENDING_RETRY_INTERVAL:
+                read_id = '0'
+            try:
+                messages = self.redis.xreadgroup(
+                    groupname=REVALUATION_GROUP,
+                    consumername=self.consumer,
+                    streams={PRICE_CHANGES_STREAM: read_id},
+                    count=MAX_PRICE_CHANGES,
+                    block=READ_BLOCK_MS
+                )
+                entries = messages[0][1] if messages else []
+                if not entries:
+                    if read_id == '0':
+                        last_pending_read = time.time()
+                    read_id = '>'
+                    continue
+
+                prices_by_ticker = {}
+                for msg_id, event in entries:
+                    try:
+                        prices_by_ticker[event["ticker"].upper()] = float(event["new"])
+                    except (KeyError, ValueError) as e:
+                        logger.warning(f"Skipping malformed price change {msg_id}: {e}")
+
+                changed_count = self.revalue_tickers(prices_by_ticker)
+                self.redis.xack(PRICE_CHANGES_STREAM, REVALUATION_GROUP, *[msg_id for msg_id, _ in entries])
+                logger.info(f"{len(prices_by_ticker)} tickers moved; {changed_count} positions revalued.")
+
+            except Exception as e:
+                logger.error(f"Price-change stream read error: {e}")
+                # Whatever was read but not acked is still pending; go back for it
+                read_id = '0'
+                time.sleep(1)
+
+    def update_unrealized_pnl_per_position(self):
+        """
+        Updates the unrealized PnL one position at a time through the PnL calculator.
+        Kept for debugging a single book; run() uses the batch paths above.
+        """
+        logger.info("Starting per-position unrealized PnL update for all positions.")
+
         positions = self.get_all_positions()
         if not positions:
             logger.warning("No positions found. Unrealized PnL cannot be updated.")
@@ -65,13 +262,38 @@ class PnLUpdater:
 
         logger.info(f"Unrealized PnL update completed. {changed_count} of {total_positions} positions were updated.")
 
+    def prepare(self):
+        """Startup: make sure every position has aggregates and is in the ticker index."""
+        try:
+            self.backfill_aggregates()
+            self.rebuild_ticker_index()
+        except Exception as e:
+            logger.error(f"Failed to backfill quantity/cost aggregates: {e}")
+
+    def run_on_price_changes(self):
+        # One full sweep catches up on anything that moved while nobody was consuming, then only moved tickers are revalued
+        self.prepare()
+        self.update_unrealized_pnl()
+        self.listen_price_changes()
+
     def run(self):
         #Runs the PnL updater periodically.
+        self.prepare()
+
         while True:
-            self.update_unrealized_pnl()
-            logger.info(f"Sleeping for {self.update_interval} seconds before next update.")
+            try:
+                self.update_unrealized_pnl()
+            except Exception as e:
+                logger.error(f"Unrealized PnL sweep failed: {e}")
+            logger.debug(f"Sleeping for {self.update_interval} seconds before next update.")
             time.sleep(self.update_interval)
 
 if __name__ == "__main__":
-    updater = PnLUpdater(update_interval=120)  # Updates every two minutes by default
-    updater.run()
\ No newline at end of file
+    # Usage: python unrealized_pnl_updater.py                      revalue on price changes (default)
+    #        python unrealized_pnl_updater.py --sweep [INTERVAL]   sweep the whole book every INTERVAL seconds
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if "--sweep" in sys.argv:
+        interval = float(args[0]) if args else 5
+        PnLUpdater(update_interval=interval).run()  # Sweeps the whole book every few seconds by default
+    else:
+        PnLUpdater().run_on_price_changes()
@@ -0,0 +1,82 @@
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+import pandas as pd
+import yfinance as yf
+
+# Every yf.download in a process goes through download() below. yf.download keeps its results in
+# module-global dicts that every call resets, so two calls in flight at once in the same process can
+# drop or swap each other's frames: download_lock lets only one run at a time. download_limiter paces
+# the calls of the whole process so the refresher, PnL workers and UI together stay under Yahoo's limits.
+# To have several downloads in flight, DownloadPool runs them in worker processes, each with its own
+# yfinance state, still paced by the limiter of the process that submits them.
+DOWNLOADS_PER_SECOND = 2
+DOWNLOAD_BURST = 4
+
+
+class RateLimiter:
+    """
+    Token bucket shared by the download callers: allows `rate` calls per second on average
+    with bursts of up to `burst`, blocking callers only as long as needed.
+    """
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+download_limiter = RateLimiter(DOWNLOADS_PER_SECOND, burst=DOWNLOAD_BURST)
+download_lock = threading.Lock()
+
+
+def _download(tickers: List[str], kwargs: dict) -> pd.DataFrame:
+    with download_lock:
+        return yf.download(' '.join(tickers), threads=True, ignore_tz=True, progress=False, auto_adjust=True, **kwargs)
+
+
+def download(tickers: List[str], **kwargs) -> pd.DataFrame:
+    """Rate-limited yf.download of several tickers at once, serialized with every other download in the process."""
+    download_limiter.acquire()
+    return _download(tickers, kwargs)
+
+
+class DownloadPool:
+    """
+    Runs downloads in `processes` worker processes so that many can be in flight at once. Workers are
+    spawned (not forked) on the first download, so they start without the caller's threads and connections.
+    """
+
+    def __init__(self, processes: int):
+        self.processes = processes
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def download(self, tickers: List[str], **kwargs) -> pd.DataFrame:
+        """Same as download(), but the call runs in a worker process; blocks until its frame is back."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"))
+        download_limiter.acquire()
+        return self._executor.submit(_download, list(tickers), kwargs).result()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
@@ -4,7 +4,6 @@ import os
 import pandas as pd
 import streamlit as st
 import redis
-from redis.sentinel import Sentinel
 from redis.exceptions import BusyLoadingError, ConnectionError
 import yfinance as yf
 import plotly.graph_objects as go
@@ -19,8 +18,12 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 from scripts.send_trades_to_stream import book_trades_in_batches, book_custom_trade_to_stream
 from scripts.TradeManager import TradeManager
 from scripts.UserManager import UserManager
-from scripts.market_data import get_historical_price, get_price, get_eod_price_range
+from scripts.market_data import get_historical_price, get_price, get_prices, get_eod_price_range
 from scripts.pnl_getters import PnLRetriever
+from scripts.trade_index import fetch_trades_for_accounts
+from scripts.redis_connection import get_redis_client
+from scripts.ticker_demand import record_ticker_view
+from scripts.yf_downloads import download
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -55,14 +58,8 @@ def get_current_est_date():
     return datetime.datetime.now(EST).date()
 
 def get_redis_connection():
-       sentinel_hosts = [
-           ("sentinel1", 26379),
-           ("sentinel2", 26379),
-           ("sentinel3", 26379)
-       ]
-       sentinel = Sentinel(sentinel_hosts, socket_timeout=5)
-       redis_master = sentinel.master_for("mymaster", decode_responses=True, socket_timeout=10)
-       return redis_master
+       # One pooled client per Streamlit process, shared across reruns and sessions
+       return get_redis_client(socket_timeout=10)
 
 def ensure_stream_and_group_exist(redis_client, stream_key="trades_stream", group_name="booker-group"):
     # If stream doesn't exist, create an empty one
@@ -80,29 +77,15 @@ ensure_stream_and_group_exist(get_redis_connection())
 
 
 def fetch_trades(_r, accounts: tuple, start_date: datetime.date, end_date: datetime.date, _status_container=None, start_time=None):
-    all_trades = []
     if _status_container:
         _status_container.update(label=f"Fetching data...")
 
-    pipe = _r.pipeline()
-    trades_in_pipe = 0
-
-    for account in accounts:
-        for key in _r.scan_iter(match=f"{account}*:*:*", count=1000):
-            date = key.split(':')[1]
-            if date <= end_date.strftime("%Y-%m-%d") and date >= start_date.strftime("%Y-%m-%d"):
-                pipe.hgetall(key)
-                trades_in_pipe += 1
-                if trades_in_pipe >= 1000:
-                    results = pipe.execute()
-                    trades_in_pipe = 0
-                    all_trades+=results
-                    if _status_container:
-                        _status_container.update(label=f"Processed {len(all_trades)} trades...", state="running")
-
-    if trades_in_pipe > 0:
-        results = pipe.execute()
-        all_trades+=results
+    def report_progress(fetched):
+        if _status_container:
+            _status_container.update(label=f"Processed {fetched} trades...", state="running")
+
+    # Reads each account's time-ordered index instead of scanning the keyspace
+    all_trades = fetch_trades_for_accounts(_r, accounts, start_date, end_date, progress_callback=report_progress)
 
     if _status_container:
         _status_container.update(label=f"Fetched {len(all_trades)} trades in {time.perf_counter() - start_time:.2f}s", state="complete")
@@ -508,6 +491,11 @@ def stock_data_tab(r):
     with col1:
         selected_ticker = st.session_state.get("selected_ticker")
         if selected_ticker:
+            try:
+                # Viewed tickers join the market-data feed's fast refresh tier
+                record_ticker_view(get_redis_connection(), selected_ticker)
+            except Exception as e:
+                logger.warning(f"Could not record view of {selected_ticker}: {e}")
             company_name = get_company_name(selected_ticker)
             st.subheader(f"{company_name} ({selected_ticker})")
             display_live_price(selected_ticker)
@@ -541,7 +529,7 @@ def stock_data_tab(r):
 @st.cache_data(ttl=3600)
 def get_earliest_yfinance_date(ticker):
     try:
-        df = yf.download(ticker, start="1900-01-01", end=get_current_est_date()) # Use timezone-aware date
+        df = download([ticker], start="1900-01-01", end=get_current_est_date()) # Use timezone-aware date
         if not df.empty:
             return pd.to_datetime(df.index[0]).date()
         else:
@@ -614,6 +602,12 @@ def display_stock_data(ticker, start_date, end_date):
         st.error(f"Error fetching historical data for {ticker}: {e}")
 
 def display_detailed_positions(df, _pnl_retriever):
+    # One round trip for every ticker's live price
+    try:
+        prices = get_prices(df["Ticker"])
+    except Exception:
+        prices = {}
+
     for _, row in df.iterrows():
         company_name = get_company_name(row["Ticker"])
         label = f"**{company_name}** ({row['Ticker']})"
@@ -635,11 +629,8 @@ def display_detailed_positions(df, _pnl_retriever):
             except Exception as e:
                 st.info("PnL data is pending calculation.")
 
-            try:
-                current_price = get_price(row["Ticker"], 1)
-                st.write(f"**Current Price:** ${current_price:.2f}" if current_price is not None else "Current Price: N/A")
-            except Exception:
-                st.write("Current Price: N/A")
+            current_price = prices.get(row["Ticker"].upper())
+            st.write(f"**Current Price:** ${current_price:.2f}" if current_price is not None else "Current Price: N/A")
 
 def load_all_tickers(file_path):
    try:
@@ -684,6 +675,12 @@ def display_positions_data(r, pnl_retriever):
     df["Total PnL"] = 0.0
     df["Current Price"] = None
 
+    # One round trip for every ticker's live price
+    try:
+        prices = get_prices(df["ticker"])
+    except Exception:
+        prices = {}
+
     for idx, row in df.iterrows():
         account = row["account"]
         ticker = row["ticker"]
@@ -694,11 +691,8 @@ def display_positions_data(r, pnl_retriever):
             df.at[idx, "Total PnL"] = pnl_data.get('total_pnl', 0.0)
         except Exception:
             pass
-        try:
-            price = get_price(ticker, 1)
-            df.at[idx, "Current Price"] = price if price is not None else "N/A"
-        except Exception:
-            df.at[idx, "Current Price"] = "N/A"
+        price = prices.get(ticker.upper())
+        df.at[idx, "Current Price"] = price if price is not None else "N/A"
 
     # Rename columns for display
     df = df.rename(columns={
@@ -803,6 +797,11 @@ def display_single_account_view(account_name, r, pnl_retriever):
                 positions = get_account_positions(account_name, r)
                 if positions:
                     rows = []
+                    # One round trip for every ticker's live price
+                    try:
+                        prices = get_prices(key.split(":")[1] for key in positions)
+                    except Exception:
+                        prices = {}
                     for key, value in positions.items():
                         ticker = key.split(":")[1]
                         shares = int(value)
@@ -814,9 +813,8 @@ def display_single_account_view(account_name, r, pnl_retriever):
                             total_pnl = pnl_data.get('total_pnl', 0.0)
                         except Exception:
                             unrealized_pnl = realized_pnl = total_pnl = 0.0
-                        try:
-                            price = get_price(ticker, 1)
-                        except Exception:
+                        price = prices.get(ticker.upper())
+                        if price is None:
                             price = "N/A"
                         rows.append({
                             "Account": account_name,